@@ -0,0 +1,307 @@
+import os
+
+import cooler
+import numpy as np
+import pandas as pd
+
+from basenji import layers, stream, triu
+from basenji.genome import fetch_seq
+
+# Genome-wide Akita prediction. Windows slide along each chromosome at a
+# bin-aligned stride, their upper triangular predictions stream to a
+# resumable, chunked HDF5 file, and overlapping predictions are merged by
+# a center-weighted average into a banded chromosome-wide pixel table,
+# written as a cooler. Both stages hold O(window) memory.
+
+
+def window_geometry(model):
+    """
+    Describe the contact map of a Keras Akita model.
+
+    Parameters:
+    - model (tf.keras.Model): Model with OneToTwo and UpperTri layers, e.g. SeqNN.model.
+
+    Returns:
+    dict: seq_length, bin_size (bp), crop_bins (bins cropped from each side of
+    the map), matrix_len (bins of the cropped map) and diagonal_offset.
+    """
+    seq_length = model.inputs[0].shape[1]
+    one_to_two = [layer for layer in model.layers if isinstance(layer, layers.OneToTwo)][0]
+    upper_tri = [layer for layer in model.layers if isinstance(layer, layers.UpperTri)][0]
+
+    map_len = one_to_two.output.shape[1]
+    matrix_len = upper_tri.input.shape[1]
+    if seq_length % map_len != 0 or (map_len - matrix_len) % 2 != 0:
+        raise ValueError("Model %s has an unexpected contact map layout" % model.name)
+
+    return {
+        "seq_length": seq_length,
+        "bin_size": seq_length // map_len,
+        "crop_bins": (map_len - matrix_len) // 2,
+        "matrix_len": matrix_len,
+        "diagonal_offset": upper_tri.diagonal_offset,
+    }
+
+
+def tile_windows(chrom_sizes, geometry, stride_bins):
+    """
+    Slide windows along chromosomes so that their cropped maps start at bin 0
+    and advance by stride_bins, until the maps cover each chromosome.
+    Windows may extend past chromosome ends, which are fetched as N.
+
+    Parameters:
+    - chrom_sizes (dict or pandas.DataFrame): Chromosome lengths, as {chrom: length}
+      or a DataFrame with chrom and length columns.
+    - geometry (dict): Output of window_geometry.
+    - stride_bins (int): Stride between windows, in bins.
+
+    Returns:
+    pandas.DataFrame: chrom, start, end of each window, and map_bin, the
+    chromosome bin at which its cropped map starts.
+    """
+    if isinstance(chrom_sizes, pd.DataFrame):
+        chrom_sizes = dict(zip(chrom_sizes.chrom, chrom_sizes.length))
+    if stride_bins < 1 or stride_bins > geometry["matrix_len"]:
+        raise ValueError("stride_bins must be between 1 and the map length %d" % geometry["matrix_len"])
+
+    bin_size = geometry["bin_size"]
+    windows = []
+    for chrom, chrom_len in chrom_sizes.items():
+        chrom_bins = -(-chrom_len // bin_size)
+        last_bin = max(chrom_bins - geometry["matrix_len"], 0)
+        map_bins = np.arange(0, last_bin + 1, stride_bins)
+        if map_bins[-1] < last_bin:
+            map_bins = np.append(map_bins, map_bins[-1] + stride_bins)
+
+        starts = (map_bins - geometry["crop_bins"]) * bin_size
+        windows.append(pd.DataFrame({
+            "chrom": chrom,
+            "start": starts,
+            "end": starts + geometry["seq_length"],
+            "map_bin": map_bins,
+        }))
+
+    return pd.concat(windows, ignore_index=True)
+
+
+def center_weights(matrix_len, diagonal_offset=2):
+    """
+    Weight each upper triangular entry by the distance of its midpoint along
+    the diagonal from the window center, decaying linearly from 1 at the center
+    to 1/matrix_len at the map corners.
+
+    Returns:
+    numpy.ndarray: (M,) float32 weights.
+    """
+    rows, cols = triu.triu_indices(matrix_len, diagonal_offset)
+    center = (matrix_len - 1) / 2
+    midpoints = (rows + cols) / 2
+    weights = 1 - np.abs(midpoints - center) / (matrix_len / 2)
+    return weights.astype("float32")
+
+
+def predict_windows(model, genome_open, windows_df, preds_file, batch_size=4,
+                    chunk_seqs=32, float16=True, seq_index=False, verbose=False):
+    """
+    Predict windows into a resumable basenji.stream.PredStreamH5 file. Chunks
+    completed by an earlier, interrupted run are skipped.
+
+    Parameters:
+    - model (tf.keras.Model): Model, e.g. SeqNN.model or SeqNN.ensemble.
+    - genome_open (GenomeStore or pysam.Fastafile): Genome to fetch windows from.
+    - windows_df (pandas.DataFrame): Output of tile_windows.
+    - preds_file (str): HDF5 predictions file.
+    - batch_size (int), chunk_seqs (int): Prediction batch and chunk sizes.
+    - float16 (bool): Store predictions as float16.
+    - seq_index (bool): Model takes uint8 index sequences.
+
+    Returns:
+    basenji.stream.PredStreamH5: Completed predictions, open for reading.
+    """
+    num_windows = windows_df.shape[0]
+    pred_shape = tuple(model.outputs[0].shape[1:])
+    preds_stream = stream.PredStreamH5(preds_file, num_windows, pred_shape,
+                                       chunk_seqs=chunk_seqs, float16=float16)
+
+    def seqs_fn(row_start, row_end):
+        chunk_df = windows_df.iloc[row_start:row_end]
+        return np.array([fetch_seq(genome_open, chrom, start, end, seq_index=seq_index)
+                         for chrom, start, end in zip(chunk_df.chrom, chunk_df.start, chunk_df.end)])
+
+    preds_stream.write_stream(model, seqs_fn, batch_size, verbose=verbose)
+    return preds_stream
+
+
+def genome_bins(chrom_sizes, bin_size):
+    """
+    Return the cooler bin table of chromosomes at bin_size.
+
+    Returns:
+    pandas.DataFrame: chrom, start, end of each bin.
+    """
+    if isinstance(chrom_sizes, pd.DataFrame):
+        chrom_sizes = dict(zip(chrom_sizes.chrom, chrom_sizes.length))
+    return cooler.binnify(pd.Series(chrom_sizes), bin_size)
+
+
+def stitch_pixels(preds_stream, windows_df, chrom_sizes, geometry, target_index=0):
+    """
+    Merge overlapping window predictions into chromosome-wide pixels, as the
+    center_weights weighted average of all windows covering each pixel.
+
+    Windows are read in order, one at a time, and accumulated into a rolling
+    matrix_len x matrix_len band of rows; rows before the next window's map are
+    complete and emitted. Pixels nearer the diagonal than diagonal_offset, or
+    beyond the chromosome end, are omitted.
+
+    Parameters:
+    - preds_stream (basenji.stream.PredStreamH5): Predictions of windows_df.
+    - windows_df (pandas.DataFrame): Output of tile_windows, in its order.
+    - chrom_sizes (dict or pandas.DataFrame): Chromosome lengths, in genome_bins order.
+    - geometry (dict): Output of window_geometry.
+    - target_index (int): Prediction target.
+
+    Yields:
+    pandas.DataFrame: bin1_id, bin2_id, count pixel chunks, sorted, with
+    genome-wide bin ids of genome_bins.
+    """
+    if isinstance(chrom_sizes, pd.DataFrame):
+        chrom_sizes = dict(zip(chrom_sizes.chrom, chrom_sizes.length))
+    bin_size = geometry["bin_size"]
+    matrix_len = geometry["matrix_len"]
+
+    rows, cols = triu.triu_indices(matrix_len, geometry["diagonal_offset"])
+    band_index = rows * matrix_len + (cols - rows)
+    weights = center_weights(matrix_len, geometry["diagonal_offset"])
+
+    # windows are read in order, so cache one decompressed chunk at a time
+    chunk_cache = {}
+
+    def window_preds(wi):
+        ci = wi // preds_stream.chunk_seqs
+        if ci not in chunk_cache:
+            chunk_cache.clear()
+            row_start, row_end = preds_stream.chunk_rows(ci)
+            chunk_cache[ci] = preds_stream[row_start:row_end][..., target_index]
+        return chunk_cache[ci][wi - ci * preds_stream.chunk_seqs]
+
+    chrom_offset = 0
+    for chrom, chrom_len in chrom_sizes.items():
+        chrom_bins = -(-chrom_len // bin_size)
+        chrom_windows = np.nonzero((windows_df.chrom == chrom).values)[0]
+
+        # rolling accumulators over [base, base+matrix_len) rows and their bands
+        acc_wp = np.zeros((matrix_len, matrix_len), dtype="float64")
+        acc_w = np.zeros((matrix_len, matrix_len), dtype="float64")
+        base = 0
+
+        for wi in chrom_windows:
+            map_bin = int(windows_df.map_bin.values[wi])
+            if map_bin > base:
+                shift = min(map_bin - base, matrix_len)
+                pixels_df = _band_pixels(acc_wp, acc_w, base, shift, chrom_bins, chrom_offset)
+                if len(pixels_df) > 0:
+                    yield pixels_df
+                acc_wp = np.roll(acc_wp, -shift, axis=0)
+                acc_w = np.roll(acc_w, -shift, axis=0)
+                acc_wp[-shift:] = 0
+                acc_w[-shift:] = 0
+                base = map_bin
+
+            preds = window_preds(wi).astype("float64")
+            acc_wp.flat[band_index] += weights * preds
+            acc_w.flat[band_index] += weights
+
+        pixels_df = _band_pixels(acc_wp, acc_w, base, matrix_len, chrom_bins, chrom_offset)
+        if len(pixels_df) > 0:
+            yield pixels_df
+        chrom_offset += chrom_bins
+
+
+def _band_pixels(acc_wp, acc_w, base, num_rows, chrom_bins, chrom_offset):
+    """Return the averaged, covered pixels of the first num_rows band rows."""
+    row_i, band_i = np.nonzero(acc_w[:num_rows] > 0)
+    bin1 = base + row_i
+    bin2 = bin1 + band_i
+    valid = bin2 < chrom_bins
+    row_i, band_i = row_i[valid], band_i[valid]
+
+    return pd.DataFrame({
+        "bin1_id": chrom_offset + bin1[valid],
+        "bin2_id": chrom_offset + bin2[valid],
+        "count": (acc_wp[row_i, band_i] / acc_w[row_i, band_i]).astype("float32"),
+    })
+
+
+def write_cooler(cool_file, preds_stream, windows_df, chrom_sizes, geometry,
+                 target_index=0, assembly=None):
+    """
+    Stitch one target's window predictions into a cooler whose float32 count
+    column holds the merged predictions. The cooler is written to a temporary
+    file and renamed, so an existing cool_file is always complete.
+    """
+    if not preds_stream.done():
+        raise ValueError("%s has unfinished chunks" % preds_stream.h5_file)
+
+    bins_df = genome_bins(chrom_sizes, geometry["bin_size"])
+    pixels = stitch_pixels(preds_stream, windows_df, chrom_sizes, geometry, target_index)
+
+    tmp_file = cool_file + ".tmp"
+    cooler.create_cooler(tmp_file, bins_df, pixels, dtypes={"count": "float32"},
+                         ordered=True, assembly=assembly, mode="w",
+                         metadata={"target_index": target_index,
+                                   "seq_length": geometry["seq_length"]})
+    os.replace(tmp_file, cool_file)
+
+
+def predict_genome(model, genome_open, out_dir, stride_bins=None, chroms=None,
+                   targets=None, batch_size=4, chunk_seqs=32, seq_index=False,
+                   assembly=None, verbose=False):
+    """
+    Predict whole chromosomes into one cooler per target. Rerunning with the
+    same arguments resumes: completed prediction chunks and coolers are kept.
+
+    Parameters:
+    - model (tf.keras.Model): Model, e.g. SeqNN.model or SeqNN.ensemble.
+    - genome_open (GenomeStore or pysam.Fastafile): Genome, e.g. from basenji.genome.open_genome.
+    - out_dir (str): Output directory for windows.tsv, preds.h5 and target<i>.cool.
+    - stride_bins (int, optional): Window stride in bins. Default is half the map length.
+    - chroms (list, optional): Chromosomes to predict. Default is all.
+    - targets (list, optional): Target indexes to write. Default is all.
+    - batch_size (int), chunk_seqs (int): Prediction batch and chunk sizes.
+    - seq_index (bool): Model takes uint8 index sequences.
+    - assembly (str, optional): Genome assembly name for the coolers.
+
+    Returns:
+    list: Written cooler file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    geometry = window_geometry(model)
+    if stride_bins is None:
+        stride_bins = geometry["matrix_len"] // 2
+
+    chrom_sizes = dict(zip(genome_open.references, genome_open.lengths))
+    if chroms is not None:
+        chrom_sizes = {chrom: chrom_sizes[chrom] for chrom in chroms}
+
+    windows_df = tile_windows(chrom_sizes, geometry, stride_bins)
+    windows_df.to_csv(os.path.join(out_dir, "windows.tsv"), sep="\t", index=False)
+
+    preds_stream = predict_windows(model, genome_open, windows_df,
+                                   os.path.join(out_dir, "preds.h5"),
+                                   batch_size=batch_size, chunk_seqs=chunk_seqs,
+                                   seq_index=seq_index, verbose=verbose)
+
+    if targets is None:
+        targets = range(preds_stream.preds.shape[-1])
+
+    cool_files = []
+    for ti in targets:
+        cool_file = os.path.join(out_dir, "target%d.cool" % ti)
+        if not os.path.isfile(cool_file):
+            write_cooler(cool_file, preds_stream, windows_df, chrom_sizes, geometry,
+                         target_index=ti, assembly=assembly)
+        cool_files.append(cool_file)
+
+    preds_stream.close()
+    return cool_files
@@ -0,0 +1,204 @@
+from functools import lru_cache
+
+import numpy as np
+import scipy.sparse
+
+from basenji import triu
+
+# Contact map scores computed directly on the flat upper triangular vectors
+# produced by layers.UpperTri, without expanding them with ut_dense.
+# Predictions are (M x T) or (N x M x T) arrays of M upper triangular entries
+# and T targets; scores are returned per sequence and target.
+
+
+def _as_batch(preds_ut):
+    """Return predictions as an (N x M x T) array and whether a batch axis was added."""
+    preds_ut = np.asarray(preds_ut)
+    if preds_ut.ndim == 2:
+        return preds_ut[np.newaxis], True
+    return preds_ut, False
+
+
+def _aggregate(agg_matrix, preds_ut):
+    """
+    Apply a sparse (K x M) aggregation matrix to an (N x M x T) batch.
+
+    Returns
+    --------
+    (N x K x T) numpy array
+    """
+    num_seqs, ut_len, num_targets = preds_ut.shape
+    # (M x N*T), so the sparse matrix is applied once for the whole batch
+    preds_flat = preds_ut.transpose(1, 0, 2).reshape(ut_len, num_seqs * num_targets)
+    agg_preds = np.asarray(agg_matrix @ preds_flat, dtype="float64")
+    agg_preds = agg_preds.reshape(-1, num_seqs, num_targets)
+    return agg_preds.transpose(1, 0, 2)
+
+
+@lru_cache(maxsize=32)
+def ut_distances(matrix_len, diagonal_offset=2):
+    """Genomic distance, in bins, of each upper triangular entry to the diagonal."""
+    rows, cols = triu.triu_indices(matrix_len, diagonal_offset)
+    distances = cols - rows
+    distances.setflags(write=False)
+    return distances
+
+
+@lru_cache(maxsize=32)
+def _distance_matrix(matrix_len, diagonal_offset):
+    """Sparse matrix averaging upper triangular entries by distance to the diagonal."""
+    distances = ut_distances(matrix_len, diagonal_offset)
+    ut_len = len(distances)
+    diag_counts = np.bincount(distances - diagonal_offset)
+
+    agg_matrix = scipy.sparse.csr_matrix(
+        (1 / diag_counts[distances - diagonal_offset],
+         (distances - diagonal_offset, np.arange(ut_len))),
+        shape=(len(diag_counts), ut_len),
+    )
+    return agg_matrix
+
+
+@lru_cache(maxsize=32)
+def _insulation_matrix(matrix_len, diagonal_offset, window):
+    """Sparse matrix averaging the upper triangular entries of each insulation square."""
+    rows, cols = triu.triu_indices(matrix_len, diagonal_offset)
+    ut_len = len(rows)
+    boundaries = np.arange(window, matrix_len - window + 1)
+
+    # entry (r, c) belongs to the square of boundary b if b-window <= r < b <= c < b+window
+    agg_rows, agg_cols = [], []
+    for bi, b in enumerate(boundaries):
+        square_mask = (rows >= b - window) & (rows < b) & (cols >= b) & (cols < b + window)
+        square_index = np.nonzero(square_mask)[0]
+        agg_rows.append(np.full(len(square_index), bi))
+        agg_cols.append(square_index)
+    agg_rows = np.concatenate(agg_rows)
+    agg_cols = np.concatenate(agg_cols)
+
+    square_counts = np.bincount(agg_rows, minlength=len(boundaries))
+    agg_matrix = scipy.sparse.csr_matrix(
+        (1 / square_counts[agg_rows], (agg_rows, agg_cols)),
+        shape=(len(boundaries), ut_len),
+    )
+    return agg_matrix
+
+
+def scd(ref_preds_ut, alt_preds_ut, dense=False):
+    """
+    Compute the squared contact difference (SCD) between reference and alternate predictions.
+
+    SCD is the square root of the summed squared difference over the upper triangular
+    entries, as in published Akita scores.
+
+    Parameters:
+    - ref_preds_ut (numpy.ndarray): (M x T) or (N x M x T) reference predictions.
+    - alt_preds_ut (numpy.ndarray): Alternate predictions of the same shape.
+    - dense (bool, optional): If True, sum over both triangles of the symmetric dense
+                              matrices instead, i.e. the score computed after `ut_dense`,
+                              which is sqrt(2) times larger. Default is False.
+
+    Returns:
+    numpy.ndarray: (T,) or (N x T) SCD per sequence and target.
+    """
+    diff_ut = np.asarray(alt_preds_ut) - np.asarray(ref_preds_ut)
+    sum_sq = np.sum(np.square(diff_ut, dtype="float64"), axis=-2)
+    if dense:
+        sum_sq *= 2
+    return np.sqrt(sum_sq)
+
+
+def mse(ref_preds_ut, alt_preds_ut):
+    """
+    Compute the mean squared difference between reference and alternate predictions
+    over the upper triangular entries.
+
+    Parameters:
+    - ref_preds_ut (numpy.ndarray): (M x T) or (N x M x T) reference predictions.
+    - alt_preds_ut (numpy.ndarray): Alternate predictions of the same shape.
+
+    Returns:
+    numpy.ndarray: (T,) or (N x T) mean squared difference per sequence and target.
+    """
+    diff_ut = np.asarray(alt_preds_ut) - np.asarray(ref_preds_ut)
+    return np.mean(np.square(diff_ut, dtype="float64"), axis=-2)
+
+
+def pearsonr(ref_preds_ut, alt_preds_ut):
+    """
+    Compute the Pearson correlation between reference and alternate predictions
+    over the upper triangular entries, for each sequence and target.
+
+    Parameters:
+    - ref_preds_ut (numpy.ndarray): (M x T) or (N x M x T) reference predictions.
+    - alt_preds_ut (numpy.ndarray): Alternate predictions of the same shape.
+
+    Returns:
+    numpy.ndarray: (T,) or (N x T) correlations; NaN where either map is constant.
+    """
+    ref_ut = np.asarray(ref_preds_ut, dtype="float64")
+    alt_ut = np.asarray(alt_preds_ut, dtype="float64")
+
+    ref_ut = ref_ut - ref_ut.mean(axis=-2, keepdims=True)
+    alt_ut = alt_ut - alt_ut.mean(axis=-2, keepdims=True)
+
+    cov = np.sum(ref_ut * alt_ut, axis=-2)
+    var = np.sqrt(np.sum(np.square(ref_ut), axis=-2) * np.sum(np.square(alt_ut), axis=-2))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return cov / var
+
+
+def distance_means(preds_ut, diagonal_offset=2):
+    """
+    Average upper triangular predictions by distance to the diagonal.
+
+    Parameters:
+    - preds_ut (numpy.ndarray): (M x T) or (N x M x T) predictions, or their differences.
+    - diagonal_offset (int, optional): Number of diagonals ignored in the upper triangular
+                                       vectors. Default is 2.
+
+    Returns:
+    numpy.ndarray: (K x T) or (N x K x T) means for the K = D - diagonal_offset diagonals,
+                   ordered from diagonal_offset outwards.
+    """
+    preds_ut, singleton = _as_batch(preds_ut)
+    matrix_len = triu.triu_matrix_len(preds_ut.shape[1], diagonal_offset)
+
+    dist_means = _aggregate(_distance_matrix(matrix_len, diagonal_offset), preds_ut)
+
+    if singleton:
+        dist_means = dist_means[0]
+    return dist_means
+
+
+def insulation(preds_ut, window=10, diagonal_offset=2):
+    """
+    Compute insulation-style diagonal band summaries of upper triangular predictions.
+
+    For each boundary bin b, averages the contacts between the `window` bins upstream of b
+    and the `window` bins from b downstream, i.e. the square [b-window, b) x [b, b+window)
+    sliding along the diagonal, skipping entries within `diagonal_offset` of the diagonal.
+
+    Parameters:
+    - preds_ut (numpy.ndarray): (M x T) or (N x M x T) predictions, or their differences.
+    - window (int, optional): Square size in bins. Default is 10.
+    - diagonal_offset (int, optional): Number of diagonals ignored in the upper triangular
+                                       vectors. Default is 2.
+
+    Returns:
+    numpy.ndarray: (B x T) or (N x B x T) insulation for the B = D - 2*window + 1 boundaries
+                   from bin `window` to bin D - window.
+    """
+    preds_ut, singleton = _as_batch(preds_ut)
+    matrix_len = triu.triu_matrix_len(preds_ut.shape[1], diagonal_offset)
+    if window < 1 or 2 * window > matrix_len or window <= diagonal_offset // 2:
+        raise ValueError(
+            f"Insulation window {window} does not fit matrix length {matrix_len} "
+            f"with diagonal offset {diagonal_offset}"
+        )
+
+    ins = _aggregate(_insulation_matrix(matrix_len, diagonal_offset, window), preds_ut)
+
+    if singleton:
+        ins = ins[0]
+    return ins
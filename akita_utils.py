@@ -1,9 +1,13 @@
+import collections
+import multiprocessing
+
 import numpy as np
-import random
 import pandas as pd
 from matplotlib import pyplot as plt
 import json
-from basenji import dataset, seqnn
+from basenji import dataset, dna_io, seqnn, triu
+from basenji.dna_io import dna_1hot, dna_1hot_batch
+from basenji.genome import fetch_seq
 
 def set_diag(arr, x, i=0, copy=False):
     """
@@ -90,7 +94,7 @@ def permute_seq_k(seq_1hot, k=2):
     Parameters
     ----------
     seq_1hot : numpy.array
-        n_bases x 4 array
+        n_bases x 4 array, or n_bases uint8 index array
     k : int
         number of bases kept together in permutations.
     """
@@ -106,7 +110,7 @@ def permute_seq_k(seq_1hot, k=2):
     np.random.shuffle(perm_inds)
 
     for i in range(k):
-        seq_1hot_perm[i::k] = seq_1hot[perm_inds + i, :].copy()
+        seq_1hot_perm[i::k] = seq_1hot[perm_inds + i]
 
     return seq_1hot_perm
 
@@ -203,55 +207,98 @@ def expand_and_check_window(s, chrom_sizes_table, shift=0, seq_length=1310720):
     return chrom, up_start, down_end
 
 
-def dna_1hot(seq, seq_len=None, n_uniform=False, n_sample=False):
-    """dna_1hot
-    Args:
-      seq:       nucleotide sequence.
-      seq_len:   length to extend/trim sequences to.
-      n_uniform: represent N's as 0.25, forcing float16,
-      n_sample:  sample ACGT for N
+def expand_windows(seq_coords_df, chrom_sizes, shift=0, seq_length=1310720):
+    """
+    Vectorized version of `expand_and_check_window` and `get_relative_window_coordinates`.
+
+    Computes the expanded prediction windows and the relative permutation coordinates of all rows
+    of `seq_coords_df` at once. Rather than raising on the first window that cannot be centered,
+    it flags every row with a validity mask, so that invalid rows can be filtered out up front.
+
+    Parameters:
+    - seq_coords_df (pandas.DataFrame): DataFrame with columns 'chrom', 'start', 'end',
+                                        representing genomic coordinates of interest.
+    - chrom_sizes (DataFrame or dict): A pandas DataFrame with 'chrom' and 'size' columns, or a
+                                       dict mapping chromosome names to sizes.
+    - shift (int, optional): The number of base pairs to shift the center of the window. Default is 0.
+    - seq_length (int, optional): The desired total length of the expanded window. Default is 1310720.
+
     Returns:
-      seq_code: length by nucleotides array representation.
+    - DataFrame: Indexed like `seq_coords_df`, with columns 'chrom', 'window_start', 'window_end'
+      (genomic coordinates of the expanded window), 'permutation_start', 'permutation_end' (relative
+      coordinates of the span within the window) and 'valid' (False where the chromosome is unknown,
+      the shift excludes the span, or the window extends beyond the chromosome).
     """
-    if seq_len is None:
-        seq_len = len(seq)
-        seq_start = 0
-    else:
-        if seq_len <= len(seq):
-            # trim the sequence
-            seq_trim = (len(seq) - seq_len) // 2
-            seq = seq[seq_trim : seq_trim + seq_len]
-            seq_start = 0
-        else:
-            seq_start = (seq_len - len(seq)) // 2
+    if isinstance(chrom_sizes, pd.DataFrame):
+        chrom_sizes = dict(zip(chrom_sizes["chrom"], chrom_sizes["size"]))
 
-    seq = seq.upper()
+    chroms = seq_coords_df["chrom"].to_numpy()
+    start = seq_coords_df["start"].to_numpy(dtype="int64")
+    end = seq_coords_df["end"].to_numpy(dtype="int64")
 
-    # map nt's to a matrix len(seq)x4 of 0's and 1's.
-    if n_uniform:
-        seq_code = np.zeros((seq_len, 4), dtype="float16")
-    else:
-        seq_code = np.zeros((seq_len, 4), dtype="bool")
-
-    for i in range(seq_len):
-        if i >= seq_start and i - seq_start < len(seq):
-            nt = seq[i - seq_start]
-            if nt == "A":
-                seq_code[i, 0] = 1
-            elif nt == "C":
-                seq_code[i, 1] = 1
-            elif nt == "G":
-                seq_code[i, 2] = 1
-            elif nt == "T":
-                seq_code[i, 3] = 1
-            else:
-                if n_uniform:
-                    seq_code[i, :] = 0.25
-                elif n_sample:
-                    ni = random.randint(0, 3)
-                    seq_code[i, ni] = 1
+    # even span lengths
+    start = start - (np.abs(end - start) % 2)
+
+    span_length = np.abs(end - start)
+    up_length = (seq_length - span_length) // 2
+
+    # start and end in genomic coordinates (optionally shifted)
+    window_start = start - up_length - shift
+    window_end = end + up_length - shift
+
+    # relative start and end of the span of interest in the prediction window
+    permutation_start = up_length + 1 + shift
+    permutation_end = permutation_start + span_length
+
+    # map chromosome sizes once per unique chromosome
+    uniq_chroms, chrom_inv = np.unique(chroms.astype(str), return_inverse=True)
+    uniq_sizes = np.array([chrom_sizes.get(c, -1) for c in uniq_chroms], dtype="int64")
+    chr_size = uniq_sizes[chrom_inv.reshape(-1)]
+
+    valid = (
+        (chr_size >= 0)
+        & (shift <= up_length)
+        & (window_start >= 0)
+        & (window_end <= chr_size)
+    )
+
+    return pd.DataFrame(
+        {
+            "chrom": chroms,
+            "window_start": window_start,
+            "window_end": window_end,
+            "permutation_start": permutation_start,
+            "permutation_end": permutation_end,
+            "valid": valid,
+        },
+        index=seq_coords_df.index,
+    )
 
-    return seq_code
+
+def _check_windows(windows_df):
+    """
+    Raise for the first window of `expand_windows` output that cannot be centered.
+    """
+    if not windows_df["valid"].all():
+        w = windows_df[~windows_df["valid"]].iloc[0]
+        raise Exception(
+            "The prediction window for the following window of interest: ",
+            w.chrom,
+            w.window_start,
+            w.window_end,
+            "cannot be centered.",
+        )
+
+
+def seq_rc(seq):
+    """
+    Reverse complement a single sequence given either as a (L, 4) one-hot
+    array or as a uint8 (L,) nucleotide index array.
+    """
+    if seq.ndim == 1:
+        return dna_io.index_rc(seq)
+    else:
+        return hot1_rc(seq)
 
 
 def central_permutation_seqs_gen(
@@ -261,6 +308,7 @@ def central_permutation_seqs_gen(
     permutation_window_shift=0,
     revcomp=False,
     seq_length=1310720,
+    seq_index=False,
 ):
     """
     Generates sequences for a set of genomic coordinates, applying central permutations and optionally
@@ -282,30 +330,37 @@ def central_permutation_seqs_gen(
                                                  permutation window. Default is 0.
     - rc (bool, optional): If True, operates on reverse complement of the sequences. Default is False.
     - seq_length (int, optional): The total length of the sequence to be generated. Default is 1310720.
+    - seq_index (bool, optional): If True, yield compact uint8 nucleotide index arrays (N=4) for a
+                                  model built with `SeqNN.build_index`. Default is False.
 
     Yields:
-    numpy.ndarray: One-hot encoded DNA sequences. Each sequence is either the original or its central
-                   permutation, with or without reverse complement as specified by `rc`.
+    numpy.ndarray: One-hot encoded (or index) DNA sequences. Each sequence is either the original or
+                   its central permutation, with or without reverse complement as specified by `rc`.
 
     Raises:
     Exception: If the prediction window for a given span cannot be centered within the chromosome.
+               Windows are checked before any sequence is generated; use `expand_windows` to filter
+               invalid rows beforehand.
     """
 
-    for s in seq_coords_df.itertuples():
-        list_1hot = []
+    windows_df = expand_windows(
+        seq_coords_df,
+        chrom_sizes_table,
+        shift=permutation_window_shift,
+        seq_length=seq_length,
+    )
+    _check_windows(windows_df)
 
-        chrom, window_start, window_end = expand_and_check_window(
-            s, chrom_sizes_table, shift=permutation_window_shift
-        )
-        permutation_start, permutation_end = get_relative_window_coordinates(
-            s, shift=permutation_window_shift
-        )
+    for w in windows_df.itertuples():
+        list_1hot = []
+        chrom, window_start, window_end = w.chrom, w.window_start, w.window_end
+        permutation_start, permutation_end = w.permutation_start, w.permutation_end
 
-        wt_seq_1hot = dna_1hot(
-            genome_open.fetch(chrom, window_start, window_end).upper()
+        wt_seq_1hot = fetch_seq(
+            genome_open, chrom, window_start, window_end, seq_index=seq_index
         )
         if revcomp:
-            rc_wt_seq_1hot = hot1_rc(wt_seq_1hot)
+            rc_wt_seq_1hot = seq_rc(wt_seq_1hot)
             list_1hot.append(rc_wt_seq_1hot.copy())
         else:
             list_1hot.append(wt_seq_1hot.copy())
@@ -317,7 +372,7 @@ def central_permutation_seqs_gen(
         alt_seq_1hot[permutation_start:permutation_end] = permuted_span
 
         if revcomp:
-            rc_alt_seq_1hot = hot1_rc(alt_seq_1hot.copy())
+            rc_alt_seq_1hot = seq_rc(alt_seq_1hot)
             list_1hot.append(rc_alt_seq_1hot)
         else:
             list_1hot.append(alt_seq_1hot)
@@ -327,53 +382,235 @@ def central_permutation_seqs_gen(
             yield sequence
 
 
+def central_permutation_batch_gen(
+    seq_coords_df,
+    genome_open,
+    chrom_sizes_table,
+    batch_size=8,
+    permutation_seeds=None,
+    permutation_window_shift=0,
+    revcomp=False,
+    seq_length=1310720,
+    nproc=1,
+    seq_index=False,
+):
+    """
+    Batched version of `central_permutation_seqs_gen` that fills a reusable buffer.
+
+    Each row of `seq_coords_df` is fetched once as a compact index sequence; its reference
+    and one permuted sequence per permutation seed are then written into a preallocated
+    batch buffer, copying the reference and shuffling only the central span. Rows can be
+    fetched and permuted across a process pool, which requires a picklable genome handler
+    such as `basenji.genome.GenomeStore`.
+
+    Parameters:
+    - seq_coords_df (pandas.DataFrame): DataFrame with columns 'chrom', 'start', 'end', 'strand',
+                                        representing genomic coordinates of interest.
+    - genome_open (GenomeFileHandler): A file handler for the genome to fetch sequences.
+    - chrom_sizes_table (pandas.DataFrame): DataFrame with columns 'chrom' and 'size', representing
+                                            the sizes of chromosomes in the genome.
+    - batch_size (int, optional): Number of rows per yielded batch. Default is 8.
+    - permutation_seeds (list, optional): Seeds for the permutations of each row, one permuted
+                                          sequence per seed. Default None draws a single permutation
+                                          per row from numpy's global random state, in the calling
+                                          process, so results do not depend on `nproc`.
+    - permutation_window_shift (int, optional): The number of base pairs to shift the center of the
+                                                 permutation window. Default is 0.
+    - revcomp (bool, optional): If True, operates on reverse complement of the sequences. Default is False.
+    - seq_length (int, optional): The total length of the sequence to be generated. Default is 1310720.
+    - nproc (int, optional): Number of processes fetching and permuting rows. At most two batches
+                             of rows are in flight at once. Default is 1.
+    - seq_index (bool, optional): If True, yield uint8 nucleotide index arrays. Default is False.
+
+    Yields:
+    numpy.ndarray: Array of shape ((1 + S) * n, seq_length, 4) for n rows and S permutation seeds
+                   (S=1 by default), holding for each row its reference followed by its permuted
+                   sequences. The buffer is overwritten by the next batch, so consume or copy it first.
+
+    Raises:
+    Exception: If the prediction window for a given span cannot be centered within the chromosome.
+               Windows are checked before any sequence is generated; use `expand_windows` to filter
+               invalid rows beforehand.
+    """
+    num_perms = 1 if permutation_seeds is None else len(permutation_seeds)
+    seqs_per_row = 1 + num_perms
+
+    # plan windows
+    windows_df = expand_windows(
+        seq_coords_df,
+        chrom_sizes_table,
+        shift=permutation_window_shift,
+        seq_length=seq_length,
+    )
+    _check_windows(windows_df)
+
+    def row_tasks():
+        for w in windows_df.itertuples():
+            span_length = w.permutation_end - w.permutation_start
+            if permutation_seeds is None:
+                # drawn here, not in workers that share a forked random state
+                row_perms = [np.random.permutation(span_length)]
+            else:
+                row_perms = None
+            yield (genome_open, w.chrom, w.window_start, w.window_end,
+                   span_length, permutation_seeds, row_perms)
+
+    # preallocate buffer
+    if seq_index:
+        seqs_batch = np.zeros((batch_size * seqs_per_row, seq_length), dtype="uint8")
+    else:
+        seqs_batch = np.zeros((batch_size * seqs_per_row, seq_length, 4), dtype="bool")
+
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        row_results = _bounded_imap(
+            pool, _central_permutation_row, row_tasks(), 2 * max(batch_size, nproc)
+        )
+    else:
+        pool = None
+        row_results = map(_central_permutation_row, row_tasks())
+
+    try:
+        bi = 0
+        for w, (ref_index, perms) in zip(windows_df.itertuples(), row_results):
+            permutation_start, permutation_end = w.permutation_start, w.permutation_end
+            span_length = permutation_end - permutation_start
+
+            if revcomp:
+                ref_index = dna_io.index_rc(ref_index)
+                permutation_start, permutation_end = (
+                    seq_length - permutation_end,
+                    seq_length - permutation_start,
+                )
+                # the reversed span is permuted by the mirrored order
+                perms = [span_length - 1 - perm[::-1] for perm in perms]
+
+            # reference
+            ref_i = bi * seqs_per_row
+            if seq_index:
+                seqs_batch[ref_i] = ref_index
+            else:
+                dna_io.index_1hot(ref_index, out=seqs_batch[ref_i])
+            ref_span = seqs_batch[ref_i, permutation_start:permutation_end].copy()
+
+            # permutations
+            for pi, perm in enumerate(perms):
+                alt_i = ref_i + 1 + pi
+                seqs_batch[alt_i] = seqs_batch[ref_i]
+                seqs_batch[alt_i, permutation_start:permutation_end] = ref_span[perm]
+
+            bi += 1
+            if bi == batch_size:
+                yield seqs_batch
+                bi = 0
+
+        if bi > 0:
+            yield seqs_batch[: bi * seqs_per_row]
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _bounded_imap(pool, func, tasks, max_pending):
+    """
+    Ordered `pool.imap` that keeps at most `max_pending` tasks in flight, so that
+    results cannot pile up ahead of a slow consumer.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) == max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def _central_permutation_row(task):
+    """
+    Fetch one window as a uint8 index sequence and draw its central span permutations,
+    unless they were drawn by the caller. Module level so that
+    `central_permutation_batch_gen` can map it across processes.
+    """
+    (genome_open, chrom, window_start, window_end,
+     span_length, permutation_seeds, perms) = task
+
+    ref_index = fetch_seq(genome_open, chrom, window_start, window_end, seq_index=True)
+
+    if perms is None:
+        perms = []
+        for seed in permutation_seeds:
+            perm = np.arange(span_length)
+            np.random.RandomState(seed).shuffle(perm)
+            perms.append(perm)
+
+    return ref_index, perms
+
+
 def ut_dense(preds_ut, diagonal_offset=2):
     """Construct symmetric dense prediction matrices from upper triangular vectors.
 
     Parameters
     -----------
-    preds_ut : ( M x O) numpy array
+    preds_ut : ( M x O) or (N x M x O) numpy array
         Upper triangular matrix to convert. M is the number of upper triangular entries,
-        and O corresponds to the number of different targets.
+        and O corresponds to the number of different targets. A batch of N predictions
+        is expanded in a single scatter.
     diagonal_offset : int
         Number of diagonals that are added as zeros in the conversion.
         Typically 2 diagonals are ignored in Hi-C data processing.
 
     Returns
     --------
-    preds_dense : (D x D x O) numpy array
+    preds_dense : (D x D x O) or (N x D x D x O) numpy array
         Each output upper-triangular vector is converted to a symmetric D x D matrix.
         Output matrices have zeros at the diagonal for `diagonal_offset` number of diagonals.
 
     """
-    ut_len, num_targets = preds_ut.shape
+    singleton = preds_ut.ndim == 2
+    if singleton:
+        preds_ut = preds_ut[np.newaxis]
+    num_seqs, ut_len, num_targets = preds_ut.shape
 
     # infer original sequence length
-    seq_len = int(np.sqrt(2 * ut_len + 0.25) - 0.5)
-    seq_len += diagonal_offset
+    seq_len = triu.triu_matrix_len(ut_len, diagonal_offset)
 
-    # get triu indexes
-    ut_indexes = np.triu_indices(seq_len, diagonal_offset)
-    assert len(ut_indexes[0]) == ut_len
+    # gather symmetric dense matrices, with zeros near the diagonal
+    preds_ut_pad = np.zeros((num_seqs, ut_len + 1, num_targets), dtype=preds_ut.dtype)
+    preds_ut_pad[:, :ut_len] = preds_ut
+    preds_dense = np.take(preds_ut_pad, triu.triu_dense_index(seq_len, diagonal_offset), axis=1)
+    preds_dense = preds_dense.reshape((num_seqs, seq_len, seq_len, num_targets))
 
-    # assign to dense matrix
-    preds_dense = np.zeros(shape=(seq_len, seq_len, num_targets), dtype=preds_ut.dtype)
-    preds_dense[ut_indexes] = preds_ut
+    if diagonal_offset == 0:
+        # symmetrizing by addition doubles the main diagonal
+        diag = np.arange(seq_len)
+        preds_dense[:, diag, diag] *= 2
 
-    # symmetrize
-    preds_dense += np.transpose(preds_dense, axes=[1, 0, 2])
+    if singleton:
+        preds_dense = preds_dense[0]
 
     return preds_dense
 
 def from_upper_triu(vector_repr, matrix_len, num_diags):
         z = np.zeros((matrix_len,matrix_len))
-        triu_tup = np.triu_indices(matrix_len,num_diags)
+        triu_tup = triu.triu_indices(matrix_len,num_diags)
         z[triu_tup] = vector_repr
         for i in range(-num_diags+1,num_diags):
             set_diag(z, np.nan, i)
         return z + z.T
 
-def get_data(data_dir, split_label='train'):
+def get_data(data_dir, split_label='train', sample_indices=None):
+    """
+    Load a split's inputs and targets as numpy arrays.
+
+    Parameters:
+    - data_dir (str): Data directory with statistics.json and tfrecords/.
+    - split_label (str): Split, e.g. train, valid or test.
+    - sample_indices (list, optional): Record indices to decode, in order. All records when None.
+
+    Returns:
+    - tuple: Inputs, targets, diagonal offset and cropped map length.
+    """
     # read data parameters
     data_stats_file = '%s/statistics.json' % data_dir
     with open(data_stats_file) as data_stats_open:
@@ -383,8 +620,12 @@ def get_data(data_dir, split_label='train'):
     target_length1 = data_stats['seq_length'] // data_stats['pool_width']
     target_length1_cropped = target_length1 - 2*target_crop
 
-    data = dataset.SeqDataset(data_dir, split_label, batch_size=8)
-    inputs, targets = data.numpy(return_inputs=True, return_outputs=True)
+    data = dataset.SeqDataset(data_dir, split_label, batch_size=8,
+                              record_index=(sample_indices is not None))
+    if sample_indices is None:
+        inputs, targets = data.numpy(return_inputs=True, return_outputs=True)
+    else:
+        inputs, targets = data.take(sample_indices, return_inputs=True, return_outputs=True)
 
     return inputs, targets, hic_diags, target_length1_cropped
 
@@ -392,7 +633,7 @@ def show_targets(data_dir, split_label='train', sample_indices=[0,1,2], plot_par
                                                                                      'num_cols': 3,
                                                                                      'vmin':-2,
                                                                                      'vmax':2}):
-    inputs, targets, hic_diags, target_length1_cropped = get_data(data_dir, split_label)
+    inputs, targets, hic_diags, target_length1_cropped = get_data(data_dir, split_label, sample_indices)
 
     # plot target 
     vmin = plot_params['vmin']
@@ -406,7 +647,7 @@ def show_targets(data_dir, split_label='train', sample_indices=[0,1,2], plot_par
     fig = plt.figure(figsize=figsize)
     for i, sample_index in enumerate(sample_indices):
         ax = fig.add_subplot(num_rows, num_cols, i+1)
-        mat = from_upper_triu(targets[sample_index:sample_index+1,:,:][:,:,0], target_length1_cropped, hic_diags)
+        mat = from_upper_triu(targets[i:i+1,:,:][:,:,0], target_length1_cropped, hic_diags)
         im = ax.matshow(mat, cmap='RdBu_r', vmax=vmax, vmin=vmin)
         fig.colorbar(im, ax=ax, fraction=.04, pad=0.05)
         ax.set_title(f'target{sample_index+1}')
@@ -439,7 +680,8 @@ def show_predictions(predictions, hic_diags, target_length1_cropped, plot_params
     plt.tight_layout()
 
 
-def symmertic_insertion_seqs_gen(seq_coords_df, background_seqs, genome_open, nproc=1, map=map):
+def symmertic_insertion_seqs_gen(seq_coords_df, background_seqs, genome_open, nproc=1, map=map,
+                                 seq_index=False):
     """
     Generate sequences with symmetric insertions for a given set of coordinates.
 
@@ -454,34 +696,166 @@ def symmertic_insertion_seqs_gen(seq_coords_df, background_seqs, genome_open, np
                                          Represents genomic coordinates and insertion parameters.
     - background_seqs (List[numpy.ndarray]): List of background sequences to be modified.
     - genome_open (GenomeFileHandler): A file handler for the genome to fetch sequences.
+    - seq_index (bool, optional): If True, background sequences are uint8 nucleotide index
+                                  arrays and index sequences are yielded. Default is False.
 
     Yields:
-    numpy.ndarray: One-hot encoded DNA sequence with symmetric insertions.
+    numpy.ndarray: One-hot encoded (or index) DNA sequence with symmetric insertions.
     """
-    
+
     for s in seq_coords_df.itertuples():
 
         flank_bp = s.flank_bp
         spacer_bp = s.spacer_bp
         orientation_string = s.orientation
 
-        seq_1hot_insertion = dna_1hot(
-            genome_open.fetch(
-                s.chrom, s.start - flank_bp, s.end + flank_bp
-            ).upper()
+        seq_1hot_insertion = fetch_seq(
+            genome_open, s.chrom, s.start - flank_bp, s.end + flank_bp,
+            seq_index=seq_index
         )
 
         if s.strand == "-":
-            seq_1hot_insertion = hot1_rc(seq_1hot_insertion)
+            seq_1hot_insertion = seq_rc(seq_1hot_insertion)
             # now, all motifs are standarized to this orientation ">"
 
-        seq_1hot = background_seqs[s.background_index].copy()
-
         seq_1hot = _insert_casette(
-            seq_1hot, seq_1hot_insertion, spacer_bp, orientation_string
+            background_seqs[s.background_index],
+            seq_1hot_insertion,
+            spacer_bp,
+            orientation_string,
         )
 
-        yield seq_1hot    
+        yield seq_1hot
+
+
+def symmetric_insertion_batch_gen(
+    seq_coords_df, background_seqs, genome_open, batch_size=8, seq_index=False
+):
+    """
+    Batched version of `symmertic_insertion_seqs_gen` writing casettes into a reusable buffer.
+
+    Rows are grouped by 'background_index', so each background only needs to be predicted
+    once and every buffer slot only restores the region dirtied by its previous casette
+    instead of copying the whole background again. Inserts are fetched, encoded and
+    reverse complemented once per (chrom, start, end, flank_bp, strand) and reused across
+    the spacing and orientation grid.
+
+    Parameters:
+    - seq_coords_df (pandas.DataFrame): DataFrame with columns 'chrom', 'start', 'end',
+                                         'strand', 'flank_bp', 'spacer_bp', 'orientation',
+                                         'background_index'.
+    - background_seqs (List[numpy.ndarray]): List of background sequences to be modified.
+    - genome_open (GenomeFileHandler): A file handler for the genome to fetch sequences.
+    - batch_size (int, optional): Number of sequences per yielded batch. Default is 8.
+    - seq_index (bool, optional): If True, background sequences are uint8 nucleotide index
+                                  arrays and index sequences are yielded. Default is False.
+
+    Yields:
+    tuple: (rows, seqs_batch), where rows is the `seq_coords_df` index of the rows in the batch,
+           in background-grouped order, and seqs_batch is an array of the corresponding
+           sequences with symmetric insertions. The buffer is overwritten by the next batch,
+           so consume or copy it first.
+
+    Raises:
+    ValueError: If an 'orientation' is not a non-empty string of '>' and '<'. All rows are
+                checked before any batch is generated.
+    """
+    _check_orientations(seq_coords_df["orientation"].unique())
+
+    background_0 = background_seqs[0]
+    seqs_batch = np.zeros((batch_size,) + background_0.shape, dtype=background_0.dtype)
+    seq_length = background_0.shape[0]
+
+    # per slot: background index and dirty region
+    slot_backgrounds = [None] * batch_size
+    slot_dirty = [(0, 0)] * batch_size
+
+    insert_cache = {}
+
+    # group rows sharing a background
+    row_order = np.argsort(seq_coords_df["background_index"].to_numpy(), kind="stable")
+    seq_coords_sorted = seq_coords_df.iloc[row_order]
+
+    rows = []
+    bi = 0
+    for s in seq_coords_sorted.itertuples():
+        # fetch and orient insert once
+        insert_key = (s.chrom, s.start, s.end, s.flank_bp, s.strand)
+        if insert_key not in insert_cache:
+            insert_fwd = fetch_seq(
+                genome_open, s.chrom, s.start - s.flank_bp, s.end + s.flank_bp,
+                seq_index=seq_index
+            )
+            if s.strand == "-":
+                insert_fwd = seq_rc(insert_fwd)
+            insert_cache[insert_key] = (insert_fwd, seq_rc(insert_fwd))
+        insert_fwd, insert_rc = insert_cache[insert_key]
+
+        # restore background
+        background = background_seqs[s.background_index]
+        if slot_backgrounds[bi] == s.background_index:
+            dirty_start, dirty_end = slot_dirty[bi]
+            seqs_batch[bi, dirty_start:dirty_end] = background[dirty_start:dirty_end]
+        else:
+            seqs_batch[bi] = background
+            slot_backgrounds[bi] = s.background_index
+
+        # write casette
+        insert_bp = len(insert_fwd)
+        offsets = _casette_offsets(
+            seq_length, insert_bp, s.spacer_bp, len(s.orientation)
+        )
+        for offset, orientation_arrow in zip(offsets, s.orientation):
+            if orientation_arrow == ">":
+                seqs_batch[bi, offset : offset + insert_bp] = insert_fwd
+            else:
+                seqs_batch[bi, offset : offset + insert_bp] = insert_rc
+        slot_dirty[bi] = (offsets[0], offsets[-1] + insert_bp)
+
+        rows.append(s.Index)
+        bi += 1
+        if bi == batch_size:
+            yield rows, seqs_batch
+            rows = []
+            bi = 0
+
+    if bi > 0:
+        yield rows, seqs_batch[:bi]
+
+
+def _check_orientations(orientations):
+    """
+    Raise a ValueError unless each orientation is a non-empty string of '>' and '<'.
+    """
+    for orientation_string in orientations:
+        if (
+            not isinstance(orientation_string, str)
+            or len(orientation_string) == 0
+            or set(orientation_string) - set("<>")
+        ):
+            raise ValueError(
+                f"orientation = {orientation_string!r}. Expected a non-empty string of '>' and '<'."
+            )
+
+
+def _casette_offsets(seq_length, insert_bp, spacer_bp, num_inserts):
+    """
+    Start positions of `num_inserts` inserts, separated by spacers and centered in the sequence.
+    """
+    insert_plus_spacer_bp = insert_bp + 2 * spacer_bp
+    multi_insert_bp = num_inserts * insert_plus_spacer_bp
+    insert_start_bp = seq_length // 2 - multi_insert_bp // 2
+
+    insertion_starting_positions = []
+    for i in range(num_inserts):
+        offset = insert_start_bp + i * insert_plus_spacer_bp + spacer_bp
+        insertion_starting_positions.append(offset)
+
+        assert (
+            offset >= 0 and offset < seq_length - insert_bp
+        ), f"offset = {offset}. Please, check length of insert and inter-insert spacing."
+
+    return insertion_starting_positions
 
 
 def _insert_casette(
@@ -497,8 +871,8 @@ def _insert_casette(
     based on the specified orientations and returns the modified sequence.
 
     Parameters:
-    - seq_1hot (numpy.ndarray): One-hot encoded DNA sequence to be modified.
-    - seq_1hot_insertion (numpy.ndarray): One-hot encoded DNA sequence to be inserted.
+    - seq_1hot (numpy.ndarray): One-hot encoded (or index) DNA sequence to be modified.
+    - seq_1hot_insertion (numpy.ndarray): One-hot encoded (or index) DNA sequence to be inserted.
     - spacer_bp (int): Number of base pairs for intert-insert spacers.
     - orientation_string (str): String specifying the orientation and number of insertions.
                                '>' denotes forward orientation, and '<' denotes reverse.
@@ -507,87 +881,27 @@ def _insert_casette(
     numpy.ndarray: One-hot encoded DNA sequence with the casette insertion.
 
     Raises:
+    ValueError: If `orientation_string` is not a non-empty string of '>' and '<'.
     AssertionError: If the insertion offset is outside the valid range or if the length
                     of the insert and inter-insert spacing leads to an invalid offset.
     """
+    _check_orientations([orientation_string])
+
     seq_length = seq_1hot.shape[0]
     insert_bp = len(seq_1hot_insertion)
     num_inserts = len(orientation_string)
 
-    insert_plus_spacer_bp = insert_bp + 2 * spacer_bp
-    multi_insert_bp = num_inserts * insert_plus_spacer_bp
-    insert_start_bp = seq_length // 2 - multi_insert_bp // 2
+    offsets = _casette_offsets(seq_length, insert_bp, spacer_bp, num_inserts)
+    seq_1hot_insertion_rc = seq_rc(seq_1hot_insertion)
 
     output_seq = seq_1hot.copy()
-    insertion_starting_positions = []
-    for i in range(num_inserts):
-        offset = insert_start_bp + i * insert_plus_spacer_bp + spacer_bp
-        insertion_starting_positions.append(offset)
-
-        assert (
-            offset >= 0 and offset < seq_length - insert_bp
-        ), f"offset = {offset}. Please, check length of insert and inter-insert spacing."
-
-        for orientation_arrow in orientation_string[i]:
-            if orientation_arrow == ">":
-                output_seq[offset : offset + insert_bp] = seq_1hot_insertion
-            else:
-                output_seq[offset : offset + insert_bp] = hot1_rc(
-                    seq_1hot_insertion
-                )
-
-    return output_seq
-
-
-def dna_1hot(seq, seq_len=None, n_uniform=False, n_sample=False):
-    """dna_1hot
-    Args:
-      seq:       nucleotide sequence.
-      seq_len:   length to extend/trim sequences to.
-      n_uniform: represent N's as 0.25, forcing float16,
-      n_sample:  sample ACGT for N
-    Returns:
-      seq_code: length by nucleotides array representation.
-    """
-    if seq_len is None:
-        seq_len = len(seq)
-        seq_start = 0
-    else:
-        if seq_len <= len(seq):
-            # trim the sequence
-            seq_trim = (len(seq) - seq_len) // 2
-            seq = seq[seq_trim : seq_trim + seq_len]
-            seq_start = 0
+    for offset, orientation_arrow in zip(offsets, orientation_string):
+        if orientation_arrow == ">":
+            output_seq[offset : offset + insert_bp] = seq_1hot_insertion
         else:
-            seq_start = (seq_len - len(seq)) // 2
+            output_seq[offset : offset + insert_bp] = seq_1hot_insertion_rc
 
-    seq = seq.upper()
-
-    # map nt's to a matrix len(seq)x4 of 0's and 1's.
-    if n_uniform:
-        seq_code = np.zeros((seq_len, 4), dtype="float16")
-    else:
-        seq_code = np.zeros((seq_len, 4), dtype="bool")
-
-    for i in range(seq_len):
-        if i >= seq_start and i - seq_start < len(seq):
-            nt = seq[i - seq_start]
-            if nt == "A":
-                seq_code[i, 0] = 1
-            elif nt == "C":
-                seq_code[i, 1] = 1
-            elif nt == "G":
-                seq_code[i, 2] = 1
-            elif nt == "T":
-                seq_code[i, 3] = 1
-            else:
-                if n_uniform:
-                    seq_code[i, :] = 0.25
-                elif n_sample:
-                    ni = random.randint(0, 3)
-                    seq_code[i, ni] = 1
-
-    return seq_code
+    return output_seq
 
 
 def hot1_rc(seqs_1hot):
@@ -25,6 +25,7 @@ import pandas as pd
 import pysam
 
 from basenji import dna_io
+from basenji import genome
 
 ################################################################################
 # bed.py
@@ -32,11 +33,13 @@ from basenji import dna_io
 # Methods to work with BED files.
 ################################################################################
 
-def make_bed_seqs(bed_file, fasta_file, seq_len, stranded=False):
+def make_bed_seqs(bed_file, fasta_file, seq_len, stranded=False, seq_1hot=False):
   """Return BED regions as sequences and regions as a list of coordinate
-  tuples, extended to a specified length."""
+  tuples, extended to a specified length. With seq_1hot, sequences are
+  (L,4) one hot arrays from genome.fetch_seq, which a genome store
+  decodes without building strings."""
   """Extract and extend BED sequences to seq_len."""
-  fasta_open = pysam.Fastafile(fasta_file)
+  fasta_open = genome.open_genome(fasta_file)
 
   seqs_dna = []
   seqs_coords = []
@@ -62,6 +65,14 @@ def make_bed_seqs(bed_file, fasta_file, seq_len, stranded=False):
     else:
       seqs_coords.append((chrm,seq_start,seq_end))
 
+    if seq_1hot:
+      # fetch encoded, with N's for over reach
+      seq_code = genome.fetch_seq(fasta_open, chrm, seq_start, seq_end)
+      if stranded and strand == '-':
+        seq_code = dna_io.hot1_rc(seq_code)
+      seqs_dna.append(seq_code)
+      continue
+
     # initialize sequence
     seq_dna = ''
 
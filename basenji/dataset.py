@@ -15,26 +15,466 @@
 from __future__ import print_function
 import glob
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import pdb
+import struct
 import sys
+import zlib
 
 from natsort import natsorted
 import numpy as np
 import tensorflow as tf
 
+from basenji import dna_io
+
 # TFRecord constants
 TFR_INPUT = 'sequence'
 TFR_OUTPUT = 'target'
+TFR_HEADER_BYTES = 12 # uint64 length, uint32 masked crc32c
+TFR_FOOTER_BYTES = 4  # uint32 masked crc32c of data
 
 def file_to_records(filename):
   return tf.data.TFRecordDataset(filename, compression_type='ZLIB')
 
+@tf.function(input_signature=[tf.TensorSpec([None], tf.string), tf.TensorSpec([], tf.int32)])
+def tfr_batch_stats(example_protos, target_length):
+  """Count a batch of serialized examples and their targets with any
+     nonzero value, decoding targets only."""
+  features = {TFR_OUTPUT: tf.io.FixedLenFeature([], tf.string)}
+  parsed_features = tf.io.parse_example(example_protos, features=features)
+  targets = tf.io.decode_raw(parsed_features[TFR_OUTPUT], tf.float16)
+  targets = tf.reshape(targets, [tf.shape(targets)[0], target_length, -1])
+  return tf.shape(targets)[0], tf.reduce_any(tf.not_equal(targets, 0), axis=[0,1])
+
+
+def tfr_stats(tfr_file, target_length, batch_size=256):
+  """Count a TFRecord file's sequences and its targets with any nonzero
+     value, parsing batches of records with tfr_batch_stats."""
+  num_seqs = 0
+  targets_nonzero = None
+  for example_protos in file_to_records(tfr_file).batch(batch_size):
+    batch_seqs, batch_nonzero = tfr_batch_stats(example_protos, target_length)
+    num_seqs += int(batch_seqs)
+    if targets_nonzero is None:
+      targets_nonzero = batch_nonzero.numpy()
+    else:
+      targets_nonzero |= batch_nonzero.numpy()
+
+  if targets_nonzero is None:
+    targets_nonzero = np.zeros(0, dtype='bool')
+  return {'num_seqs': num_seqs, 'targets_nonzero': targets_nonzero.tolist()}
+
+
+def tfr_stats_file(tfr_file):
+  """Hidden sidecar file caching tfr_stats, which TFRecord globs skip."""
+  tfr_dir, tfr_name = os.path.split(tfr_file)
+  return os.path.join(tfr_dir, '.%s.stats.json' % tfr_name)
+
+
+def tfr_stats_cached(tfr_file, target_length):
+  """Return tfr_stats, reusing the sidecar cache when the file's size
+     and mtime are unchanged and refreshing it otherwise."""
+  tfr_stat = os.stat(tfr_file)
+  file_key = {'size': tfr_stat.st_size, 'mtime_ns': tfr_stat.st_mtime_ns,
+              'target_length': target_length}
+
+  stats_file = tfr_stats_file(tfr_file)
+  try:
+    with open(stats_file) as stats_open:
+      stats = json.load(stats_open)
+    if all(stats.get(key) == value for key, value in file_key.items()):
+      return stats
+  except (OSError, ValueError):
+    pass
+
+  stats = tfr_stats(tfr_file, target_length)
+  stats.update(file_key)
+  write_sidecar(stats_file, stats)
+
+  return stats
+
+
+def write_sidecar(json_file, data):
+  """Write a JSON sidecar cache atomically, skipping read-only
+     data directories."""
+  try:
+    json_tmp = '%s.%d' % (json_file, os.getpid())
+    with open(json_tmp, 'w') as json_open:
+      json.dump(data, json_open)
+    os.replace(json_tmp, json_file)
+  except OSError:
+    pass
+
+
+def balance_shards(file_lens, num_shards):
+  """Assign files to shards, largest first to the shard with the fewest
+     records, so shard record counts balance. Returns each shard's
+     sorted file indexes."""
+  shard_files = [[] for _ in range(num_shards)]
+  shard_lens = np.zeros(num_shards, dtype='int64')
+  for fi in sorted(range(len(file_lens)), key=lambda fi: (-file_lens[fi], fi)):
+    si = int(np.argmin(shard_lens))
+    shard_files[si].append(fi)
+    shard_lens[si] += file_lens[fi]
+  return [sorted(files) for files in shard_files]
+
+
+class TFRecordStream:
+  """Read the uncompressed record stream of a TFRecord file.
+
+  Uncompressed files seek directly. A ZLIB file is a single deflate
+  stream, which cannot be entered mid-way, so seeking only moves forward
+  by inflating and discarding the bytes in between; seeking backward
+  reopens the file.
+  """
+  def __init__(self, tfr_file, compression_type='ZLIB', chunk_size=1<<20):
+    if compression_type not in ['ZLIB', '']:
+      raise ValueError('Unsupported TFRecord compression %s' % compression_type)
+    self.tfr_file = tfr_file
+    self.compression_type = compression_type
+    self.chunk_size = chunk_size
+    self.file_open = None
+    self.reopen()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.file_open is not None:
+      self.file_open.close()
+      self.file_open = None
+
+  def reopen(self):
+    self.close()
+    self.file_open = open(self.tfr_file, 'rb')
+    self.position = 0
+    if self.compression_type == 'ZLIB':
+      self.decompressor = zlib.decompressobj()
+      self.buffer = bytearray()
+
+  def fill(self, n):
+    """Inflate until the buffer holds n bytes or the file ends."""
+    while len(self.buffer) < n and not self.decompressor.eof:
+      chunk = self.file_open.read(self.chunk_size)
+      if chunk:
+        self.buffer += self.decompressor.decompress(chunk)
+      else:
+        self.buffer += self.decompressor.flush()
+        break
+
+  def read(self, n):
+    if self.compression_type == '':
+      data = self.file_open.read(n)
+    else:
+      self.fill(n)
+      data = bytes(self.buffer[:n])
+      del self.buffer[:n]
+    self.position += len(data)
+    return data
+
+  def seek(self, offset):
+    if self.compression_type == '':
+      self.file_open.seek(offset)
+      self.position = offset
+    else:
+      if offset < self.position:
+        self.reopen()
+      while self.position < offset:
+        skip_len = min(offset - self.position, self.chunk_size)
+        if len(self.read(skip_len)) < skip_len:
+          raise ValueError('%s ends before offset %d' % (self.tfr_file, offset))
+
+  def read_record(self, length=None):
+    """Read the record at the current position, checking its framing
+       and, if given, its length. Returns None at the end of the file."""
+    header = self.read(TFR_HEADER_BYTES)
+    if len(header) == 0:
+      return None
+    if len(header) < TFR_HEADER_BYTES:
+      raise ValueError('%s has a truncated record header' % self.tfr_file)
+    record_len = struct.unpack('<Q', header[:8])[0]
+    if length is not None and record_len != length:
+      raise ValueError('%s record at %d has length %d, index expected %d' % \
+                       (self.tfr_file, self.position - TFR_HEADER_BYTES, record_len, length))
+    record = self.read(record_len + TFR_FOOTER_BYTES)
+    if len(record) < record_len + TFR_FOOTER_BYTES:
+      raise ValueError('%s has a truncated record' % self.tfr_file)
+    return record[:record_len]
+
+
+def tfr_record_index(tfr_file, compression_type='ZLIB'):
+  """Scan a TFRecord file's framing for each record's offset in the
+     uncompressed stream and its data length."""
+  offsets = []
+  lengths = []
+  with TFRecordStream(tfr_file, compression_type) as stream:
+    while True:
+      offset = stream.position
+      header = stream.read(TFR_HEADER_BYTES)
+      if len(header) == 0:
+        break
+      if len(header) < TFR_HEADER_BYTES:
+        raise ValueError('%s has a truncated record header' % tfr_file)
+      record_len = struct.unpack('<Q', header[:8])[0]
+      stream.seek(stream.position + record_len + TFR_FOOTER_BYTES)
+      offsets.append(offset)
+      lengths.append(record_len)
+  return {'offsets': offsets, 'lengths': lengths}
+
+
+def tfr_index_file(tfr_file):
+  """Hidden sidecar file caching tfr_record_index."""
+  tfr_dir, tfr_name = os.path.split(tfr_file)
+  return os.path.join(tfr_dir, '.%s.index.json' % tfr_name)
+
+
+def tfr_index_cached(tfr_file, compression_type='ZLIB'):
+  """Return tfr_record_index, reusing the sidecar cache when the file's
+     size and mtime are unchanged and refreshing it otherwise."""
+  tfr_stat = os.stat(tfr_file)
+  file_key = {'size': tfr_stat.st_size, 'mtime_ns': tfr_stat.st_mtime_ns,
+              'compression_type': compression_type}
+
+  index_file = tfr_index_file(tfr_file)
+  try:
+    with open(index_file) as index_open:
+      record_index = json.load(index_open)
+    if all(record_index.get(key) == value for key, value in file_key.items()):
+      return record_index
+  except (OSError, ValueError):
+    pass
+
+  record_index = tfr_record_index(tfr_file, compression_type)
+  record_index.update(file_key)
+  write_sidecar(index_file, record_index)
+
+  return record_index
+
+
+class RecordIndex:
+  """Map a split's record indexes to (file, offset, length) across its
+     TFRecord files, reading records without parsing the others."""
+  def __init__(self, tfr_files, compression_type='ZLIB', num_threads=None):
+    self.tfr_files = list(tfr_files)
+    self.compression_type = compression_type
+    if num_threads is None:
+      num_threads = min(len(self.tfr_files), os.cpu_count() or 1)
+
+    def file_index(tfr_file):
+      return tfr_index_cached(tfr_file, compression_type)
+
+    if num_threads > 1:
+      with ThreadPool(num_threads) as pool:
+        files_index = pool.map(file_index, self.tfr_files)
+    else:
+      files_index = [file_index(tfr_file) for tfr_file in self.tfr_files]
+
+    file_lens = [len(fi['offsets']) for fi in files_index]
+    self.file_starts = np.cumsum([0] + file_lens)
+    self.offsets = np.zeros(self.file_starts[-1], dtype='int64')
+    self.lengths = np.zeros(self.file_starts[-1], dtype='int64')
+    for fi, file_index in enumerate(files_index):
+      file_slice = slice(self.file_starts[fi], self.file_starts[fi+1])
+      self.offsets[file_slice] = file_index['offsets']
+      self.lengths[file_slice] = file_index['lengths']
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def locate(self, index):
+    """Return record index's file, offset and length."""
+    fi = np.searchsorted(self.file_starts, index, side='right') - 1
+    return self.tfr_files[fi], int(self.offsets[index]), int(self.lengths[index])
+
+  def read(self, indexes):
+    """Yield the serialized records at indexes, in the given order.
+
+    Each distinct record is read once, in sorted order, because ZLIB
+    files only seek forward cheaply. Records read ahead of their turn
+    are held until yielded, so a shuffled order can hold up to all the
+    requested records in memory, while a sorted order holds none.
+    """
+    indexes = np.asarray(indexes, dtype='int64').reshape(-1)
+    out_of_range = (indexes < 0) | (indexes >= len(self))
+    if np.any(out_of_range):
+      raise IndexError('Record %d out of range for %d records' % \
+                       (indexes[out_of_range][0], len(self)))
+
+    # last position of each record, to release it
+    last_positions = {int(index): pos for pos, index in enumerate(indexes)}
+
+    held_records = {}
+    sorted_records = self.read_sorted(np.unique(indexes))
+    try:
+      for pos, index in enumerate(indexes):
+        index = int(index)
+        while index not in held_records:
+          read_index, record = next(sorted_records)
+          held_records[read_index] = record
+        if last_positions[index] == pos:
+          yield held_records.pop(index)
+        else:
+          yield held_records[index]
+    finally:
+      sorted_records.close()
+
+  def read_sorted(self, indexes):
+    """Yield (index, serialized record) for sorted, in range indexes."""
+    stream = None
+    try:
+      for index in indexes:
+        index = int(index)
+        tfr_file, offset, length = self.locate(index)
+        if stream is None or stream.tfr_file != tfr_file:
+          if stream is not None:
+            stream.close()
+          stream = TFRecordStream(tfr_file, self.compression_type)
+        stream.seek(offset)
+        yield index, stream.read_record(length)
+    finally:
+      if stream is not None:
+        stream.close()
+
+
+def seq_1hot_index(seq_1hot):
+  """Convert (L,4+) one hot coding to a uint8 (L,) index, N=4."""
+  seq_1hot = seq_1hot[...,:4]
+  seq_index = tf.argmax(seq_1hot, axis=-1, output_type=tf.int32)
+  seq_n = tf.not_equal(tf.reduce_sum(tf.cast(seq_1hot, tf.int32), axis=-1), 1)
+  seq_index = tf.where(seq_n, 4, seq_index)
+  return tf.cast(seq_index, tf.uint8)
+
+
+def mmap_files(mmap_dir, split_label):
+  """Return the index, sequences and targets files of a split's
+     memory-mapped cache."""
+  return ('%s/%s.json' % (mmap_dir, split_label),
+          '%s/%s-seqs.bin' % (mmap_dir, split_label),
+          '%s/%s-targets.bin' % (mmap_dir, split_label))
+
+
+def read_mmap(mmap_dir, split_label):
+  """Open a split's memory-mapped cache read-only.
+
+  Returns:
+    mmap_index: Index dict written by write_mmap.
+    seqs:       [num_seqs, seq_length] uint8 index (N=4), or
+                [num_seqs, seq_length, 4] bool one hot, memmap.
+    targets:    [num_seqs, target_length, num_targets] float16 memmap.
+  """
+  index_file, seqs_file, targets_file = mmap_files(mmap_dir, split_label)
+  with open(index_file) as index_open:
+    mmap_index = json.load(index_open)
+
+  num_seqs = mmap_index['num_seqs']
+  seqs_shape = (num_seqs, mmap_index['seq_length'])
+  if mmap_index['seq_format'] == '1hot':
+    seqs_shape += (4,)
+  targets_shape = (num_seqs, mmap_index['target_length'], mmap_index['num_targets'])
+
+  if num_seqs == 0:
+    seqs = np.zeros(seqs_shape, dtype=mmap_index['seq_dtype'])
+    targets = np.zeros(targets_shape, dtype='float16')
+  else:
+    seqs = np.memmap(seqs_file, dtype=mmap_index['seq_dtype'], mode='r', shape=seqs_shape)
+    targets = np.memmap(targets_file, dtype='float16', mode='r', shape=targets_shape)
+  return mmap_index, seqs, targets
+
+
+def write_mmap(data_dir, split_label, mmap_dir, seq_format='index',
+               tfr_pattern=None, batch_size=16):
+  """Decode a split's TFRecords into fixed-stride, memory-mapped files.
+
+  Sequences are stored as uint8 nucleotide indexes (seq_format 'index',
+  N=4) or bool one hot coding ('1hot'), and targets as float16, so
+  reading record i is a slice at a fixed offset. The index file is
+  written last, marking the cache complete.
+
+  Args:
+    data_dir:    Data directory with statistics.json and tfrecords/.
+    split_label: Split, e.g. train, valid or test.
+    mmap_dir:    Output directory.
+    seq_format:  'index' or '1hot'.
+  """
+  if seq_format not in ['index', '1hot']:
+    raise ValueError('seq_format must be index or 1hot')
+  os.makedirs(mmap_dir, exist_ok=True)
+
+  seq_data = SeqDataset(data_dir, split_label, batch_size, mode='eval',
+                        tfr_pattern=tfr_pattern, seq_index=(seq_format == 'index'))
+  num_seqs = seq_data.num_seqs
+  seq_dtype = 'uint8' if seq_format == 'index' else 'bool'
+  seqs_shape = (num_seqs, seq_data.seq_length)
+  if seq_format == '1hot':
+    seqs_shape += (4,)
+  targets_shape = (num_seqs, seq_data.target_length, seq_data.num_targets)
+
+  index_file, seqs_file, targets_file = mmap_files(mmap_dir, split_label)
+  if os.path.isfile(index_file):
+    os.remove(index_file)
+
+  si = 0
+  if num_seqs > 0:
+    seqs = np.memmap(seqs_file, dtype=seq_dtype, mode='w+', shape=seqs_shape)
+    targets = np.memmap(targets_file, dtype='float16', mode='w+', shape=targets_shape)
+    for seqs_batch, targets_batch in seq_data.dataset:
+      batch_len = seqs_batch.shape[0]
+      seqs[si:si+batch_len] = seqs_batch.numpy()
+      targets[si:si+batch_len] = targets_batch.numpy()
+      si += batch_len
+    seqs.flush()
+    targets.flush()
+    del seqs, targets
+
+  if si != num_seqs:
+    raise ValueError('%s has %d sequences, expected %d' % (seq_data.tfr_path, si, num_seqs))
+
+  mmap_index = {
+    'num_seqs': num_seqs,
+    'seq_length': seq_data.seq_length,
+    'seq_format': seq_format,
+    'seq_dtype': seq_dtype,
+    'target_length': seq_data.target_length,
+    'num_targets': seq_data.num_targets,
+    'tfr_files': natsorted(glob.glob(seq_data.tfr_path))
+  }
+  with open(index_file, 'w') as index_open:
+    json.dump(mmap_index, index_open, indent=2)
+
 
 class SeqDataset:
   def __init__(self, data_dir, split_label, batch_size, shuffle_buffer=128,
-               seq_length_crop=None, mode='eval', tfr_pattern=None):
-    """Initialize basic parameters; run compute_stats; run make_dataset."""
+               seq_length_crop=None, mode='eval', tfr_pattern=None,
+               seq_index=False, mmap_dir=None, batch_parse=False,
+               deterministic=None, record_index=False, num_workers=1,
+               worker_index=0, seed=None, shard_records=False):
+    """Initialize basic parameters; run compute_stats; run make_dataset.
+
+    seq_index:     yield sequences as uint8 (L,) nucleotide index arrays
+                   (N=4) rather than float32 (L,4) one hot coding.
+    mmap_dir:      read decoded records from the memory-mapped cache
+                   written by write_mmap, rather than from TFRecords.
+    batch_parse:   batch serialized records first, then parse and decode
+                   each batch in parallel with generate_batch_parser.
+    deterministic: preserve record order in the parallel batch parse;
+                   None keeps order except in unseeded train mode.
+    record_index:  load (building once) the split's RecordIndex, so take
+                   and record_dataset read records directly.
+    num_workers:   number of workers reading disjoint shards, by file
+                   when each worker gets one, otherwise by record. Eval
+                   file shards balance per-file record counts, read from
+                   the RecordIndex or the cached file statistics.
+    worker_index:  this worker's shard, in [0, num_workers).
+    seed:          seed file and record shuffles in train mode, giving
+                   the same per-epoch orders on every run.
+    shard_records: shard by record, reading every file, so eval shards
+                   differ by at most one record, e.g. for synchronized
+                   multi-worker evaluate.
+    """
 
     self.data_dir = data_dir
     self.split_label = split_label
@@ -43,6 +483,19 @@ class SeqDataset:
     self.seq_length_crop = seq_length_crop
     self.mode = mode
     self.tfr_pattern = tfr_pattern
+    self.seq_index = seq_index
+    self.mmap_dir = mmap_dir
+    self.batch_parse = batch_parse
+    if deterministic is None:
+      deterministic = (mode != 'train' or seed is not None)
+    self.deterministic = deterministic
+    if num_workers < 1 or not 0 <= worker_index < num_workers:
+      raise ValueError('worker_index %d must be in [0, %d)' % (worker_index, num_workers))
+    self.num_workers = num_workers
+    self.worker_index = worker_index
+    self.seed = seed
+    self.shard_records = shard_records
+    self.worker_seqs = None
 
     # read data parameters
     data_stats_file = '%s/statistics.json' % self.data_dir
@@ -56,19 +509,86 @@ class SeqDataset:
     self.num_targets = data_stats['num_targets']
     self.pool_width = data_stats['pool_width']
     
-    if self.tfr_pattern is None:
+    if self.mmap_dir is not None:
+      self.tfr_path = '%s/tfrecords/%s-*.tfr' % (self.data_dir, self.split_label)
+      self.mmap_index, self.mmap_seqs, self.mmap_targets = read_mmap(self.mmap_dir, self.split_label)
+      self.num_seqs = self.mmap_index['num_seqs']
+      for key in ['seq_length', 'target_length', 'num_targets']:
+        if self.mmap_index[key] != getattr(self, key):
+          raise ValueError('%s cache %s %d differs from statistics %d' % \
+                           (self.mmap_dir, key, self.mmap_index[key], getattr(self, key)))
+    elif self.tfr_pattern is None:
       self.tfr_path = '%s/tfrecords/%s-*.tfr' % (self.data_dir, self.split_label)
       self.num_seqs = data_stats['%s_seqs' % self.split_label]
     else:
       self.tfr_path = '%s/tfrecords/%s' % (self.data_dir, self.tfr_pattern)
       self.compute_stats()
 
+    self.tfr_index = None
+    if record_index:
+      self.load_record_index()
+
     self.make_dataset()
 
   def batches_per_epoch(self):
-    return self.num_seqs // self.batch_size
+    """Batches per epoch per worker, equal across workers."""
+    return self.num_seqs // (self.batch_size * self.num_workers)
+
+  def worker_num_seqs(self):
+    """Records in one pass over this worker's shard, or None for train
+       file shards, which repeat and are not counted."""
+    return self.worker_seqs
+
+  def worker_num_batches(self):
+    """Batches in one pass over this worker's shard, or None."""
+    if self.worker_seqs is None:
+      return None
+    return int(np.ceil(self.worker_seqs / self.batch_size))
+
+  def file_num_seqs(self, tfr_files):
+    """Records per TFRecord file, from the RecordIndex when loaded and
+       otherwise from the cached file statistics."""
+    if self.tfr_index is not None and self.tfr_index.tfr_files == list(tfr_files):
+      return np.diff(self.tfr_index.file_starts).tolist()
+    return [tfr_stats_cached(tfr_file, self.target_length)['num_seqs'] \
+            for tfr_file in tfr_files]
+
+  def load_record_index(self):
+    """Load the split's RecordIndex, building missing file sidecars."""
+    if self.tfr_index is None:
+      self.tfr_index = RecordIndex(natsorted(glob.glob(self.tfr_path)))
+      if len(self.tfr_index) != self.num_seqs:
+        raise ValueError('%s index has %d records, expected %d' % \
+                         (self.tfr_path, len(self.tfr_index), self.num_seqs))
+    return self.tfr_index
+
+  def index_records(self, indexes):
+    """Dataset of the serialized records at indexes, read via the
+       RecordIndex."""
+    tfr_index = self.load_record_index()
+    indexes = [int(index) for index in indexes]
+    return tf.data.Dataset.from_generator(lambda: tfr_index.read(indexes),
+      output_signature=tf.TensorSpec([], tf.string))
+
+  def record_dataset(self, indexes, batch_size=None):
+    """Make Dataset of parsed batches of the records at indexes, in
+       order, e.g. one shard of an evaluation split."""
+    if batch_size is None:
+      batch_size = self.batch_size
+    dataset = self.index_records(indexes)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(self.generate_batch_parser(),
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
 
   def distribute(self, strategy):
+    if self.num_workers > 1:
+      # workers already read disjoint shards
+      options = tf.data.Options()
+      options.experimental_distribute.auto_shard_policy = \
+        tf.data.experimental.AutoShardPolicy.OFF
+      self.dataset = self.dataset.with_options(options)
     self.dataset = strategy.experimental_distribute_dataset(self.dataset)
 
   def generate_parser(self, raw=False):
@@ -87,16 +607,26 @@ class SeqDataset:
       # decode sequence
       sequence = tf.io.decode_raw(parsed_features[TFR_INPUT], tf.uint8)
       if not raw:
-        if self.seq_1hot:
-          sequence = tf.reshape(sequence, [self.seq_length])
-          sequence = tf.one_hot(sequence, 1+self.seq_depth, dtype=tf.uint8)
-          sequence = sequence[:,:-1] # drop N
+        if self.seq_index:
+          if self.seq_1hot:
+            sequence = tf.reshape(sequence, [self.seq_length])
+          else:
+            sequence = tf.reshape(sequence, [self.seq_length, self.seq_depth])
+            sequence = seq_1hot_index(sequence)
+          if self.seq_length_crop is not None:
+            crop_len = (self.seq_length - self.seq_length_crop) // 2
+            sequence = sequence[crop_len:-crop_len]
         else:
-          sequence = tf.reshape(sequence, [self.seq_length, self.seq_depth])
-        if self.seq_length_crop is not None:
-          crop_len = (self.seq_length - self.seq_length_crop) // 2
-          sequence = sequence[crop_len:-crop_len,:]
-        sequence = tf.cast(sequence, tf.float32)
+          if self.seq_1hot:
+            sequence = tf.reshape(sequence, [self.seq_length])
+            sequence = tf.one_hot(sequence, 1+self.seq_depth, dtype=tf.uint8)
+            sequence = sequence[:,:-1] # drop N
+          else:
+            sequence = tf.reshape(sequence, [self.seq_length, self.seq_depth])
+          if self.seq_length_crop is not None:
+            crop_len = (self.seq_length - self.seq_length_crop) // 2
+            sequence = sequence[crop_len:-crop_len,:]
+          sequence = tf.cast(sequence, tf.float32)
         
       # decode targets
       targets = tf.io.decode_raw(parsed_features[TFR_OUTPUT], tf.float16)
@@ -108,20 +638,84 @@ class SeqDataset:
 
     return parse_proto
 
+  def generate_batch_parser(self):
+    def parse_protos(example_protos):
+      """Parse a batch of TFRecord protobufs with one parse_example,
+         decode_raw and cast per feature."""
+
+      # define features
+      features = {
+        TFR_INPUT: tf.io.FixedLenFeature([], tf.string),
+        TFR_OUTPUT: tf.io.FixedLenFeature([], tf.string)
+      }
+
+      # parse examples into batched features
+      parsed_features = tf.io.parse_example(example_protos, features=features)
+
+      # decode sequences
+      sequence = tf.io.decode_raw(parsed_features[TFR_INPUT], tf.uint8)
+      if self.seq_1hot:
+        sequence = tf.reshape(sequence, [-1, self.seq_length])
+      else:
+        sequence = tf.reshape(sequence, [-1, self.seq_length, self.seq_depth])
+      if self.seq_length_crop is not None:
+        crop_len = (self.seq_length - self.seq_length_crop) // 2
+        sequence = sequence[:,crop_len:-crop_len]
+      if self.seq_index:
+        if not self.seq_1hot:
+          sequence = seq_1hot_index(sequence)
+      else:
+        if self.seq_1hot:
+          sequence = tf.one_hot(sequence, 1+self.seq_depth, dtype=tf.uint8)
+          sequence = sequence[...,:-1] # drop N
+        sequence = tf.cast(sequence, tf.float32)
+
+      # decode targets
+      targets = tf.io.decode_raw(parsed_features[TFR_OUTPUT], tf.float16)
+      targets = tf.reshape(targets, [-1, self.target_length, self.num_targets])
+      targets = tf.cast(targets, tf.float32)
+
+      return sequence, targets
+
+    return parse_protos
+
   def make_dataset(self, cycle_length=4):
     """Make Dataset w/ transformations."""
+    if self.mmap_dir is not None:
+      self.worker_seqs = len(range(self.worker_index, self.num_seqs, self.num_workers))
+      self.make_mmap_dataset()
+      return
 
     # initialize dataset from TFRecords glob
     tfr_files = natsorted(glob.glob(self.tfr_path))
+    shard_records = self.num_workers > 1 and \
+      (self.shard_records or len(tfr_files) < self.num_workers)
+    if shard_records or self.num_workers == 1:
+      self.worker_seqs = len(range(self.worker_index, self.num_seqs, self.num_workers))
     if tfr_files:
+      if self.num_workers > 1 and not shard_records:
+        if self.mode == 'train':
+          # shard files across workers
+          tfr_files = tfr_files[self.worker_index::self.num_workers]
+        else:
+          # shard files across workers, balancing record counts
+          file_lens = self.file_num_seqs(tfr_files)
+          worker_files = balance_shards(file_lens, self.num_workers)[self.worker_index]
+          tfr_files = [tfr_files[fi] for fi in worker_files]
+          self.worker_seqs = sum(file_lens[fi] for fi in worker_files)
       # dataset = tf.data.Dataset.list_files(tf.constant(tfr_files), shuffle=False)
-      dataset = tf.data.Dataset.from_tensor_slices(tfr_files)
+      dataset = tf.data.Dataset.from_tensor_slices(tf.constant(tfr_files, dtype=tf.string))
     else:
       print('Cannot order TFRecords %s' % self.tfr_path, file=sys.stderr)
       dataset = tf.data.Dataset.list_files(self.tfr_path)
 
     # train
     if self.mode == 'train':
+      # shuffle file order, a new seeded permutation each epoch
+      if self.seed is not None and tfr_files:
+        dataset = dataset.shuffle(buffer_size=len(tfr_files), seed=self.seed,
+          reshuffle_each_iteration=True)
+
       # repeat
       dataset = dataset.repeat()
 
@@ -130,26 +724,42 @@ class SeqDataset:
         cycle_length=cycle_length,
         num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
+      # shard records across workers
+      if shard_records:
+        dataset = dataset.shard(self.num_workers, self.worker_index)
+
       # shuffle
       dataset = dataset.shuffle(buffer_size=self.shuffle_buffer,
-        reshuffle_each_iteration=True)
+        seed=self.seed, reshuffle_each_iteration=True)
 
     # valid/test
     else:
       # flat mix files
       dataset = dataset.flat_map(file_to_records)
 
-    # (no longer necessary in tf2?)
-    # helper for training on single genomes in a multiple genome mode
-    # if self.num_seqs > 0:
-    #  dataset = dataset.map(self.generate_parser())
-    dataset = dataset.map(self.generate_parser())
+      # shard records across workers
+      if shard_records:
+        dataset = dataset.shard(self.num_workers, self.worker_index)
 
-    # cache (runs OOM)
-    # dataset = dataset.cache()
+    if self.batch_parse:
+      # batch serialized records, then parse whole batches in parallel
+      dataset = dataset.batch(self.batch_size)
+      dataset = dataset.map(self.generate_batch_parser(),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=self.deterministic)
 
-    # batch
-    dataset = dataset.batch(self.batch_size)
+    else:
+      # (no longer necessary in tf2?)
+      # helper for training on single genomes in a multiple genome mode
+      # if self.num_seqs > 0:
+      #  dataset = dataset.map(self.generate_parser())
+      dataset = dataset.map(self.generate_parser())
+
+      # cache (runs OOM)
+      # dataset = dataset.cache()
+
+      # batch
+      dataset = dataset.batch(self.batch_size)
 
     # prefetch
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -158,48 +768,126 @@ class SeqDataset:
     self.dataset = dataset
 
 
-  def compute_stats(self):
-    """ Iterate over the TFRecords to count sequences, and infer
-        seq_depth and num_targets."""
-    with tf.name_scope('stats'):
-      # read TF Records
-      dataset = tf.data.Dataset.list_files(self.tfr_path)
-      dataset = dataset.flat_map(file_to_records)
-      dataset = dataset.map(self.generate_parser(raw=True))
-      dataset = dataset.batch(1)
+  def read_mmap_batch(self, indexes):
+    """Read records from the memory-mapped cache, as views when
+       the indexes are contiguous."""
+    if len(indexes) > 0 and indexes[-1] - indexes[0] == len(indexes) - 1 and \
+        np.all(np.diff(indexes) == 1):
+      rows = slice(indexes[0], indexes[-1]+1)
+    else:
+      rows = indexes
+    return self.mmap_seqs[rows], self.mmap_targets[rows]
 
-    self.num_seqs = 0
-    if self.num_targets is not None:
-      targets_nonzero = np.zeros(self.num_targets, dtype='bool')
+  def make_mmap_dataset(self):
+    """Make Dataset of batches read from the memory-mapped cache."""
+    seq_format = self.mmap_index['seq_format']
+    seq_dtype = tf.uint8 if seq_format == 'index' else tf.bool
 
-    # for (seq_raw, genome), targets_raw in dataset:
-    for seq_raw, targets_raw in dataset:
-      # infer seq_depth
-      seq_1hot = seq_raw.numpy().reshape((self.seq_length,-1))
+    def read_batch(indexes):
+      seqs, targets = tf.numpy_function(self.read_mmap_batch, [indexes],
+                                        [seq_dtype, tf.float16])
+      seqs.set_shape((None,) + self.mmap_seqs.shape[1:])
+      targets.set_shape((None,) + self.mmap_targets.shape[1:])
+
+      # decode sequence
+      if seq_format == 'index':
+        if not self.seq_index:
+          seqs = tf.one_hot(tf.cast(seqs, tf.int32), 5, dtype=tf.float32)[...,:4]
+      else:
+        if self.seq_index:
+          seqs = seq_1hot_index(tf.cast(seqs, tf.uint8))
+        else:
+          seqs = tf.cast(seqs, tf.float32)
+      if self.seq_length_crop is not None:
+        crop_len = (self.seq_length - self.seq_length_crop) // 2
+        seqs = seqs[:,crop_len:-crop_len]
+
+      # decode targets
+      targets = tf.cast(targets, tf.float32)
+      return seqs, targets
+
+    dataset = tf.data.Dataset.range(self.num_seqs)
+
+    # shard records across workers
+    if self.num_workers > 1:
+      dataset = dataset.shard(self.num_workers, self.worker_index)
+
+    # train
+    if self.mode == 'train':
+      # shuffle record indexes, a new permutation each epoch
+      dataset = dataset.shuffle(buffer_size=max(self.num_seqs, 1),
+        seed=self.seed, reshuffle_each_iteration=True)
+      dataset = dataset.repeat()
+
+    dataset = dataset.batch(self.batch_size)
+    dataset = dataset.map(read_batch,
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    self.dataset = dataset
+
+  def compute_stats(self, num_threads=None):
+    """ Count sequences and nonzero targets in the TFRecords, and infer
+        num_targets. Files are scanned in parallel threads, and each
+        file's counts are cached in a sidecar keyed by its size and
+        mtime, so later runs only scan new or changed files."""
+    tfr_files = natsorted(glob.glob(self.tfr_path))
+    if num_threads is None:
+      num_threads = min(len(tfr_files), os.cpu_count() or 1)
+
+    def file_stats(tfr_file):
+      return tfr_stats_cached(tfr_file, self.target_length)
+
+    if num_threads > 1:
+      with ThreadPool(num_threads) as pool:
+        files_stats = pool.map(file_stats, tfr_files)
+    else:
+      files_stats = [file_stats(tfr_file) for tfr_file in tfr_files]
+
+    self.num_seqs = 0
+    targets_nonzero = None
+    for stats in files_stats:
+      if stats['num_seqs'] == 0:
+        continue
+      self.num_seqs += stats['num_seqs']
 
       # infer num_targets
-      targets1 = targets_raw.numpy().reshape(self.target_length,-1)
+      file_nonzero = np.array(stats['targets_nonzero'], dtype='bool')
       if self.num_targets is None:
-        self.num_targets = targets1.shape[-1]
-        targets_nonzero = ((targets1 != 0).sum(axis=0) > 0)
+        self.num_targets = len(file_nonzero)
       else:
-        assert(self.num_targets == targets1.shape[-1])
-        targets_nonzero = np.logical_or(targets_nonzero, (targets1 != 0).sum(axis=0) > 0)
+        assert(self.num_targets == len(file_nonzero))
 
-      # count sequences
-      self.num_seqs += 1
+      if targets_nonzero is None:
+        targets_nonzero = file_nonzero
+      else:
+        targets_nonzero = np.logical_or(targets_nonzero, file_nonzero)
 
     # warn user about nonzero targets
     if self.num_seqs > 0:
-      self.num_targets_nonzero = (targets_nonzero > 0).sum()
+      self.num_targets_nonzero = targets_nonzero.sum()
       print('%s has %d sequences with %d/%d targets' % (self.tfr_path, self.num_seqs, self.num_targets_nonzero, self.num_targets), flush=True)
     else:
       self.num_targets_nonzero = None
       print('%s has %d sequences with 0 targets' % (self.tfr_path, self.num_seqs), flush=True)
 
 
-  def numpy(self, return_inputs=True, return_outputs=True, step=1, target_slice=None, dtype='float16'):
-    """ Convert TFR inputs and/or outputs to numpy arrays."""
+  def __len__(self):
+    return self.num_seqs
+
+  def __getitem__(self, index):
+    """ Return one record's numpy (sequence, targets), decoding only it."""
+    seqs_1hot, targets = self.take([index])
+    return seqs_1hot[0], targets[0]
+
+  def raw_records(self, indexes=None):
+    """ Dataset of raw (sequence, targets) records in file order.
+
+    Args:
+      indexes: Optional sorted, unique record indexes. Other records are
+               skipped unparsed, and reading stops after the last index;
+               with a RecordIndex loaded, they are read directly.
+    """
     with tf.name_scope('numpy'):
       # initialize dataset from TFRecords glob
       tfr_files = natsorted(glob.glob(self.tfr_path))
@@ -212,37 +900,133 @@ class SeqDataset:
 
       # read TF Records
       dataset = dataset.flat_map(file_to_records)
+
+      # select records
+      if indexes is not None and self.tfr_index is not None:
+        dataset = self.index_records(indexes)
+      elif indexes is not None:
+        keep_indexes = tf.constant(indexes, dtype=tf.int64)
+        dataset = dataset.take(int(indexes[-1]) + 1 if len(indexes) else 0)
+        dataset = dataset.enumerate()
+        dataset = dataset.filter(lambda ri, record: tf.reduce_any(tf.equal(ri, keep_indexes)))
+        dataset = dataset.map(lambda ri, record: record)
+
       dataset = dataset.map(self.generate_parser(raw=True))
-      dataset = dataset.batch(1)
 
-    # initialize inputs and outputs
-    seqs_1hot = []
-    targets = []
+    return dataset
 
-    # collect inputs and outputs
-    for seq_raw, targets_raw in dataset:
-      # sequence
+  def numpy_record(self, seq_raw, targets_raw, return_inputs=True, return_outputs=True,
+                   step=1, target_slice=None, dtype='float16'):
+    """ Convert one raw record to numpy inputs and/or outputs, or None."""
+    seq_1hot = None
+    if return_inputs:
+      seq_1hot = seq_raw.numpy().reshape((self.seq_length,-1))
+      if self.seq_index:
+        if self.seq_1hot:
+          seq_1hot = seq_1hot[:,0]
+        else:
+          seq_1hot = dna_io.hot1_index(seq_1hot)
+      if self.seq_length_crop is not None:
+        crop_len = (self.seq_length - self.seq_length_crop) // 2
+        seq_1hot = seq_1hot[crop_len:-crop_len]
+
+    targets1 = None
+    if return_outputs:
+      targets1 = targets_raw.numpy().astype(dtype)
+      targets1 = np.reshape(targets1, (self.target_length,-1))
+      if target_slice is not None:
+        targets1 = targets1[:,target_slice]
+      if step > 1:
+        step_i = np.arange(0, self.target_length, step)
+        targets1 = targets1[step_i,:]
+
+    return seq_1hot, targets1
+
+  def iterate(self, return_inputs=True, return_outputs=True, step=1, target_slice=None, dtype='float16'):
+    """ Stream numpy inputs and/or outputs one record at a time,
+        holding only the current record in memory."""
+    for seq_raw, targets_raw in self.raw_records():
+      seq_1hot, targets1 = self.numpy_record(seq_raw, targets_raw, return_inputs,
+                                             return_outputs, step, target_slice, dtype)
+      if return_inputs and return_outputs:
+        yield seq_1hot, targets1
+      elif return_inputs:
+        yield seq_1hot
+      else:
+        yield targets1
+
+  def take(self, indexes, return_inputs=True, return_outputs=True, step=1, target_slice=None, dtype='float16'):
+    """ Convert the records at indexes to numpy inputs and/or outputs,
+        in the given order, decoding only those records."""
+    indexes = np.array(indexes, dtype='int64').reshape(-1)
+    indexes[indexes < 0] += self.num_seqs
+    if np.any(indexes < 0) or np.any(indexes >= self.num_seqs):
+      raise IndexError('Record indexes out of range for %d sequences' % self.num_seqs)
+    read_indexes, read_inverse = np.unique(indexes, return_inverse=True)
+
+    seqs_1hot = None
+    targets = None
+    ri = -1
+    for ri, (seq_raw, targets_raw) in enumerate(self.raw_records(read_indexes)):
+      seq_1hot, targets1 = self.numpy_record(seq_raw, targets_raw, return_inputs,
+                                             return_outputs, step, target_slice, dtype)
+      out_mask = (read_inverse == ri)
       if return_inputs:
-        seq_1hot = seq_raw.numpy().reshape((self.seq_length,-1))
-        if self.seq_length_crop is not None:
-          crop_len = (self.seq_length - self.seq_length_crop) // 2
-          seq_1hot = seq_1hot[crop_len:-crop_len,:]
-        seqs_1hot.append(seq_1hot)
+        if seqs_1hot is None:
+          seqs_1hot = np.zeros((len(indexes),) + seq_1hot.shape, dtype=seq_1hot.dtype)
+        seqs_1hot[out_mask] = seq_1hot
+      if return_outputs:
+        if targets is None:
+          targets = np.zeros((len(indexes),) + targets1.shape, dtype=dtype)
+        targets[out_mask] = targets1
 
-      # targets
+    if ri + 1 != len(read_indexes):
+      raise IndexError('%s has fewer records than %d' % (self.tfr_path, read_indexes[-1]+1))
+    if seqs_1hot is None:
+      seqs_1hot = np.zeros(0)
+    if targets is None:
+      targets = np.zeros(0, dtype=dtype)
+
+    # return
+    if return_inputs and return_outputs:
+      return seqs_1hot, targets
+    elif return_inputs:
+      return seqs_1hot
+    else:
+      return targets
+
+  def numpy(self, return_inputs=True, return_outputs=True, step=1, target_slice=None, dtype='float16'):
+    """ Convert TFR inputs and/or outputs to numpy arrays, filling
+        arrays preallocated for num_seqs records."""
+    seqs_1hot = None
+    targets = None
+
+    # collect inputs and outputs
+    si = 0
+    for seq_raw, targets_raw in self.raw_records():
+      seq_1hot, targets1 = self.numpy_record(seq_raw, targets_raw, return_inputs,
+                                             return_outputs, step, target_slice, dtype)
+      if si == self.num_seqs:
+        raise ValueError('%s has more than %d sequences' % (self.tfr_path, self.num_seqs))
+      if return_inputs:
+        if seqs_1hot is None:
+          seqs_1hot = np.zeros((self.num_seqs,) + seq_1hot.shape, dtype=seq_1hot.dtype)
+        seqs_1hot[si] = seq_1hot
       if return_outputs:
-        targets1 = targets_raw.numpy().astype(dtype)
-        targets1 = np.reshape(targets1, (self.target_length,-1))
-        if target_slice is not None:
-          targets1 = targets1[:,target_slice]
-        if step > 1:
-          step_i = np.arange(0, self.target_length, step)
-          targets1 = targets1[step_i,:]
-        targets.append(targets1)
+        if targets is None:
+          targets = np.zeros((self.num_seqs,) + targets1.shape, dtype=dtype)
+        targets[si] = targets1
+      si += 1
 
     # make arrays
-    seqs_1hot = np.array(seqs_1hot)
-    targets = np.array(targets, dtype=dtype)
+    if seqs_1hot is None:
+      seqs_1hot = np.array([])
+    else:
+      seqs_1hot = seqs_1hot[:si]
+    if targets is None:
+      targets = np.array([], dtype=dtype)
+    else:
+      targets = targets[:si]
 
     # return
     if return_inputs and return_outputs:
@@ -26,6 +26,59 @@ import numpy as np
 # Methods to load the training data.
 ################################################################################
 
+# ASCII byte -> nucleotide index (A,C,G,T -> 0-3; anything else -> 4)
+_NT_INDEX = np.full(256, 4, dtype='uint8')
+for _nt_i, _nt in enumerate('ACGT'):
+  _NT_INDEX[ord(_nt)] = _nt_i
+  _NT_INDEX[ord(_nt.lower())] = _nt_i
+
+# nucleotide index -> one hot row, with N as all zeros or uniform
+_INDEX_1HOT = np.eye(5, 4, dtype='bool')
+_INDEX_1HOT_UNIFORM = np.eye(5, 4, dtype='float16')
+_INDEX_1HOT_UNIFORM[4] = 0.25
+
+# nucleotide index -> complement index
+_INDEX_RC = np.array([3, 2, 1, 0, 4], dtype='uint8')
+
+# nucleotide index -> ASCII
+_INDEX_NT = np.frombuffer(b'ACGTN', dtype='uint8')
+
+
+def _seq_codes(seq):
+  """ Map a nucleotide string to a uint8 index array via byte lookup. """
+  seq_bytes = seq.encode('ascii', errors='replace')
+  return _NT_INDEX[np.frombuffer(seq_bytes, dtype='uint8')]
+
+
+def _dna_1hot_fill(seq_code, seq, seq_len, n_uniform, n_sample):
+  """ Write the one hot coding of seq into the preallocated
+      seq_len x 4 array seq_code, trimming or padding as dna_1hot. """
+  if seq_len <= len(seq):
+    # trim the sequence
+    seq_trim = (len(seq) - seq_len) // 2
+    seq = seq[seq_trim:seq_trim + seq_len]
+    seq_start = 0
+  else:
+    seq_start = (seq_len - len(seq)) // 2
+
+  # padding stays zero
+  seq_code[:seq_start] = 0
+  seq_code[seq_start + len(seq):] = 0
+
+  codes = _seq_codes(seq)
+  seq_view = seq_code[seq_start:seq_start + len(seq)]
+  if n_uniform:
+    seq_view[:] = _INDEX_1HOT_UNIFORM[codes]
+  else:
+    seq_view[:] = _INDEX_1HOT[codes]
+    if n_sample:
+      n_pos = np.flatnonzero(codes == 4)
+      if len(n_pos) > 0:
+        # draw in sequence order to match the per-base loop
+        n_nts = [random.randint(0,3) for _ in range(len(n_pos))]
+        seq_view[n_pos, n_nts] = 1
+
+
 def dna_1hot(seq, seq_len=None, n_uniform=False, n_sample=False):
   """ dna_1hot
 
@@ -40,45 +93,51 @@ def dna_1hot(seq, seq_len=None, n_uniform=False, n_sample=False):
     """
   if seq_len is None:
     seq_len = len(seq)
-    seq_start = 0
-  else:
-    if seq_len <= len(seq):
-      # trim the sequence
-      seq_trim = (len(seq) - seq_len) // 2
-      seq = seq[seq_trim:seq_trim + seq_len]
-      seq_start = 0
-    else:
-      seq_start = (seq_len - len(seq)) // 2
-
-  seq = seq.upper()
 
   # map nt's to a matrix len(seq)x4 of 0's and 1's.
   if n_uniform:
-    seq_code = np.zeros((seq_len, 4), dtype='float16')
+    seq_code = np.empty((seq_len, 4), dtype='float16')
   else:
-    seq_code = np.zeros((seq_len, 4), dtype='bool')
-    
-  for i in range(seq_len):
-    if i >= seq_start and i - seq_start < len(seq):
-      nt = seq[i - seq_start]
-      if nt == 'A':
-        seq_code[i, 0] = 1
-      elif nt == 'C':
-        seq_code[i, 1] = 1
-      elif nt == 'G':
-        seq_code[i, 2] = 1
-      elif nt == 'T':
-        seq_code[i, 3] = 1
-      else:
-        if n_uniform:
-          seq_code[i, :] = 0.25
-        elif n_sample:
-          ni = random.randint(0,3)
-          seq_code[i, ni] = 1
+    seq_code = np.empty((seq_len, 4), dtype='bool')
+
+  _dna_1hot_fill(seq_code, seq, seq_len, n_uniform, n_sample)
 
   return seq_code
 
 
+def dna_1hot_batch(seqs, seq_len=None, n_uniform=False, n_sample=False, out=None):
+  """ dna_1hot_batch
+
+    One hot code a list of sequences into a single preallocated array.
+
+    Args:
+      seqs:      list of nucleotide sequences.
+      seq_len:   length to extend/trim sequences to (default: first length).
+      n_uniform: represent N's as 0.25, forcing float16,
+      n_sample:  sample ACGT for N
+      out:       optional preallocated N x seq_len x 4 array to fill.
+
+    Returns:
+      seqs_code: num sequences by length by nucleotides array.
+    """
+  if seq_len is None:
+    seq_len = len(seqs[0]) if len(seqs) > 0 else 0
+
+  if out is None:
+    if n_uniform:
+      out = np.empty((len(seqs), seq_len, 4), dtype='float16')
+    else:
+      out = np.empty((len(seqs), seq_len, 4), dtype='bool')
+  elif out.shape[0] < len(seqs) or out.shape[1:] != (seq_len, 4):
+    raise ValueError('Output array shape %s cannot hold %d sequences of length %d' % \
+                     (str(out.shape), len(seqs), seq_len))
+
+  for si, seq in enumerate(seqs):
+    _dna_1hot_fill(out[si], seq, seq_len, n_uniform, n_sample)
+
+  return out
+
+
 def dna_1hot_index(seq, n_sample=False):
   """ dna_1hot_index
 
@@ -88,31 +147,58 @@ def dna_1hot_index(seq, n_sample=False):
     Returns:
       seq_code:  index int array representation.
     """
-  seq_len = len(seq)
-  seq = seq.upper()
-
   # map nt's to a len(seq) of 0,1,2,3
-  seq_code = np.zeros(seq_len, dtype='uint8')
-    
-  for i in range(seq_len):
-    nt = seq[i]
-    if nt == 'A':
-      seq_code[i] = 0
-    elif nt == 'C':
-      seq_code[i] = 1
-    elif nt == 'G':
-      seq_code[i] = 2
-    elif nt == 'T':
-      seq_code[i] = 3
-    else:
-      if n_sample:
-        seq_code[i] = random.randint(0,3)
-      else:
-        seq_code[i] = 4
+  seq_code = _seq_codes(seq)
+
+  if n_sample:
+    n_pos = np.flatnonzero(seq_code == 4)
+    if len(n_pos) > 0:
+      # draw in sequence order to match the per-base loop
+      seq_code[n_pos] = [random.randint(0,3) for _ in range(len(n_pos))]
 
   return seq_code
 
 
+def hot1_index(seqs_1hot):
+  """ Convert one hot coded sequences (... x L x 4) to uint8
+       index arrays (... x L), coding positions that are not exactly
+       one hot, e.g. all-zero or uniform 0.25 N's, as 4 (N). """
+  seqs_1hot = np.asarray(seqs_1hot)[...,:4]
+  seqs_index = np.argmax(seqs_1hot, axis=-1).astype('uint8')
+  seqs_n = ((seqs_1hot == 1).sum(axis=-1) != 1) | (seqs_1hot.sum(axis=-1) != 1)
+  seqs_index[seqs_n] = 4
+  return seqs_index
+
+
+def index_1hot(seqs_index, n_uniform=False, out=None):
+  """ Expand uint8 index arrays (... x L) to one hot coding
+       (... x L x 4), with N's as zeros or 0.25 if n_uniform,
+       optionally writing into the preallocated array out. """
+  if n_uniform:
+    index_table = _INDEX_1HOT_UNIFORM
+  else:
+    index_table = _INDEX_1HOT
+
+  if out is None:
+    return index_table[seqs_index]
+  elif out.dtype == index_table.dtype:
+    return np.take(index_table, seqs_index, axis=0, out=out)
+  else:
+    out[...] = index_table[seqs_index]
+    return out
+
+
+def index_rc(seqs_index):
+  """ Reverse complement a batch (or single) uint8 index sequence(s),
+       leaving N's as N. """
+  return _INDEX_RC[seqs_index[...,::-1]]
+
+
+def index_dna(seq_index):
+  """ Decode a uint8 index sequence (N=4) to an uppercase string. """
+  return _INDEX_NT[seq_index].tobytes().decode('ascii')
+
+
 def hot1_augment(Xb, fwdrc=True, shift=0):
   """ Transform a batch of one hot coded sequences to augment training.
 
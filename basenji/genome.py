@@ -15,9 +15,15 @@
 
 from __future__ import print_function
 
+import json
+import os
 import sys
+
+import numpy as np
 import pysam
 
+from basenji import dna_io
+
 ################################################################################
 # genome.py
 #
@@ -119,3 +125,204 @@ def split_contigs(chrom_segments, gaps_file):
         chrom_segments[chrom].append((pos1, pos2))
 
   return chrom_segments
+
+
+################################################################################
+# Genome store
+#
+# A FASTA converted once into 2-bit packed nucleotides plus a packed N mask,
+# memory-mapped so that windows decode straight to index/one hot arrays and
+# worker processes share one page-cached copy.
+################################################################################
+
+STORE_SUFFIX = '.gstore'
+STORE_FORMAT = 'basenji-gstore-1'
+
+# packed byte -> 4 nucleotide indexes, most significant bits first
+_UNPACK_2BIT = np.array([[(b >> shift) & 3 for shift in (6, 4, 2, 0)]
+                         for b in range(256)], dtype='uint8')
+
+# nucleotide index -> ASCII
+_INDEX_NT = np.frombuffer(b'ACGTN', dtype='uint8')
+
+
+def open_genome(genome_file):
+  """ Open a genome store (*.gstore) or FASTA file for fetching. """
+  if genome_file.endswith(STORE_SUFFIX):
+    return GenomeStore(genome_file)
+  else:
+    return pysam.Fastafile(genome_file)
+
+
+def fetch_seq(genome_open, chrom, start, end, seq_index=False):
+  """ Fetch [start,end) encoded for the model, padding with N beyond
+      the chromosome ends.
+
+    A GenomeStore decodes straight from its packed arrays; other
+    handlers, e.g. pysam.Fastafile, are fetched as text and encoded.
+
+    Args:
+      genome_open: GenomeStore or pysam.Fastafile
+      chrom, start, end: window coordinates
+      seq_index: return a uint8 (L,) nucleotide index array (N=4)
+                 rather than an (L,4) one hot array
+
+    Returns:
+      encoded sequence
+    """
+  if isinstance(genome_open, GenomeStore):
+    if seq_index:
+      return genome_open.fetch_index(chrom, start, end)
+    else:
+      return genome_open.fetch_1hot(chrom, start, end)
+
+  chrom_len = genome_open.get_reference_length(chrom)
+  cstart, cend = max(start, 0), min(end, chrom_len)
+  if cend > cstart:
+    seq_dna = genome_open.fetch(chrom, cstart, cend)
+    seq_dna = 'N'*(cstart - start) + seq_dna + 'N'*(end - cend)
+  else:
+    seq_dna = 'N'*(end - start)
+  if seq_index:
+    return dna_io.dna_1hot_index(seq_dna)
+  else:
+    return dna_io.dna_1hot(seq_dna)
+
+
+def write_genome_store(fasta_file, store_file=None, chunk_size=2**24):
+  """ Convert a FASTA file to a 2-bit packed, N-masked genome store.
+
+    Args:
+      fasta_file: indexed FASTA file
+      store_file: output index path, defaulting to fasta_file with its
+                  extension replaced by .gstore (hg38.fa -> hg38.gstore);
+                  packed data is written to store_file + .bin
+      chunk_size: bases encoded at a time
+
+    Returns:
+      store_file
+    """
+  if store_file is None:
+    store_file = os.path.splitext(fasta_file)[0] + STORE_SUFFIX
+  assert(chunk_size % 8 == 0)
+
+  fasta_open = pysam.Fastafile(fasta_file)
+
+  # lay out chromosomes
+  chroms = []
+  offset = 0
+  for chrom, chrom_len in zip(fasta_open.references, fasta_open.lengths):
+    seq_bytes = (chrom_len + 3) // 4
+    mask_bytes = (chrom_len + 7) // 8
+    chroms.append({'chrom':chrom, 'length':chrom_len,
+                   'seq_offset':offset, 'mask_offset':offset + seq_bytes})
+    offset += seq_bytes + mask_bytes
+
+  # pack sequences and N masks
+  store_bin = np.memmap(store_file + '.bin', dtype='uint8', mode='w+',
+                        shape=(max(offset,1),))
+  for chrom_info in chroms:
+    chrom_len = chrom_info['length']
+    for cstart in range(0, chrom_len, chunk_size):
+      cend = min(cstart + chunk_size, chrom_len)
+      seq_codes = dna_io.dna_1hot_index(fasta_open.fetch(chrom_info['chrom'], cstart, cend))
+
+      # N mask
+      mask_start = chrom_info['mask_offset'] + cstart // 8
+      seq_mask = np.packbits(seq_codes == 4)
+      store_bin[mask_start:mask_start+len(seq_mask)] = seq_mask
+
+      # 2-bit codes, N's as A
+      seq_codes &= 3
+      pad_len = -len(seq_codes) % 4
+      if pad_len > 0:
+        seq_codes = np.concatenate([seq_codes, np.zeros(pad_len, dtype='uint8')])
+      seq_codes = seq_codes.reshape((-1,4))
+      seq_packed = (seq_codes[:,0] << 6) | (seq_codes[:,1] << 4) | \
+                   (seq_codes[:,2] << 2) | seq_codes[:,3]
+      seq_start = chrom_info['seq_offset'] + cstart // 4
+      store_bin[seq_start:seq_start+len(seq_packed)] = seq_packed
+
+  store_bin.flush()
+  del store_bin
+  fasta_open.close()
+
+  # write index
+  with open(store_file, 'w') as store_open:
+    json.dump({'format':STORE_FORMAT, 'chroms':chroms}, store_open, indent=2)
+
+  return store_file
+
+
+class GenomeStore:
+  """ Memory-mapped 2-bit genome written by write_genome_store.
+
+      Fetches return arrays directly, padding with N beyond the
+      chromosome ends. fetch() mirrors pysam.Fastafile for code
+      that needs text. Instances pickle by path for process pools. """
+  def __init__(self, store_file):
+    self.store_file = store_file
+    with open(store_file) as store_open:
+      store_index = json.load(store_open)
+    if store_index.get('format') != STORE_FORMAT:
+      raise ValueError('Unrecognized genome store format in %s' % store_file)
+
+    self.chroms = {ci['chrom']:ci for ci in store_index['chroms']}
+    self.references = [ci['chrom'] for ci in store_index['chroms']]
+    self.lengths = [ci['length'] for ci in store_index['chroms']]
+    self.store_bin = np.memmap(store_file + '.bin', dtype='uint8', mode='r')
+
+  def __getstate__(self):
+    return {'store_file': self.store_file}
+
+  def __setstate__(self, state):
+    self.__init__(state['store_file'])
+
+  def close(self):
+    self.store_bin = None
+
+  def get_reference_length(self, chrom):
+    return self.chroms[chrom]['length']
+
+  def fetch_index(self, chrom, start, end):
+    """ Fetch [start,end) as a uint8 index array (N=4). """
+    chrom_info = self.chroms[chrom]
+    seq_index = np.full(end - start, 4, dtype='uint8')
+
+    # clip to chromosome
+    cstart = max(start, 0)
+    cend = min(end, chrom_info['length'])
+    if cstart >= cend:
+      return seq_index
+
+    # unpack 2-bit codes
+    byte_start = cstart // 4
+    byte_end = (cend + 3) // 4
+    seq_packed = self.store_bin[chrom_info['seq_offset']+byte_start:chrom_info['seq_offset']+byte_end]
+    seq_codes = _UNPACK_2BIT[seq_packed].reshape(-1)
+    seq_codes = seq_codes[cstart - 4*byte_start:cend - 4*byte_start]
+
+    # apply N mask
+    mask_start = cstart // 8
+    mask_end = (cend + 7) // 8
+    seq_mask = self.store_bin[chrom_info['mask_offset']+mask_start:chrom_info['mask_offset']+mask_end]
+    seq_mask = np.unpackbits(seq_mask)[cstart - 8*mask_start:cend - 8*mask_start]
+    seq_codes[seq_mask.view('bool')] = 4
+
+    seq_index[cstart-start:cend-start] = seq_codes
+    return seq_index
+
+  def fetch_1hot(self, chrom, start, end, n_uniform=False):
+    """ Fetch [start,end) as a one hot coded array. """
+    return dna_io.index_1hot(self.fetch_index(chrom, start, end), n_uniform)
+
+  def fetch(self, chrom, start=None, end=None):
+    """ Fetch [start,end) as an uppercase string, clipped to the
+        chromosome like pysam.Fastafile.fetch. """
+    chrom_len = self.chroms[chrom]['length']
+    start = 0 if start is None else max(start, 0)
+    end = chrom_len if end is None else min(end, chrom_len)
+    if start >= end:
+      return ''
+    seq_index = self.fetch_index(chrom, start, end)
+    return _INDEX_NT[seq_index].tobytes().decode()
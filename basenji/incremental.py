@@ -0,0 +1,338 @@
+# Copyright 2023 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import numpy as np
+import tensorflow as tf
+
+from basenji import layers
+
+################################################################################
+# incremental.py
+#
+# Receptive-field-limited recomputation of the 1D trunk for local,
+# length-preserving sequence edits. Reference activations are cached once;
+# for each edited sequence only the positions downstream of the edit are
+# recomputed through the 1D layers, up to the OneToTwo transition, and the
+# remaining layers are replayed on the patched 1D representation.
+################################################################################
+
+# layers acting on each position independently
+POINTWISE_LAYERS = (
+  tf.keras.layers.ReLU,
+  tf.keras.layers.Activation,
+  tf.keras.layers.BatchNormalization,
+  tf.keras.layers.Dropout,
+  tf.keras.layers.Dense,
+  layers.PolyReLU,
+  layers.Softplus,
+  layers.Exp,
+  layers.Clip,
+  layers.StochasticShift,
+)
+
+# TFOpLambda activations acting on each position independently
+POINTWISE_OPS = ('nn.gelu', 'math.sigmoid', 'math.tanh', 'nn.relu',
+                 'math.softplus', 'math.exp')
+
+POOLING_LAYERS = (
+  tf.keras.layers.MaxPooling1D,
+  tf.keras.layers.AveragePooling1D,
+)
+
+
+class IncrementalModel:
+  """ Predict locally edited sequences by recomputing only the trunk
+      positions their edits reach.
+
+  Walks the Keras layer graph of model from its input up to the first
+  OneToTwo layer (or to the output of a purely 1D model). Conv1D,
+  pooling, pointwise and Add layers are supported there; other layers
+  raise NotImplementedError. After set_reference caches the reference
+  activations, predict propagates each sequence's differing interval
+  through those layers as a window, reading unchanged neighbours from
+  the cache, and replays the remaining layers on the patched 1D output.
+
+  Edits must preserve sequence length; insertions or deletions shift
+  the downstream sequence and are not local.
+  """
+  def __init__(self, model, batch_size=8):
+    self.model = model
+    self.batch_size = batch_size
+
+    self.input_tensor = model.inputs[0]
+    self.seq_length = self.input_tensor.shape[1]
+
+    self.prefix_layers = []
+    self.suffix_layers = []
+    self.cut_tensor = None
+    self.split_layers()
+
+    # tensors whose reference values are read around edit windows
+    self.cache_ids = {id(self.cut_tensor)}
+    for layer in self.prefix_layers:
+      if self.layer_kind(layer) in ['conv', 'pool', 'add']:
+        for t in tf.nest.flatten(layer.input):
+          self.cache_ids.add(id(t))
+
+    self.ref_seq = None
+    self.ref_cache = {}
+    self.ref_preds = None
+
+  def split_layers(self):
+    """ Split model layers into the incremental 1D prefix and the suffix. """
+    in_prefix = True
+    for layer in self.model.layers:
+      if isinstance(layer, tf.keras.layers.InputLayer):
+        continue
+      if in_prefix and isinstance(layer, layers.OneToTwo):
+        self.cut_tensor = layer.input
+        in_prefix = False
+      if in_prefix:
+        self.prefix_layers.append(layer)
+      else:
+        self.suffix_layers.append(layer)
+
+    if self.cut_tensor is None:
+      self.cut_tensor = self.model.outputs[0]
+      if len(self.cut_tensor.shape) != 3:
+        raise NotImplementedError('Cannot find the 1D portion of model %s' % self.model.name)
+
+    for layer in self.prefix_layers:
+      self.layer_kind(layer)
+
+  def layer_kind(self, layer):
+    """ Classify a prefix layer by how it propagates edit windows. """
+    if isinstance(layer, layers.StochasticReverseComplement):
+      return 'reverse'
+    elif isinstance(layer, POINTWISE_LAYERS):
+      return 'pointwise'
+    elif type(layer).__name__ == 'TFOpLambda' and layer.symbol in POINTWISE_OPS:
+      return 'pointwise'
+    elif isinstance(layer, tf.keras.layers.Conv1D) and type(layer) == tf.keras.layers.Conv1D:
+      if layer.strides[0] != 1 or layer.padding != 'same' or layer.groups != 1:
+        raise NotImplementedError('Conv1D %s must have stride 1, same padding and one group' % layer.name)
+      return 'conv'
+    elif isinstance(layer, POOLING_LAYERS):
+      pool_size = layer.pool_size[0]
+      if layer.strides[0] != pool_size:
+        raise NotImplementedError('Pooling %s must have stride equal to pool size' % layer.name)
+      if layer.input.shape[1] % pool_size != 0:
+        raise NotImplementedError('Pooling %s input length must be divisible by pool size' % layer.name)
+      return 'pool'
+    elif isinstance(layer, tf.keras.layers.Add):
+      return 'add'
+    else:
+      raise NotImplementedError('Incremental recomputation does not support layer %s (%s)' % \
+                                (layer.name, type(layer).__name__))
+
+  def set_reference(self, ref_seq_1hot):
+    """ Cache reference activations and predictions.
+
+    Args:
+      ref_seq_1hot: [seq_length, 4] one hot reference sequence.
+    """
+    self.ref_seq = np.asarray(ref_seq_1hot, dtype='float32')
+    values = {id(self.input_tensor): tf.constant(self.ref_seq[np.newaxis])}
+
+    # full prefix
+    self.ref_cache = {}
+    if id(self.input_tensor) in self.cache_ids:
+      self.ref_cache[id(self.input_tensor)] = self.ref_seq
+    for layer in self.prefix_layers:
+      layer_in = tf.nest.map_structure(lambda t: values[id(t)], layer.input)
+      layer_out = layer(layer_in, training=False)
+      for t, v in zip(tf.nest.flatten(layer.output), tf.nest.flatten(layer_out)):
+        values[id(t)] = v
+        if id(t) in self.cache_ids:
+          self.ref_cache[id(t)] = v[0].numpy()
+
+    # suffix
+    cut_value = self.ref_cache[id(self.cut_tensor)][np.newaxis]
+    self.ref_preds = self.replay_suffix(cut_value)[0]
+
+  def replay_suffix(self, cut_value):
+    """ Run the layers after the 1D prefix on a batch of its outputs. """
+    values = {id(self.cut_tensor): tf.constant(cut_value)}
+    for layer in self.prefix_layers:
+      if isinstance(layer, layers.StochasticReverseComplement):
+        values[id(layer.output[1])] = tf.constant(False)
+
+    for layer in self.suffix_layers:
+      layer_in = tf.nest.map_structure(lambda t: self.suffix_value(values, t), layer.input)
+      layer_out = layer(layer_in, training=False)
+      for t, v in zip(tf.nest.flatten(layer.output), tf.nest.flatten(layer_out)):
+        values[id(t)] = v
+
+    return values[id(self.model.outputs[0])].numpy()
+
+  def suffix_value(self, values, t):
+    if id(t) not in values:
+      raise NotImplementedError('Layers after the 1D prefix read tensor %s from within it' % t.name)
+    return values[id(t)]
+
+  def predict(self, seqs_1hot):
+    """ Predict edited versions of the reference sequence.
+
+    Args:
+      seqs_1hot: [num_seqs, seq_length, 4] one hot sequences, each differing
+                 from the reference over a short interval.
+
+    Returns:
+      preds: [num_seqs, ...] predictions.
+    """
+    if self.ref_seq is None:
+      raise ValueError('Call set_reference before predict.')
+
+    preds = []
+    for bi in range(0, len(seqs_1hot), self.batch_size):
+      seqs_batch = np.asarray(seqs_1hot[bi:bi+self.batch_size], dtype='float32')
+      preds.append(self.predict_batch(seqs_batch))
+    return np.concatenate(preds, axis=0)
+
+  def predict_batch(self, seqs_1hot):
+    """ Predict a batch of edited sequences. """
+    num_seqs = seqs_1hot.shape[0]
+
+    # edit intervals
+    seq_diff = (seqs_1hot != self.ref_seq[np.newaxis]).any(axis=-1)
+    edited = seq_diff.any(axis=-1)
+    preds = np.repeat(self.ref_preds[np.newaxis], num_seqs, axis=0)
+    if not edited.any():
+      return preds
+
+    seqs_1hot = seqs_1hot[edited]
+    seq_diff = seq_diff[edited]
+    diff_start = seq_diff.argmax(axis=1)
+    diff_end = self.seq_length - seq_diff[:,::-1].argmax(axis=1)
+
+    # input window
+    window_len = int((diff_end - diff_start).max())
+    starts = clip_starts(diff_start, window_len, self.seq_length)
+    window_len = min(window_len, self.seq_length)
+    input_vals = np.stack([seqs_1hot[i,s:s+window_len] for i, s in enumerate(starts)])
+    windows = {id(self.input_tensor): (starts, window_len, tf.constant(input_vals))}
+
+    # propagate windows through the prefix
+    for layer in self.prefix_layers:
+      kind = self.layer_kind(layer)
+      if kind == 'reverse':
+        windows[id(layer.output[0])] = windows[id(layer.input)]
+      elif kind == 'pointwise':
+        starts, window_len, vals = windows[id(layer.input)]
+        windows[id(layer.output)] = (starts, window_len, layer(vals, training=False))
+      elif kind == 'conv':
+        windows[id(layer.output)] = self.conv_window(layer, windows[id(layer.input)])
+      elif kind == 'pool':
+        windows[id(layer.output)] = self.pool_window(layer, windows[id(layer.input)])
+      elif kind == 'add':
+        windows[id(layer.output)] = self.add_window(layer, windows)
+
+    # patch 1D output
+    cut_ref = self.ref_cache[id(self.cut_tensor)]
+    starts, window_len, vals = windows[id(self.cut_tensor)]
+    vals = vals.numpy()
+    cut_value = np.repeat(cut_ref[np.newaxis], len(starts), axis=0)
+    for i, s in enumerate(starts):
+      cut_value[i,s:s+window_len] = vals[i]
+
+    preds[edited] = self.replay_suffix(cut_value)
+    return preds
+
+  def gather_input(self, t, window, read_starts, read_len):
+    """ Read [read_start, read_start+read_len) of tensor t for each sequence,
+        from its edit window where available, else from the reference,
+        zero padding beyond the ends. """
+    ref = self.ref_cache[id(t)]
+    length = ref.shape[0]
+    starts, window_len, vals = window
+    vals = np.asarray(vals)
+
+    x = np.zeros((len(read_starts), read_len, ref.shape[-1]), dtype='float32')
+    for i, r in enumerate(read_starts):
+      # reference
+      lo, hi = max(r, 0), min(r + read_len, length)
+      x[i,lo-r:hi-r] = ref[lo:hi]
+
+      # edit window
+      lo, hi = max(r, starts[i]), min(r + read_len, starts[i] + window_len)
+      if hi > lo:
+        x[i,lo-r:hi-r] = vals[i,lo-starts[i]:hi-starts[i]]
+    return x
+
+  def conv_window(self, layer, window):
+    """ Recompute a Conv1D layer's outputs reached by the edit windows. """
+    starts, window_len, _ = window
+    length = layer.input.shape[1]
+
+    dilation = layer.dilation_rate[0]
+    eff_kernel = dilation*(layer.kernel_size[0] - 1) + 1
+    pad_left = (eff_kernel - 1) // 2
+    pad_right = eff_kernel - 1 - pad_left
+
+    # output window
+    out_len = min(window_len + eff_kernel - 1, length)
+    out_starts = clip_starts(starts - pad_right, out_len, length)
+
+    # convolve the input window with its halo
+    x = self.gather_input(layer.input, window, out_starts - pad_left, out_len + eff_kernel - 1)
+    y = tf.nn.convolution(x, layer.kernel, padding='VALID', dilations=dilation)
+    if layer.use_bias:
+      y = tf.nn.bias_add(y, layer.bias)
+    if layer.activation is not None:
+      y = layer.activation(y)
+
+    return out_starts, out_len, y
+
+  def pool_window(self, layer, window):
+    """ Recompute a pooling layer's outputs reached by the edit windows. """
+    starts, window_len, _ = window
+    pool_size = layer.pool_size[0]
+    length = layer.output.shape[1]
+
+    # output window
+    out_starts = starts // pool_size
+    out_ends = -(-(starts + window_len) // pool_size)
+    out_len = min(int((out_ends - out_starts).max()), length)
+    out_starts = clip_starts(out_starts, out_len, length)
+
+    # pool the aligned input window
+    x = self.gather_input(layer.input, window, out_starts*pool_size, out_len*pool_size)
+    x = x.reshape((x.shape[0], out_len, pool_size, x.shape[-1]))
+    if isinstance(layer, tf.keras.layers.MaxPooling1D):
+      y = x.max(axis=2)
+    else:
+      y = x.mean(axis=2)
+
+    return out_starts, out_len, tf.constant(y)
+
+  def add_window(self, layer, windows):
+    """ Recompute an Add layer over the union of its inputs' edit windows. """
+    in_windows = [windows[id(t)] for t in layer.input]
+    length = layer.output.shape[1]
+
+    out_starts = np.min([w[0] for w in in_windows], axis=0)
+    out_ends = np.max([w[0] + w[1] for w in in_windows], axis=0)
+    out_len = min(int((out_ends - out_starts).max()), length)
+    out_starts = clip_starts(out_starts, out_len, length)
+
+    y = 0
+    for t, w in zip(layer.input, in_windows):
+      y += self.gather_input(t, w, out_starts, out_len)
+
+    return out_starts, out_len, tf.constant(y)
+
+
+def clip_starts(starts, window_len, length):
+  """ Clip window starts so that windows lie within [0, length). """
+  return np.clip(np.asarray(starts), 0, max(length - window_len, 0))
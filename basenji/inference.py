@@ -0,0 +1,228 @@
+# Copyright 2023 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import json
+import os
+import time
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+################################################################################
+# inference.py
+#
+# Fixed-shape, optionally XLA compiled, inference for Keras models.
+################################################################################
+
+# compiled models, by Keras model and (batch_size, jit_compile)
+_compiled_cache = weakref.WeakKeyDictionary()
+
+
+def compiled_model(model, batch_size, jit_compile=True, warmup=True, verbose=False):
+  """ Return the cached CompiledModel for model, building it if needed. """
+  model_cache = _compiled_cache.setdefault(model, {})
+  key = (batch_size, jit_compile)
+  if key not in model_cache:
+    model_cache[key] = CompiledModel(model, batch_size, jit_compile=jit_compile,
+                                     warmup=warmup, verbose=verbose)
+  return model_cache[key]
+
+
+class BatchPredictor:
+  """ Predict with predict_fn, a function of one input batch of static
+      shape input_spec, padding every batch, including the final partial
+      one, to batch_size and dropping the padded predictions. """
+  def __init__(self, predict_fn, input_spec, output_shape, verbose=False):
+    self.predict_fn = predict_fn
+    self.input_spec = input_spec
+    self.batch_size = int(input_spec.shape[0])
+    self.output_shape = tuple(output_shape)
+    self.verbose = verbose
+
+    self.compile_time = None
+    self.batch_times = []
+
+  def __call__(self, x):
+    return self.predict(x)
+
+  def predict(self, seq_data, dtype='float32'):
+    """ Predict an array of sequences, a SeqDataset, or a Dataset or
+        iterable of sequence batches (or (sequence, target) batches). """
+    if isinstance(seq_data, np.ndarray) or tf.is_tensor(seq_data):
+      return self.predict_array(np.asarray(seq_data), dtype=dtype)
+
+    dataset = getattr(seq_data, 'dataset', seq_data)
+    preds = []
+    for x in dataset:
+      if isinstance(x, (tuple, list)):
+        x = x[0]
+      preds.append(self.predict_array(np.asarray(x), dtype=dtype))
+    return np.concatenate(preds, axis=0)
+
+  def predict_array(self, seqs, dtype='float32'):
+    """ Predict an array of sequences in fixed-size padded batches. """
+    num_seqs = seqs.shape[0]
+    seqs = seqs.astype(self.input_spec.dtype.as_numpy_dtype, copy=False)
+
+    preds_shape = (num_seqs,) + self.output_shape
+    preds = np.zeros(preds_shape, dtype=dtype)
+
+    for si in range(0, num_seqs, self.batch_size):
+      seqs_batch = seqs[si:si+self.batch_size]
+      batch_len = seqs_batch.shape[0]
+
+      # pad tail batch
+      if batch_len < self.batch_size:
+        pad_shape = (self.batch_size - batch_len,) + seqs.shape[1:]
+        seqs_batch = np.concatenate([seqs_batch, np.zeros(pad_shape, dtype=seqs.dtype)])
+
+      t0 = time.time()
+      preds_batch = self.predict_fn(tf.constant(seqs_batch)).numpy()
+      self.batch_times.append(time.time() - t0)
+
+      # drop padding
+      preds[si:si+batch_len] = preds_batch[:batch_len]
+
+    return preds
+
+  def timings(self):
+    """ Return compile and steady-state timing statistics. """
+    batch_times = np.array(self.batch_times)
+    return {
+      'compile_time': self.compile_time,
+      'batches': len(batch_times),
+      'batch_time_mean': float(batch_times.mean()) if len(batch_times) else None,
+      'seqs_per_second': float(self.batch_size / batch_times.mean()) if len(batch_times) else None
+    }
+
+
+class CompiledModel(BatchPredictor):
+  """ Predict with a single traced function of fixed batch shape.
+
+  Every batch is padded to batch_size, so the model is traced (and XLA
+  compiled with jit_compile) once, at warmup, instead of per new batch
+  shape.
+  """
+  def __init__(self, model, batch_size, jit_compile=True, warmup=True, verbose=False):
+    self.model = model
+    self.jit_compile = jit_compile
+
+    input_shape = (batch_size,) + tuple(model.inputs[0].shape[1:])
+    input_spec = tf.TensorSpec(input_shape, dtype=model.inputs[0].dtype)
+    predict_fn = tf.function(self.call_model, jit_compile=jit_compile,
+                             input_signature=[input_spec])
+    super().__init__(predict_fn, input_spec, model.outputs[0].shape[1:], verbose=verbose)
+
+    if warmup:
+      self.warmup()
+
+  @property
+  def model(self):
+    """ Keras model, referenced weakly so the cache entry keyed on it
+        is released along with the model. """
+    if self._model_ref is None:
+      return None
+    return self._model_ref()
+
+  @model.setter
+  def model(self, model):
+    self._model_ref = None if model is None else weakref.ref(model)
+
+  def call_model(self, x):
+    return self.model(x, training=False)
+
+  def warmup(self):
+    """ Trace and compile on a batch of zeros, then time a steady-state batch. """
+    x = tf.zeros(self.input_spec.shape, dtype=self.input_spec.dtype)
+
+    t0 = time.time()
+    self.predict_fn(x).numpy()
+    self.compile_time = time.time() - t0
+
+    t0 = time.time()
+    self.predict_fn(x).numpy()
+    steady_time = time.time() - t0
+
+    if self.verbose:
+      print('Compiled batch %d in %.2fs, steady state %.2fs/batch' % \
+            (self.batch_size, self.compile_time, steady_time), flush=True)
+
+
+################################################################################
+# Export
+################################################################################
+EXPORT_META = 'basenji_export.json'
+
+
+def export_model(model, export_dir, batch_size, metadata={}):
+  """ Export a Keras model to a SavedModel whose serving function has
+      a static [batch_size, ...] input signature, for loading with
+      load_exported without rebuilding the model.
+
+  Args:
+    model:      Keras model, e.g. SeqNN.model or SeqNN.ensemble.
+    export_dir: Output SavedModel directory.
+    batch_size: Static batch size.
+    metadata:   Additional JSON-serializable description to store.
+  """
+  input_shape = (batch_size,) + tuple(model.inputs[0].shape[1:])
+  input_spec = tf.TensorSpec(input_shape, dtype=model.inputs[0].dtype, name='sequence')
+
+  # track only variables, so loading skips reviving Keras layers
+  module = tf.Module()
+  module.model_variables = list(model.variables)
+  module.serve = tf.function(lambda x: model(x, training=False),
+                             input_signature=[input_spec])
+  tf.saved_model.save(module, export_dir,
+                      signatures={'serving_default': module.serve})
+
+  # describe inputs and outputs
+  export_meta = dict(metadata)
+  export_meta.update({
+    'batch_size': batch_size,
+    'input_shape': list(input_shape[1:]),
+    'input_dtype': input_spec.dtype.name,
+    'output_shape': list(model.outputs[0].shape[1:]),
+    'output_dtype': model.outputs[0].dtype.name
+  })
+  with open(os.path.join(export_dir, EXPORT_META), 'w') as meta_open:
+    json.dump(export_meta, meta_open, indent=2)
+
+
+def load_exported(export_dir, verbose=False):
+  """ Load a model written by export_model, without building Keras layers. """
+  return ExportedModel(export_dir, verbose=verbose)
+
+
+class ExportedModel(BatchPredictor):
+  """ Predict with the static-shape serving function of an exported model. """
+  def __init__(self, export_dir, verbose=False):
+    self.export_dir = export_dir
+
+    with open(os.path.join(export_dir, EXPORT_META)) as meta_open:
+      self.metadata = json.load(meta_open)
+
+    input_shape = (self.metadata['batch_size'],) + tuple(self.metadata['input_shape'])
+    input_spec = tf.TensorSpec(input_shape, dtype=tf.as_dtype(self.metadata['input_dtype']))
+
+    t0 = time.time()
+    self.saved_model = tf.saved_model.load(export_dir)
+    self.load_time = time.time() - t0
+
+    super().__init__(self.saved_model.serve, input_spec,
+                     self.metadata['output_shape'], verbose=verbose)
+
+    if verbose:
+      print('Loaded %s in %.2fs' % (export_dir, self.load_time), flush=True)
@@ -19,6 +19,8 @@ from typing import Optional, List
 import numpy as np
 import tensorflow as tf
 
+from basenji import triu
+
 ############################################################
 # Basic
 ############################################################
@@ -1094,8 +1096,7 @@ class UpperTri(tf.keras.layers.Layer):
       seq_len = seq_len.value
       output_dim = output_dim.value
 
-    triu_tup = np.triu_indices(seq_len, self.diagonal_offset)
-    triu_index = list(triu_tup[0]+ seq_len*triu_tup[1])
+    triu_index = triu.triu_flat_index_t(seq_len, self.diagonal_offset)
     unroll_repr = tf.reshape(inputs, [-1, seq_len**2, output_dim])
     return tf.gather(unroll_repr, triu_index, axis=1)
 
@@ -1113,6 +1114,28 @@ class Symmetrize2D(tf.keras.layers.Layer):
     x_sym = (x+x_t)/2
     return x_sym
 
+############################################################
+# Input
+############################################################
+
+class IndexOneHot(tf.keras.layers.Layer):
+  """Expand uint8 nucleotide index sequences (N=4) to one hot coding."""
+  def __init__(self, n_uniform=False, **kwargs):
+    super(IndexOneHot, self).__init__(**kwargs)
+    self.n_uniform = n_uniform
+
+  def call(self, seq_index):
+    seq_1hot = tf.one_hot(tf.cast(seq_index, tf.int32), 5, dtype=tf.float32)
+    if self.n_uniform:
+      return seq_1hot[...,:4] + 0.25*seq_1hot[...,4:]
+    else:
+      return seq_1hot[...,:4]
+
+  def get_config(self):
+    config = super().get_config().copy()
+    config['n_uniform'] = self.n_uniform
+    return config
+
 ############################################################
 # Augmentation
 ############################################################
@@ -1203,30 +1226,10 @@ class SwitchReverseTriu(tf.keras.layers.Layer):
     ut_len = x_ut.shape[1]
     if type(ut_len) == tf.compat.v1.Dimension:
       ut_len = ut_len.value
-    seq_len = int(np.sqrt(2*ut_len + 0.25) - 0.5)
-    seq_len += self.diagonal_offset
-
-    # get triu indexes
-    ut_indexes = np.triu_indices(seq_len, self.diagonal_offset)
-    assert(len(ut_indexes[0]) == ut_len)
+    seq_len = triu.triu_matrix_len(ut_len, self.diagonal_offset)
 
-    # construct a ut matrix of ut indexes
-    mat_ut_indexes = np.zeros(shape=(seq_len,seq_len), dtype='int')
-    mat_ut_indexes[ut_indexes] = np.arange(ut_len)
-
-    # make lower diag mask
-    mask_ut = np.zeros(shape=(seq_len,seq_len), dtype='bool')
-    mask_ut[ut_indexes] = True
-    mask_ld = ~mask_ut
-
-    # construct a matrix of symmetric ut indexes
-    mat_indexes = mat_ut_indexes + np.multiply(mask_ld, mat_ut_indexes.T)
-
-    # reverse complement
-    mat_rc_indexes = mat_indexes[::-1,::-1]
-
-    # extract ut order
-    rc_ut_order = mat_rc_indexes[ut_indexes]
+    # reverse complement ut order
+    rc_ut_order = triu.triu_rc_order(seq_len, self.diagonal_offset)
 
     return tf.keras.backend.switch(reverse,
                                    tf.gather(x_ut, rc_ut_order, axis=1),
@@ -1262,6 +1265,98 @@ class EnsembleShift(tf.keras.layers.Layer):
     })
     return config
 
+class EnsembleStack(tf.keras.layers.Layer):
+  """Stack shifts and reverse complements of one hot encoded DNA sequences
+     into the batch dimension, augmentation-major, in the order of
+     EnsembleShift followed by EnsembleReverseComplement."""
+  def __init__(self, shifts=[0], rc=False):
+    super(EnsembleStack, self).__init__()
+    self.shifts = shifts
+    self.rc = rc
+
+  def call(self, seq_1hot):
+    ens_seqs_1hot = []
+    for shift in self.shifts:
+      if shift == 0:
+        sseq_1hot = seq_1hot
+      else:
+        sseq_1hot = shift_sequence(seq_1hot, shift)
+      ens_seqs_1hot.append(sseq_1hot)
+
+      if self.rc:
+        rc_seq_1hot = tf.gather(sseq_1hot, [3, 2, 1, 0], axis=-1)
+        rc_seq_1hot = tf.reverse(rc_seq_1hot, axis=[1])
+        ens_seqs_1hot.append(rc_seq_1hot)
+
+    return tf.concat(ens_seqs_1hot, axis=0)
+
+  def get_config(self):
+    config = super().get_config().copy()
+    config.update({
+      'shifts': self.shifts,
+      'rc': self.rc
+    })
+    return config
+
+class EnsembleUnstack(tf.keras.layers.Layer):
+  """Split EnsembleStack predictions out of the batch dimension,
+     transforming reverse complement predictions back, to return
+     [batch_size, num_augm, ...] predictions."""
+  def __init__(self, num_augm, rc=False, strand_pair=None,
+               preds_triu=False, diagonal_offset=2):
+    super(EnsembleUnstack, self).__init__()
+    self.num_augm = num_augm
+    self.rc = rc
+    self.strand_pair = strand_pair
+    self.preds_triu = preds_triu
+    self.diagonal_offset = diagonal_offset
+
+  def unreverse(self, x):
+    if self.preds_triu:
+      seq_len = triu.triu_matrix_len(x.shape[1], self.diagonal_offset)
+      rc_ut_order = triu.triu_rc_order(seq_len, self.diagonal_offset)
+      return tf.gather(x, rc_ut_order, axis=1)
+
+    xd = len(x.shape)
+    if xd == 3:
+      x = tf.reverse(x, axis=[1])
+    elif xd == 4:
+      x = tf.reverse(x, axis=[1,2])
+    elif xd != 2:
+      raise ValueError('Cannot recognize EnsembleUnstack input dimensions %d.' % xd)
+
+    if self.strand_pair is not None:
+      x = tf.gather(x, self.strand_pair, axis=-1)
+    return x
+
+  def call(self, x):
+    pred_shape = x.shape[1:]
+    batch_size = tf.shape(x)[0] // self.num_augm
+
+    if self.rc:
+      # [num_shifts, 2, batch_size, ...]
+      x = tf.reshape(x, [self.num_augm//2, 2, batch_size] + pred_shape.as_list())
+      x_fwd = x[:,0]
+      x_rev = tf.reshape(x[:,1], [-1] + pred_shape.as_list())
+      x_rev = self.unreverse(x_rev)
+      x_rev = tf.reshape(x_rev, tf.shape(x_fwd))
+      x = tf.stack([x_fwd, x_rev], axis=1)
+
+    # [batch_size, num_augm, ...]
+    x = tf.reshape(x, [self.num_augm, batch_size] + pred_shape.as_list())
+    return tf.transpose(x, [1, 0] + list(range(2, len(pred_shape)+2)))
+
+  def get_config(self):
+    config = super().get_config().copy()
+    config.update({
+      'num_augm': self.num_augm,
+      'rc': self.rc,
+      'strand_pair': self.strand_pair,
+      'preds_triu': self.preds_triu,
+      'diagonal_offset': self.diagonal_offset
+    })
+    return config
+
 class StochasticShift(tf.keras.layers.Layer):
   """Stochastically shift a one hot encoded DNA sequence."""
   def __init__(self, shift_max=0, symmetric=True, pad='uniform'):
@@ -0,0 +1,183 @@
+# Copyright 2023 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+try:
+  from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+  Interpreter = tf.lite.Interpreter
+
+from basenji import inference
+
+################################################################################
+# quantize.py
+#
+# Post-training quantization of Keras models to TFLite for CPU inference.
+################################################################################
+
+QUANT_MODES = ['float16', 'dynamic', 'int8']
+
+
+def quantize_model(model, mode='dynamic', batch_size=1, calib_data=None, calib_seqs=64):
+  """ Quantize a Keras model to a TFLite flatbuffer.
+
+  Args:
+    model:      Keras model, e.g. SeqNN.model.
+    mode:       float16 weights, dynamic range int8 weights, or int8
+                 weights and activations calibrated on calib_data.
+    batch_size: Static batch size of the quantized model.
+    calib_data: SeqDataset, or iterable of (sequence, target) batches,
+                 for int8 calibration.
+    calib_seqs: Number of calibration sequences.
+
+  Returns:
+    tflite_model: Serialized TFLite model.
+  """
+  if mode not in QUANT_MODES:
+    raise ValueError('Quantization mode must be one of %s' % QUANT_MODES)
+
+  input_shape = (batch_size,) + tuple(model.inputs[0].shape[1:])
+  input_spec = tf.TensorSpec(input_shape, dtype=model.inputs[0].dtype)
+  model_fn = tf.function(lambda x: model(x, training=False), input_signature=[input_spec])
+
+  converter = tf.lite.TFLiteConverter.from_concrete_functions(
+    [model_fn.get_concrete_function()], model)
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+  if mode == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+
+  elif mode == 'int8':
+    if calib_data is None:
+      raise ValueError('int8 quantization requires calibration data.')
+    converter.representative_dataset = lambda: calibration_batches(
+      calib_data, batch_size, calib_seqs, input_spec.dtype.as_numpy_dtype)
+
+  return converter.convert()
+
+
+def calibration_batches(calib_data, batch_size, calib_seqs, dtype):
+  """ Yield calibration input batches of batch_size from a dataset. """
+  dataset = getattr(calib_data, 'dataset', calib_data)
+  seqs = []
+  num_seqs = 0
+  for x in dataset:
+    if isinstance(x, (tuple, list)):
+      x = x[0]
+    for seq in np.asarray(x):
+      seqs.append(seq)
+      if len(seqs) == batch_size:
+        yield [np.array(seqs, dtype=dtype)]
+        num_seqs += batch_size
+        seqs = []
+      if num_seqs >= calib_seqs:
+        return
+
+
+class QuantizedModel(inference.BatchPredictor):
+  """ Predict with a TFLite model in padded batches of its static size. """
+  def __init__(self, tflite_model, num_threads=None, verbose=False):
+    if isinstance(tflite_model, str):
+      self.interpreter = Interpreter(model_path=tflite_model, num_threads=num_threads)
+    else:
+      self.interpreter = Interpreter(model_content=tflite_model, num_threads=num_threads)
+    self.interpreter.allocate_tensors()
+
+    input_details = self.interpreter.get_input_details()[0]
+    output_details = self.interpreter.get_output_details()[0]
+    self.input_index = input_details['index']
+    self.output_index = output_details['index']
+
+    input_spec = tf.TensorSpec(tuple(input_details['shape']), dtype=input_details['dtype'])
+    super().__init__(self.invoke, input_spec, output_details['shape'][1:], verbose=verbose)
+
+  def invoke(self, x):
+    self.interpreter.set_tensor(self.input_index, np.asarray(x))
+    self.interpreter.invoke()
+    return tf.constant(self.interpreter.get_tensor(self.output_index))
+
+
+class PearsonR:
+  """ Accumulate per-target Pearson correlation over batches. """
+  def __init__(self):
+    self.count = 0
+    self.sums = None
+
+  def update(self, preds, targets):
+    num_targets = preds.shape[-1]
+    preds = np.reshape(preds, (-1, num_targets)).astype('float64')
+    targets = np.reshape(targets, (-1, num_targets)).astype('float64')
+
+    batch_sums = np.array([preds.sum(axis=0), targets.sum(axis=0),
+                           (preds**2).sum(axis=0), (targets**2).sum(axis=0),
+                           (preds*targets).sum(axis=0)])
+    if self.sums is None:
+      self.sums = batch_sums
+    else:
+      self.sums += batch_sums
+    self.count += preds.shape[0]
+
+  def result(self):
+    sx, sy, sxx, syy, sxy = self.sums
+    n = self.count
+    cov = sxy - sx*sy/n
+    var = np.sqrt((sxx - sx**2/n) * (syy - sy**2/n))
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return cov / var
+
+
+def accuracy_report(model, quant_model, seq_data, max_batches=None):
+  """ Compare per-target Pearson R of float32 and quantized predictions.
+
+  Args:
+    model:       Float32 Keras model.
+    quant_model: QuantizedModel.
+    seq_data:    SeqDataset, or iterable of (sequence, target) batches.
+    max_batches: Optional number of batches to evaluate.
+
+  Returns:
+    report_df:   DataFrame with per-target Pearson R of float32 and quantized
+                 predictions against targets, their difference, and the
+                 Pearson R between float32 and quantized predictions.
+  """
+  dataset = getattr(seq_data, 'dataset', seq_data)
+
+  float_r = PearsonR()
+  quant_r = PearsonR()
+  agree_r = PearsonR()
+
+  for bi, (x, y) in enumerate(dataset):
+    if max_batches is not None and bi >= max_batches:
+      break
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    preds_float = model(x, training=False).numpy()
+    preds_quant = quant_model.predict(x)
+
+    float_r.update(preds_float, y)
+    quant_r.update(preds_quant, y)
+    agree_r.update(preds_quant, preds_float)
+
+  report_df = pd.DataFrame({
+    'target': np.arange(len(float_r.result())),
+    'pearsonr_float': float_r.result(),
+    'pearsonr_quant': quant_r.result()
+  })
+  report_df['pearsonr_delta'] = report_df.pearsonr_quant - report_df.pearsonr_float
+  report_df['pearsonr_float_quant'] = agree_r.result()
+  return report_df
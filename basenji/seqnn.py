@@ -23,8 +23,10 @@ import numpy as np
 import tensorflow as tf
 
 from basenji import blocks
+from basenji import inference
 from basenji import layers
 from basenji import metrics
+from basenji import tiled2d
 
 class SeqNN():
 
@@ -34,6 +36,9 @@ class SeqNN():
       self.__setattr__(key, value)
     self.build_model()
     self.ensemble = None
+    self.ensemble_augm = None
+    self.compiled = None
+    self.tiled = None
 
   def set_defaults(self):
     # only necessary for my bespoke parameters
@@ -176,6 +181,9 @@ class SeqNN():
     self.model = self.models[0]
     if self.verbose: print(self.model.summary())
 
+    # all heads from one trunk pass
+    self.model_heads = tf.keras.Model(inputs=sequence, outputs=self.head_output)
+
     ###################################################
     # track pooling/striding and cropping
     ###################################################
@@ -209,6 +217,44 @@ class SeqNN():
       print('target_crops', self.target_crops)
 
 
+  def build_compiled(self, batch_size, head_i=None, jit_compile=True, warmup=True):
+    """ Build a fixed batch shape, XLA compiled inference function
+        for the current model, reusing previously compiled ones.
+
+    Returns:
+      compiled: inference.CompiledModel, also kept as self.compiled.
+    """
+    # choose model
+    if self.ensemble is not None:
+      model = self.ensemble
+    elif head_i is not None:
+      model = self.models[head_i]
+    else:
+      model = self.model
+
+    self.compiled = inference.compiled_model(model, batch_size,
+                                             jit_compile=jit_compile, warmup=warmup,
+                                             verbose=self.verbose)
+    return self.compiled
+
+
+  def build_tiled(self, tile_size=128, batch_size=1, head_i=None):
+    """ Build a tiled, memory-bounded executor of the 2D stage
+        for the current model.
+
+    Returns:
+      tiled: tiled2d.Tiled2DModel, also kept as self.tiled.
+    """
+    # choose model
+    if head_i is not None:
+      model = self.models[head_i]
+    else:
+      model = self.model
+
+    self.tiled = tiled2d.Tiled2DModel(model, tile_size=tile_size, batch_size=batch_size)
+    return self.tiled
+
+
   def build_embed(self, conv_layer_i, batch_norm=True):
     if conv_layer_i == -1:
       self.model = self.model_trunk
@@ -223,11 +269,39 @@ class SeqNN():
                                   outputs=conv_layer.output)
 
 
-  def build_ensemble(self, ensemble_rc=False, ensemble_shifts=[0]):
-    """ Build ensemble of models computing on augmented input sequences. """
+  def build_ensemble(self, ensemble_rc=False, ensemble_shifts=[0], batched=False):
+    """ Build ensemble of models computing on augmented input sequences.
+
+    With batched, the augmentations are stacked into the batch dimension
+    and predicted in a single pass of the model, and ensemble_augm
+    additionally returns the [batch, augmentation, ...] predictions. """
     if ensemble_rc or len(ensemble_shifts) > 1:
       # sequence input
       sequence = tf.keras.Input(shape=(self.seq_length, 4), name='sequence')
+
+      if len(self.strand_pair) == 0:
+        strand_pair = None
+      else:
+        strand_pair = self.strand_pair[0]
+
+      if batched:
+        # stack augmentations, predict, and unstack
+        num_augm = len(ensemble_shifts) * (1 + int(ensemble_rc))
+        if self.preds_triu:
+          unstack = layers.EnsembleUnstack(num_augm, ensemble_rc, preds_triu=True,
+                                           diagonal_offset=self.diagonal_offset)
+        else:
+          unstack = layers.EnsembleUnstack(num_augm, ensemble_rc, strand_pair)
+
+        sequences = layers.EnsembleStack(ensemble_shifts, ensemble_rc)(sequence)
+        preds = unstack(self.model(sequences))
+
+        # create meta models
+        self.ensemble_augm = tf.keras.Model(inputs=sequence, outputs=preds)
+        preds_avg = tf.reduce_mean(preds, axis=1)
+        self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_avg)
+        return
+
       sequences = [sequence]
 
       if len(ensemble_shifts) > 1:
@@ -240,11 +314,6 @@ class SeqNN():
       else:
         sequences_rev = [(seq,tf.constant(False)) for seq in sequences]
 
-      if len(self.strand_pair) == 0:
-        strand_pair = None
-      else:
-        strand_pair = self.strand_pair[0]
-
       # predict each sequence
       if self.preds_triu:
         preds = [layers.SwitchReverseTriu(self.diagonal_offset)
@@ -259,6 +328,35 @@ class SeqNN():
       self.ensemble = tf.keras.Model(inputs=sequence, outputs=preds_avg)
 
 
+  def build_index(self, n_uniform=False, head_i=None):
+    """ Accept uint8 nucleotide index sequences (N=4), expanding
+        to one hot coding on device in the input layer. Call after
+        the other build_* methods, which expect one hot inputs. """
+    # choose model
+    if self.ensemble is not None:
+      model = self.ensemble
+    elif head_i is not None:
+      model = self.models[head_i]
+    else:
+      model = self.model
+
+    # index input
+    sequence = tf.keras.Input(shape=(self.seq_length,), dtype='uint8', name='sequence')
+
+    # expand and predict
+    seq_1hot = layers.IndexOneHot(n_uniform)(sequence)
+    preds = model(seq_1hot)
+    model_index = tf.keras.Model(inputs=sequence, outputs=preds)
+
+    # replace model
+    if self.ensemble is not None:
+      self.ensemble = model_index
+    elif head_i is not None:
+      self.models[head_i] = model_index
+    else:
+      self.model = model_index
+
+
   def build_sad(self):
     # sequence input
     sequence = tf.keras.Input(shape=(self.seq_length, 4), name='sequence')
@@ -808,6 +906,60 @@ class SeqNN():
       self.model = self.models[head_i]
 
 
+  def restore_heads(self, model_files):
+    """ Restore the weights of all heads from their saved models,
+        e.g. model0_best.h5 and model1_best.h5 of a multi-head run.
+
+    Args:
+      model_files: List of saved models, one per head, or dict
+                   mapping head index to saved model.
+
+    Raises:
+      ValueError: The saved models do not share trunk weights; the
+                  model's weights are left as they were.
+    """
+    if not isinstance(model_files, dict):
+      model_files = dict(enumerate(model_files))
+
+    # snapshot all heads and the trunk, to undo a failed restore
+    heads_weights = self.model_heads.get_weights()
+
+    trunk_weights = None
+    for head_i, model_file in model_files.items():
+      self.models[head_i].load_weights(model_file)
+
+      # heads share one trunk, so all files must hold the same trunk
+      head_trunk_weights = self.model_trunk.get_weights()
+      if trunk_weights is not None:
+        trunk_match = all(np.array_equal(tw, htw) for tw, htw
+                          in zip(trunk_weights, head_trunk_weights))
+        if not trunk_match:
+          self.model_heads.set_weights(heads_weights)
+          raise ValueError('%s trunk weights differ from previously restored heads; ' \
+                           'restore separately trained models into separate SeqNNs.' % model_file)
+      trunk_weights = head_trunk_weights
+
+    self.model = self.models[min(model_files)]
+
+
+  def predict_all_heads(self, seq_data, dtype='float32', **kwargs):
+    """ Predict targets for SeqDataset from all heads,
+        running the trunk once per sequence.
+
+    Returns:
+      preds: Dict mapping head index to predictions.
+    """
+    dataset = getattr(seq_data, 'dataset', None)
+    if dataset is None:
+      dataset = seq_data
+
+    preds = self.model_heads.predict(dataset, **kwargs)
+    if len(self.models) == 1:
+      preds = [preds]
+
+    return {hi: hp.astype(dtype) for hi, hp in enumerate(preds)}
+
+
   def save(self, model_file, trunk=False):
     if trunk:
       self.model_trunk.save(model_file, include_optimizer=False)
@@ -14,7 +14,10 @@
 # =========================================================================
 from __future__ import print_function
 import pdb
+import queue
+import threading
 
+import h5py
 import numpy as np
 import tensorflow as tf
 
@@ -24,18 +27,30 @@ from basenji import dna_io
 class PredStreamGen:
   """ Interface to acquire predictions via a buffered stream mechanism
         rather than getting them all at once and using excessive memory.
-        Accepts generator and constructs stream batches from it. """
-  def __init__(self, model, seqs_gen, batch_size, stream_seqs=32, verbose=False):
+        Accepts generator and constructs stream batches from it.
+        The generator may yield (L,4) one hot or compact (L,) uint8
+        index sequences; the latter need a model from SeqNN.build_index.
+        With prefetch > 0, a background thread builds up to prefetch
+        stream chunks ahead while the model predicts the current one. """
+  def __init__(self, model, seqs_gen, batch_size, stream_seqs=32,
+               prefetch=0, verbose=False):
     self.model = model
     self.seqs_gen = seqs_gen
     self.stream_seqs = stream_seqs
     self.batch_size = batch_size
+    self.prefetch = prefetch
     self.verbose = verbose
 
     self.stream_start = 0
     self.stream_end = 0
     self.stream_preds = []
 
+    # background producer
+    self.producer = None
+    self.producer_queue = None
+    self.producer_stop = threading.Event()
+    self.producer_done = False
+
 
   def __getitem__(self, i):
     # acquire predictions, if needed
@@ -57,19 +72,209 @@ class PredStreamGen:
 
   def make_dataset(self):
     """ Construct Dataset object for this stream chunk. """
+    if self.prefetch > 0:
+      seqs_1hot = self.next_prefetched()
+    else:
+      seqs_1hot = self.next_seqs()
+
+    dataset = tf.data.Dataset.from_tensor_slices((seqs_1hot,))
+    dataset = dataset.batch(self.batch_size)
+    return dataset
+
+  def next_seqs(self):
+    """ Construct array of sequences for the next stream chunk. """
     seqs_1hot = []
-    stream_end = self.stream_start+self.stream_seqs
-    for si in range(self.stream_start, stream_end):
+    for si in range(self.stream_seqs):
       try:
         seqs_1hot.append(self.seqs_gen.__next__())
       except StopIteration:
+        break
+
+    return np.array(seqs_1hot)
+
+  def next_prefetched(self):
+    """ Take the next stream chunk from the background producer. """
+    if self.producer is None:
+      self.producer_queue = queue.Queue(maxsize=self.prefetch)
+      self.producer = threading.Thread(target=self.produce, daemon=True)
+      self.producer.start()
+
+    if self.producer_done:
+      return np.array([])
+
+    seqs_1hot = self.producer_queue.get()
+    if seqs_1hot is None:
+      self.producer_done = True
+      return np.array([])
+    elif isinstance(seqs_1hot, BaseException):
+      self.producer_done = True
+      raise seqs_1hot
+
+    return seqs_1hot
+
+  def produce(self):
+    """ Fill the queue with stream chunks, blocking while it is full. """
+    try:
+      while not self.producer_stop.is_set():
+        seqs_1hot = self.next_seqs()
+        if len(seqs_1hot) > 0:
+          self.produce_put(seqs_1hot)
+        if len(seqs_1hot) < self.stream_seqs:
+          break
+      self.produce_put(None)
+    except BaseException as e:
+      self.produce_put(e)
+
+  def produce_put(self, item):
+    """ Put an item on the queue, giving up once the stream is closed. """
+    while not self.producer_stop.is_set():
+      try:
+        self.producer_queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
         continue
 
-    seqs_1hot = np.array(seqs_1hot)
+  def close(self):
+    """ Stop the background producer. """
+    if self.producer is not None:
+      self.producer_stop.set()
+      self.producer.join()
+      self.producer = None
+
+
+class PredStreamH5:
+  """ Streaming sink writing predictions chunk by chunk to a chunked,
+        compressed HDF5 file, so that long runs need not hold all
+        predictions in memory and can resume after a crash.
+
+        Rows are split into chunks of chunk_seqs sequences. A chunk's
+        predictions and row ids are written and flushed before its
+        chunk_done flag is set, so chunks may be completed in any order
+        and an interrupted run only repeats its unfinished chunks.
+        Reading is lazy: indexing and iter_chunks only load the
+        requested rows. """
+  def __init__(self, h5_file, num_seqs=None, pred_shape=None, chunk_seqs=None,
+               float16=False, compression='gzip', mode='a'):
+    self.h5_file = h5_file
+    self.h5_open = h5py.File(h5_file, mode)
+
+    if 'preds' in self.h5_open:
+      # resume
+      self.preds = self.h5_open['preds']
+      self.row_ids = self.h5_open['row_ids']
+      self.chunk_done = self.h5_open['chunk_done']
+      self.chunk_seqs = int(self.h5_open.attrs['chunk_seqs'])
+      self.num_seqs = self.preds.shape[0]
+
+      if num_seqs is not None and num_seqs != self.num_seqs:
+        raise ValueError('%s holds %d sequences, not %d' % \
+                         (h5_file, self.num_seqs, num_seqs))
+      if pred_shape is not None and tuple(pred_shape) != self.preds.shape[1:]:
+        raise ValueError('%s holds predictions of shape %s, not %s' % \
+                         (h5_file, self.preds.shape[1:], tuple(pred_shape)))
+      if chunk_seqs is not None and chunk_seqs != self.chunk_seqs:
+        raise ValueError('%s holds chunks of %d sequences, not %d' % \
+                         (h5_file, self.chunk_seqs, chunk_seqs))
+
+    else:
+      if num_seqs is None or pred_shape is None:
+        raise ValueError('num_seqs and pred_shape are required to create %s' % h5_file)
+      self.num_seqs = num_seqs
+      self.chunk_seqs = 32 if chunk_seqs is None else chunk_seqs
+      num_chunks = -(-num_seqs // self.chunk_seqs)
+
+      pred_shape = tuple(pred_shape)
+      self.preds = self.h5_open.create_dataset('preds',
+        shape=(num_seqs,)+pred_shape,
+        dtype='float16' if float16 else 'float32',
+        chunks=(min(self.chunk_seqs, max(num_seqs,1)),)+pred_shape,
+        compression=compression)
+      self.row_ids = self.h5_open.create_dataset('row_ids',
+        data=np.arange(num_seqs, dtype='int64'))
+      self.chunk_done = self.h5_open.create_dataset('chunk_done',
+        data=np.zeros(num_chunks, dtype='bool'))
+      self.h5_open.attrs['chunk_seqs'] = self.chunk_seqs
+      self.h5_open.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self.num_seqs
 
-    dataset = tf.data.Dataset.from_tensor_slices((seqs_1hot,))
-    dataset = dataset.batch(self.batch_size)
-    return dataset
+  def __getitem__(self, i):
+    return self.preds[i]
+
+  @property
+  def num_chunks(self):
+    return self.chunk_done.shape[0]
+
+  def chunk_rows(self, ci):
+    """ Return the (start, end) rows of chunk ci. """
+    row_start = ci*self.chunk_seqs
+    row_end = min(row_start + self.chunk_seqs, self.num_seqs)
+    return row_start, row_end
+
+  def pending_chunks(self):
+    """ Return the indexes of chunks not yet completed. """
+    return np.nonzero(~self.chunk_done[:])[0].tolist()
+
+  def done(self):
+    return bool(self.chunk_done[:].all())
+
+  def write_chunk(self, ci, chunk_preds, chunk_row_ids=None):
+    """ Write the predictions (and optional row ids) of chunk ci,
+        then mark it completed. """
+    row_start, row_end = self.chunk_rows(ci)
+    if chunk_preds.shape[0] != row_end - row_start:
+      raise ValueError('Chunk %d expects %d predictions, not %d' % \
+                       (ci, row_end - row_start, chunk_preds.shape[0]))
+
+    self.preds[row_start:row_end] = chunk_preds
+    if chunk_row_ids is not None:
+      self.row_ids[row_start:row_end] = chunk_row_ids
+    self.h5_open.flush()
+
+    self.chunk_done[ci] = True
+    self.h5_open.flush()
+
+  def write_stream(self, model, seqs_fn, batch_size, verbose=False):
+    """ Predict and write all pending chunks.
+
+    Args:
+      model:      Keras model.
+      seqs_fn:    Function mapping a (row_start, row_end) range to the
+                   array of its sequences, or to a (sequences, row_ids) tuple.
+      batch_size: Prediction batch size.
+    """
+    for ci in self.pending_chunks():
+      row_start, row_end = self.chunk_rows(ci)
+      if verbose:
+        print('Predicting %d-%d' % (row_start, row_end), flush=True)
+
+      seqs_1hot = seqs_fn(row_start, row_end)
+      chunk_row_ids = None
+      if isinstance(seqs_1hot, tuple):
+        seqs_1hot, chunk_row_ids = seqs_1hot
+
+      chunk_preds = model.predict(seqs_1hot, batch_size=batch_size, verbose=0)
+      self.write_chunk(ci, chunk_preds, chunk_row_ids)
+
+  def iter_chunks(self, completed=True):
+    """ Lazily yield (row_ids, predictions) for each chunk,
+        by default only those completed. """
+    chunk_done = self.chunk_done[:]
+    for ci in range(self.num_chunks):
+      if completed and not chunk_done[ci]:
+        continue
+      row_start, row_end = self.chunk_rows(ci)
+      yield self.row_ids[row_start:row_end], self.preds[row_start:row_end]
+
+  def close(self):
+    self.h5_open.close()
 
 
 class PredStreamIter:
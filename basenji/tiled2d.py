@@ -0,0 +1,525 @@
+# Copyright 2023 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+import numpy as np
+import tensorflow as tf
+
+from basenji import incremental
+from basenji import layers
+from basenji import triu
+
+################################################################################
+# tiled2d.py
+#
+# Memory-bounded execution of the 2D stage of Akita models. The layers
+# after OneToTwo are evaluated over square tiles of the contact map, each
+# with the halo its convolutions read, so no full [seq_len, seq_len] map
+# is ever materialized. Maps that Symmetrize2D makes symmetric are computed
+# and stored only on tiles on and above the diagonal; other maps are stored
+# as all of their tiles. The UpperTri output is gathered directly from the
+# tiles, so peak memory is bounded by two stored maps and the tile regions
+# rather than by the Keras graph's full size activations.
+################################################################################
+
+
+class Tiled2DModel:
+  """ Predict with the 2D stage of a model evaluated in tiles.
+
+  The layers before OneToTwo run as a Keras model. The 2D layers after it
+  are grouped into segments of pointwise, ConcatDist2D, Conv2D and Add
+  layers, each ending at a Symmetrize2D, SqueezeExcite, Cropping2D or
+  UpperTri layer. A segment is evaluated tile by tile on the padded region
+  of its input map that its convolutions read, i.e. the tile plus the
+  summed dilation halos of its Conv2D layers. Symmetrize2D averages the
+  segment's output on a tile with its output on the transposed tile, so
+  the result is symmetric and only upper tiles are computed. Segments
+  whose output is not known to be symmetric, e.g. after a 'concat'
+  OneToTwo or convolutions without Symmetrize2D, are computed on all
+  tiles. SqueezeExcite averages its activations over the stored tiles,
+  counting mirrored tiles twice. Layers after UpperTri are replayed on
+  its output.
+
+  Outputs match the full model up to float32 summation order. Other 2D
+  layers raise NotImplementedError.
+  """
+  def __init__(self, model, tile_size=128, batch_size=1):
+    self.model = model
+    self.tile_size = tile_size
+    self.batch_size = batch_size
+
+    self.one_to_two = None
+    self.post_layers = []
+    self.reverse_tensors = []
+    self.stages = []
+    self.split_layers()
+
+    self.triu_tiles_cache = {}
+    self.max_map_bytes = 0
+
+  def split_layers(self):
+    """ Split model layers into the 1D trunk, 2D stages, and the layers
+        after UpperTri. """
+    twod_layers = []
+    for layer in self.model.layers:
+      if isinstance(layer, tf.keras.layers.InputLayer):
+        continue
+      elif self.one_to_two is None:
+        if isinstance(layer, layers.OneToTwo):
+          self.one_to_two = layer
+        elif isinstance(layer, layers.StochasticReverseComplement):
+          self.reverse_tensors.append(layer.output[1])
+      elif not self.post_layers and not isinstance(layer, layers.UpperTri):
+        twod_layers.append(layer)
+      else:
+        self.post_layers.append(layer)
+
+    if self.one_to_two is None:
+      raise NotImplementedError('Model %s has no OneToTwo layer' % self.model.name)
+    if not self.post_layers:
+      raise NotImplementedError('Model %s has no UpperTri layer' % self.model.name)
+    self.upper_tri = self.post_layers.pop(0)
+
+    self.trunk_model = tf.keras.Model(inputs=self.model.inputs,
+                                      outputs=self.one_to_two.input)
+
+    # group 2D layers into stages
+    segment_layers = []
+    map_tensor = self.one_to_two.output
+    for layer in twod_layers + [self.upper_tri]:
+      if isinstance(layer, layers.Symmetrize2D):
+        segment = Segment(map_tensor, segment_layers, layer.input, symmetrize=True)
+        self.stages.append(('segment', segment))
+        segment_layers = []
+        map_tensor = layer.output
+
+      elif isinstance(layer, (layers.SqueezeExcite, tf.keras.layers.Cropping2D, layers.UpperTri)):
+        if segment_layers:
+          segment = Segment(map_tensor, segment_layers, layer.input, symmetrize=False)
+          self.stages.append(('segment', segment))
+          segment_layers = []
+        elif layer.input is not map_tensor:
+          raise NotImplementedError('2D layer %s reads an unsupported tensor' % layer.name)
+
+        if isinstance(layer, layers.SqueezeExcite):
+          self.stages.append(('squeeze', layer))
+        elif isinstance(layer, tf.keras.layers.Cropping2D):
+          self.stages.append(('crop', layer))
+        map_tensor = layer.output
+
+      else:
+        segment_layers.append(layer)
+
+  def predict(self, seqs_1hot):
+    """ Predict sequences in batches of batch_size.
+
+    Args:
+      seqs_1hot: [num_seqs, seq_length, 4] one hot sequences.
+
+    Returns:
+      preds: [num_seqs, ...] predictions, matching model.predict.
+    """
+    preds = []
+    for bi in range(0, len(seqs_1hot), self.batch_size):
+      seqs_batch = np.asarray(seqs_1hot[bi:bi+self.batch_size], dtype='float32')
+      preds.append(self.predict_batch(seqs_batch))
+    return np.concatenate(preds, axis=0)
+
+  def predict_batch(self, seqs_1hot):
+    """ Predict a batch of sequences. """
+    oned = self.trunk_model(seqs_1hot, training=False).numpy()
+    twod = OneToTwoMap(oned, self.one_to_two.operation)
+
+    for kind, stage in self.stages:
+      if kind == 'segment':
+        twod = self.run_segment(stage, twod)
+      elif kind == 'squeeze':
+        twod = self.run_squeeze(stage, twod)
+      elif kind == 'crop':
+        twod = self.run_crop(stage, twod)
+
+    preds_ut = self.run_upper_tri(self.upper_tri, twod)
+    return self.replay_post(preds_ut)
+
+  def run_segment(self, segment, source):
+    """ Evaluate a segment on the tiles of its output map, only upper
+        tiles when the output is symmetric. """
+    symmetric = segment.symmetrize or (source.symmetric and not segment.has_conv)
+    out = TileMap(source.batch, source.size, segment.channels, self.tile_size, symmetric)
+    for ti, tj in out.tile_keys():
+      r0, r1 = out.tile_bounds(ti)
+      c0, c1 = out.tile_bounds(tj)
+      y = segment.evaluate(source, r0, r1, c0, c1)
+
+      if segment.symmetrize:
+        if ti == tj:
+          y_t = y
+        else:
+          y_t = segment.evaluate(source, c0, c1, r0, r1)
+        y = (y + np.transpose(y_t, [0,2,1,3])) / 2
+
+      out.set_tile(ti, tj, y)
+
+    self.max_map_bytes = max(self.max_map_bytes, out.nbytes())
+    return out
+
+  def run_squeeze(self, layer, source):
+    """ Apply SqueezeExcite, averaging its activations over tiles. """
+    grid = TileMap(source.batch, source.size, source.channels, self.tile_size, source.symmetric)
+    squeeze = np.zeros((source.batch, source.channels), dtype='float64')
+    for ti, tj in grid.tile_keys():
+      r0, r1 = grid.tile_bounds(ti)
+      c0, c1 = grid.tile_bounds(tj)
+      x = layers.activate(tf.constant(source.region(r0, r1, c0, c1)), layer.activation)
+      weight = 1 if ti == tj or not source.symmetric else 2
+      squeeze += weight * tf.reduce_sum(tf.cast(x, tf.float64), axis=[1,2]).numpy()
+    squeeze = tf.constant(squeeze / source.size**2, dtype=tf.float32)
+
+    excite = layer.dense1(squeeze)
+    excite = layer.dense2(excite)
+    if layer.norm is not None:
+      excite = layer.norm(excite, training=False)
+    excite = tf.reshape(excite, [-1,1,1,layer.num_channels])
+    if not layer.additive:
+      excite = tf.keras.activations.sigmoid(excite)
+
+    def squeeze_excite(x):
+      x = layers.activate(tf.constant(x), layer.activation)
+      if layer.additive:
+        return (x + excite).numpy()
+      else:
+        return (x * excite).numpy()
+
+    return PointwiseMap(source, squeeze_excite)
+
+  def run_crop(self, layer, source):
+    """ Crop a map to a square map. """
+    (top, bottom), (left, right) = layer.cropping
+    if top + bottom != left + right:
+      raise NotImplementedError('Cropping2D %s must crop a square map' % layer.name)
+    return CropMap(source, top, left, source.size - top - bottom)
+
+  def run_upper_tri(self, layer, source):
+    """ Gather the UpperTri output directly from tiles.
+
+    UpperTri reads entry [col, row] for each upper triangular (row, col),
+    so entries come from upper tiles of symmetric maps and lower tiles
+    of the others.
+    """
+    ut_len = triu.triu_len(source.size, layer.diagonal_offset)
+    preds_ut = np.zeros((source.batch, ut_len, source.channels), dtype='float32')
+    triu_tiles = self.triu_tiles(source.size, layer.diagonal_offset, lower=not source.symmetric)
+    for r0, r1, c0, c1, ut_index, rows, cols in triu_tiles:
+      x = source.region(r0, r1, c0, c1)
+      preds_ut[:,ut_index] = x[:,rows,cols]
+    return preds_ut
+
+  def triu_tiles(self, matrix_len, diagonal_offset, lower=False):
+    """ Group upper triangular entries, or their lower triangular
+        mirrors, by the tile holding them.
+
+    Returns:
+      [(r0, r1, c0, c1, ut_index, rows, cols)] with the tile bounds, the
+      entries' UpperTri indexes, and their rows and columns in the tile.
+    """
+    key = (matrix_len, diagonal_offset, lower)
+    if key in self.triu_tiles_cache:
+      return self.triu_tiles_cache[key]
+
+    rows, cols = triu.triu_indices(matrix_len, diagonal_offset)
+    if lower:
+      rows, cols = cols, rows
+    grid = TileMap(1, matrix_len, 1, self.tile_size, symmetric=False)
+    tile_rows = rows // self.tile_size
+    tile_cols = cols // self.tile_size
+
+    tiles = []
+    for ti, tj in grid.tile_keys():
+      ut_index = np.nonzero((tile_rows == ti) & (tile_cols == tj))[0]
+      if len(ut_index) > 0:
+        r0, r1 = grid.tile_bounds(ti)
+        c0, c1 = grid.tile_bounds(tj)
+        tiles.append((r0, r1, c0, c1, ut_index, rows[ut_index]-r0, cols[ut_index]-c0))
+
+    self.triu_tiles_cache[key] = tiles
+    return tiles
+
+  def replay_post(self, preds_ut):
+    """ Run the layers after UpperTri on its output. """
+    values = {id(self.upper_tri.output): tf.constant(preds_ut)}
+    for t in self.reverse_tensors:
+      values[id(t)] = tf.constant(False)
+
+    for layer in self.post_layers:
+      layer_in = tf.nest.map_structure(lambda t: values[id(t)], layer.input)
+      layer_out = layer(layer_in, training=False)
+      for t, v in zip(tf.nest.flatten(layer.output), tf.nest.flatten(layer_out)):
+        values[id(t)] = v
+
+    return values[id(self.model.outputs[0])].numpy()
+
+
+class Segment:
+  """ Pointwise, ConcatDist2D, Conv2D and Add layers evaluated together
+      on tiles of a 2D map.
+
+  Args:
+    source:     Input map tensor.
+    seg_layers: Layers, in topological order.
+    output:     Output tensor.
+    symmetrize: Whether a Symmetrize2D follows output.
+  """
+  def __init__(self, source, seg_layers, output, symmetrize):
+    self.source = source
+    self.layers = seg_layers
+    self.output = output
+    self.symmetrize = symmetrize
+    self.channels = output.shape[-1]
+
+    self.kinds = [self.layer_kind(layer) for layer in seg_layers]
+    self.has_conv = 'conv' in self.kinds
+
+    # check that layers read only the source or segment tensors
+    known = {id(source)}
+    for layer in seg_layers:
+      for t in tf.nest.flatten(layer.input):
+        if id(t) not in known:
+          raise NotImplementedError('2D layer %s reads a tensor from before its segment' % layer.name)
+      known.add(id(layer.output))
+    if id(output) not in known:
+      raise NotImplementedError('2D segment does not compute %s' % output.name)
+
+    # halos each tensor is needed with, from the output backwards
+    self.halos = {id(output): 0}
+    for layer, kind in zip(reversed(seg_layers), reversed(self.kinds)):
+      out_halo = self.halos.get(id(layer.output), 0)
+      in_halo = out_halo + max(self.conv_halo(layer)) if kind == 'conv' else out_halo
+      for t in tf.nest.flatten(layer.input):
+        self.halos[id(t)] = max(self.halos.get(id(t), 0), in_halo)
+
+  def layer_kind(self, layer):
+    """ Classify a segment layer by how it is evaluated on tiles. """
+    if isinstance(layer, incremental.POINTWISE_LAYERS):
+      return 'pointwise'
+    elif type(layer).__name__ == 'TFOpLambda' and layer.symbol in incremental.POINTWISE_OPS:
+      return 'pointwise'
+    elif isinstance(layer, layers.ConcatDist2D):
+      return 'dist'
+    elif type(layer) == tf.keras.layers.Conv2D:
+      if layer.strides != (1,1) or layer.padding != 'same' or layer.groups != 1:
+        raise NotImplementedError('Conv2D %s must have stride 1, same padding and one group' % layer.name)
+      if layer.kernel_size[0] % 2 == 0 or layer.kernel_size[1] % 2 == 0:
+        raise NotImplementedError('Conv2D %s must have odd kernel sizes' % layer.name)
+      return 'conv'
+    elif isinstance(layer, tf.keras.layers.Add):
+      return 'add'
+    else:
+      raise NotImplementedError('Tiled 2D execution does not support layer %s (%s)' % \
+                                (layer.name, type(layer).__name__))
+
+  def conv_halo(self, layer):
+    """ Rows and columns a Conv2D output reads on each side. """
+    return tuple(d*(k-1)//2 for k, d in zip(layer.kernel_size, layer.dilation_rate))
+
+  def evaluate(self, source, r0, r1, c0, c1):
+    """ Evaluate the segment output on rows [r0,r1) and columns [c0,c1).
+
+    Args:
+      source: Map of the segment input.
+
+    Returns:
+      y:      [batch, r1-r0, c1-c0, channels] array.
+    """
+    size = source.size
+    halo = self.halos[id(self.source)]
+    x = source.region(r0-halo, r1+halo, c0-halo, c1+halo)
+    values = {id(self.source): (halo, tf.constant(x))}
+
+    for layer, kind in zip(self.layers, self.kinds):
+      out_halo = self.halos.get(id(layer.output), 0)
+
+      if kind == 'pointwise':
+        in_halo, x = values[id(layer.input)]
+        values[id(layer.output)] = (in_halo, layer(x, training=False))
+
+      elif kind == 'dist':
+        in_halo, x = values[id(layer.input)]
+        rows = np.arange(r0-in_halo, r1+in_halo)
+        cols = np.arange(c0-in_halo, c1+in_halo)
+        dist = np.abs(rows[:,np.newaxis] - cols[np.newaxis,:]).astype('float32')
+        dist = np.broadcast_to(dist[np.newaxis,:,:,np.newaxis], tuple(x.shape[:3]) + (1,))
+        values[id(layer.output)] = (in_halo, tf.concat([x, dist], axis=-1))
+
+      elif kind == 'conv':
+        in_halo, x = values[id(layer.input)]
+        halo_r, halo_c = self.conv_halo(layer)
+        x = crop_halo(x, in_halo, out_halo + halo_r, out_halo + halo_c)
+
+        # zero padding beyond the map
+        mask = region_mask(r0-out_halo-halo_r, r1+out_halo+halo_r,
+                           c0-out_halo-halo_c, c1+out_halo+halo_c, size)
+        x = x * mask
+
+        y = tf.nn.convolution(x, layer.kernel, padding='VALID', dilations=layer.dilation_rate)
+        if layer.use_bias:
+          y = tf.nn.bias_add(y, layer.bias)
+        if layer.activation is not None:
+          y = layer.activation(y)
+        values[id(layer.output)] = (out_halo, y)
+
+      elif kind == 'add':
+        y = 0
+        for t in layer.input:
+          in_halo, x = values[id(t)]
+          y += crop_halo(x, in_halo, out_halo, out_halo)
+        values[id(layer.output)] = (out_halo, y)
+
+    in_halo, y = values[id(self.output)]
+    return np.asarray(crop_halo(y, in_halo, 0, 0))
+
+
+################################################################################
+# Maps
+################################################################################
+class OneToTwoMap:
+  """ 2D map of a OneToTwo operation, computed per region from 1D values. """
+  def __init__(self, oned, operation):
+    self.oned = oned
+    self.operation = operation
+    self.batch, self.size, self.channels = oned.shape
+    self.symmetric = operation != 'concat'
+    if operation == 'concat':
+      self.channels *= 2
+
+  def region(self, r0, r1, c0, c1):
+    """ Return rows [r0,r1) and columns [c0,c1), zero beyond the map. """
+    twod1 = pad_slice(self.oned, c0, c1)[:,np.newaxis,:,:]
+    twod2 = pad_slice(self.oned, r0, r1)[:,:,np.newaxis,:]
+
+    if self.operation == 'concat':
+      shape = (self.batch, r1-r0, c1-c0, self.oned.shape[-1])
+      x = np.concatenate([np.broadcast_to(twod1, shape), np.broadcast_to(twod2, shape)], axis=-1)
+    elif self.operation == 'multiply':
+      x = twod1 * twod2
+    elif self.operation == 'multiply1':
+      x = (twod1+1) * (twod2+1) - 1
+    elif self.operation == 'max':
+      x = np.maximum(twod1, twod2)
+    else:
+      x = (twod1 + twod2) / 2
+
+    return x * region_mask(r0, r1, c0, c1, self.size)
+
+
+class TileMap:
+  """ 2D map stored as square tiles, only those on and above the
+      diagonal when symmetric. """
+  def __init__(self, batch, size, channels, tile_size, symmetric=True):
+    self.batch = batch
+    self.size = size
+    self.channels = channels
+    self.tile_size = tile_size
+    self.symmetric = symmetric
+    self.num_tiles = -(-size // tile_size)
+    self.tiles = {}
+
+  def tile_bounds(self, ti):
+    return ti*self.tile_size, min((ti+1)*self.tile_size, self.size)
+
+  def tile_keys(self):
+    if self.symmetric:
+      return [(ti, tj) for ti in range(self.num_tiles) for tj in range(ti, self.num_tiles)]
+    else:
+      return [(ti, tj) for ti in range(self.num_tiles) for tj in range(self.num_tiles)]
+
+  def set_tile(self, ti, tj, x):
+    self.tiles[(ti,tj)] = x
+
+  def get_tile(self, ti, tj):
+    if ti <= tj or not self.symmetric:
+      return self.tiles[(ti,tj)]
+    else:
+      return np.transpose(self.tiles[(tj,ti)], [0,2,1,3])
+
+  def nbytes(self):
+    return sum(x.nbytes for x in self.tiles.values())
+
+  def region(self, r0, r1, c0, c1):
+    """ Return rows [r0,r1) and columns [c0,c1), zero beyond the map. """
+    x = np.zeros((self.batch, r1-r0, c1-c0, self.channels), dtype='float32')
+    t = self.tile_size
+    for ti in range(max(r0,0)//t, -(-min(r1,self.size)//t)):
+      tr0, tr1 = self.tile_bounds(ti)
+      lr0, lr1 = max(r0, tr0), min(r1, tr1)
+      for tj in range(max(c0,0)//t, -(-min(c1,self.size)//t)):
+        tc0, tc1 = self.tile_bounds(tj)
+        lc0, lc1 = max(c0, tc0), min(c1, tc1)
+        tile = self.get_tile(ti, tj)
+        x[:,lr0-r0:lr1-r0,lc0-c0:lc1-c0] = tile[:,lr0-tr0:lr1-tr0,lc0-tc0:lc1-tc0]
+    return x
+
+
+class PointwiseMap:
+  """ 2D map of a pointwise function of another map, computed per region. """
+  def __init__(self, base, fn):
+    self.base = base
+    self.fn = fn
+    self.batch = base.batch
+    self.size = base.size
+    self.channels = base.channels
+    self.symmetric = base.symmetric
+
+  def region(self, r0, r1, c0, c1):
+    x = self.fn(self.base.region(r0, r1, c0, c1))
+    return x * region_mask(r0, r1, c0, c1, self.size)
+
+
+class CropMap:
+  """ Square 2D map cropped from another by top rows and left columns. """
+  def __init__(self, base, top, left, size):
+    self.base = base
+    self.top = top
+    self.left = left
+    self.batch = base.batch
+    self.size = size
+    self.channels = base.channels
+    self.symmetric = base.symmetric and top == left
+
+  def region(self, r0, r1, c0, c1):
+    x = self.base.region(r0+self.top, r1+self.top, c0+self.left, c1+self.left)
+    return x * region_mask(r0, r1, c0, c1, self.size)
+
+
+def pad_slice(x, start, end):
+  """ Slice [start, end) of axis 1, zero padding beyond its ends. """
+  length = x.shape[1]
+  x_slice = np.zeros((x.shape[0], end-start) + x.shape[2:], dtype=x.dtype)
+  lo, hi = max(start, 0), min(end, length)
+  if hi > lo:
+    x_slice[:,lo-start:hi-start] = x[:,lo:hi]
+  return x_slice
+
+
+def region_mask(r0, r1, c0, c1, size):
+  """ [1, r1-r0, c1-c0, 1] mask of positions within a size x size map. """
+  rows = (np.arange(r0, r1) >= 0) & (np.arange(r0, r1) < size)
+  cols = (np.arange(c0, c1) >= 0) & (np.arange(c0, c1) < size)
+  mask = rows[:,np.newaxis] & cols[np.newaxis,:]
+  return mask[np.newaxis,:,:,np.newaxis].astype('float32')
+
+
+def crop_halo(x, halo, halo_r, halo_c):
+  """ Crop a region with halo on each side to halos halo_r and halo_c. """
+  dr = halo - halo_r
+  dc = halo - halo_c
+  return x[:,dr:x.shape[1]-dr,dc:x.shape[2]-dc]
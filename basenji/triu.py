@@ -0,0 +1,133 @@
+# Copyright 2023 Calico LLC
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     https://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+
+from functools import lru_cache
+
+import numpy as np
+
+################################################################################
+# triu.py
+#
+# Cached index maps between square contact matrices and the upper triangular
+# vectors predicted by Akita models. All maps are keyed by
+# (matrix_len, diagonal_offset), returned as read-only int32 arrays, and
+# shared between callers.
+################################################################################
+
+def _readonly(a):
+  a.setflags(write=False)
+  return a
+
+
+def triu_len(matrix_len, diagonal_offset=2):
+  """ Number of upper triangular entries of a matrix_len x matrix_len matrix,
+      above diagonal_offset."""
+  n = max(matrix_len - diagonal_offset, 0)
+  return n * (n + 1) // 2
+
+
+def triu_matrix_len(ut_len, diagonal_offset=2):
+  """ Infer the matrix length from an upper triangular vector length."""
+  matrix_len = int(np.sqrt(2 * ut_len + 0.25) - 0.5)
+  matrix_len += diagonal_offset
+  if triu_len(matrix_len, diagonal_offset) != ut_len:
+    raise ValueError('Upper triangular length %d does not match diagonal offset %d' % \
+                     (ut_len, diagonal_offset))
+  return matrix_len
+
+
+@lru_cache(maxsize=32)
+def triu_indices(matrix_len, diagonal_offset=2):
+  """ Row and column indexes of the upper triangular entries, as
+      np.triu_indices(matrix_len, diagonal_offset).
+
+  Args:
+    matrix_len:      Matrix length.
+    diagonal_offset: Number of ignored diagonals.
+
+  Returns:
+    (rows, cols):    Read-only int32 arrays.
+  """
+  rows, cols = np.triu_indices(matrix_len, diagonal_offset)
+  return _readonly(rows.astype('int32')), _readonly(cols.astype('int32'))
+
+
+@lru_cache(maxsize=32)
+def triu_flat_index(matrix_len, diagonal_offset=2):
+  """ Row-major flat indexes (row*matrix_len + col) of the upper triangular
+      entries in a matrix_len*matrix_len unrolled matrix."""
+  rows, cols = triu_indices(matrix_len, diagonal_offset)
+  return _readonly(rows * matrix_len + cols)
+
+
+@lru_cache(maxsize=32)
+def triu_flat_index_t(matrix_len, diagonal_offset=2):
+  """ Row-major flat indexes (col*matrix_len + row) of the transposed upper
+      triangular entries, i.e. their mirrored lower triangular positions."""
+  rows, cols = triu_indices(matrix_len, diagonal_offset)
+  return _readonly(rows + cols * matrix_len)
+
+
+@lru_cache(maxsize=32)
+def triu_dense_index(matrix_len, diagonal_offset=2):
+  """ Upper triangular vector index of every entry of the symmetric dense
+      matrix, row-major flattened.
+
+  Gathering a vector padded with one trailing zero entry by this map
+  expands it to its symmetric dense matrix; entries within diagonal_offset
+  of the diagonal point to the padding.
+
+  Args:
+    matrix_len:      Matrix length.
+    diagonal_offset: Number of ignored diagonals.
+
+  Returns:
+    dense_index:     Read-only int32 array of length matrix_len**2.
+  """
+  rows, cols = triu_indices(matrix_len, diagonal_offset)
+  ut_len = len(rows)
+
+  mat_indexes = np.full((matrix_len, matrix_len), ut_len, dtype='int32')
+  mat_indexes[rows, cols] = np.arange(ut_len, dtype='int32')
+  mat_indexes[cols, rows] = np.arange(ut_len, dtype='int32')
+  return _readonly(mat_indexes.ravel())
+
+
+@lru_cache(maxsize=32)
+def triu_rc_order(matrix_len, diagonal_offset=2):
+  """ Upper triangular vector order of the reverse complemented sequence.
+
+  Reverse complementing a sequence flips its contact matrix along both axes,
+  which maps entry (i, j) to (L-1-j, L-1-i) after symmetrization. Gathering a
+  vector with this order transforms its predictions accordingly.
+
+  Args:
+    matrix_len:      Matrix length.
+    diagonal_offset: Number of ignored diagonals.
+
+  Returns:
+    rc_ut_order:     Read-only int32 array of upper triangular vector indexes.
+  """
+  rows, cols = triu_indices(matrix_len, diagonal_offset)
+  ut_len = len(rows)
+
+  # construct a symmetric matrix of ut indexes
+  mat_indexes = np.zeros((matrix_len, matrix_len), dtype='int32')
+  mat_indexes[rows, cols] = np.arange(ut_len, dtype='int32')
+  mat_indexes[cols, rows] = np.arange(ut_len, dtype='int32')
+
+  # reverse complement and extract ut order
+  mat_rc_indexes = mat_indexes[::-1, ::-1]
+  return _readonly(np.ascontiguousarray(mat_rc_indexes[rows, cols]))
@@ -26,6 +26,7 @@ import pandas as pd
 import pysam
 
 import basenji.dna_io
+import basenji.genome
 """vcf.py
 
 Methods and classes to support .vcf SNP analysis.
@@ -188,47 +189,36 @@ def snp_seq1(snp, seq_len, genome_open):
     Attrs:
         snp [SNP] :
         seq_len (int) : sequence length to code
-        genome_open (File) : open genome FASTA file
+        genome_open (File) : open genome FASTA file or GenomeStore
 
     Return:
         seq_vecs_list [array] : list of one hot coded sequences surrounding the
         SNP
     """
   left_len = seq_len // 2 - 1
-  right_len = seq_len // 2
 
   # initialize one hot coded vector list
   seq_vecs_list = []
 
-  # specify positions in GFF-style 1-based
-  seq_start = snp.pos - left_len
-  seq_end = snp.pos + right_len + max(0,
-                                      len(snp.ref_allele) - snp.longest_alt())
-
-  # extract sequence as BED style
-  if seq_start < 0:
-    seq = 'N'*(1-seq_start) + genome_open.fetch(snp.chr, 0, seq_end).upper()
-  else:
-    seq = genome_open.fetch(snp.chr, seq_start - 1, seq_end).upper()
-
-  # extend to full length
-  if len(seq) < seq_end - seq_start:
-    seq += 'N' * (seq_end - seq_start - len(seq))
+  # extract sequence as nucleotide indexes
+  seq = snp_seq_index(snp, seq_len, genome_open)
+  ref_index = basenji.dna_io.dna_1hot_index(snp.ref_allele)
 
   # verify that ref allele matches ref sequence
-  seq_ref = seq[left_len:left_len + len(snp.ref_allele)]
+  seq_ref = seq[left_len:left_len + len(ref_index)]
   ref_found = True
-  if seq_ref != snp.ref_allele:
+  if not np.array_equal(seq_ref, ref_index):
 
     # search for reference allele in alternatives
     ref_found = False
 
     # for each alternative allele
     for alt_al in snp.alt_alleles:
+      alt_index = basenji.dna_io.dna_1hot_index(alt_al)
 
       # grab reference sequence matching alt length
-      seq_ref_alt = seq[left_len:left_len + len(alt_al)]
-      if seq_ref_alt == alt_al:
+      seq_ref_alt = seq[left_len:left_len + len(alt_index)]
+      if np.array_equal(seq_ref_alt, alt_index):
         # found it!
         ref_found = True
 
@@ -239,7 +229,7 @@ def snp_seq1(snp, seq_len, genome_open):
             file=sys.stderr)
 
         # remove alt allele and include ref allele
-        seq = seq[:left_len] + snp.ref_allele + seq[left_len + len(alt_al):]
+        seq = np.concatenate([seq[:left_len], ref_index, seq[left_len + len(alt_index):]])
         break
 
   if not ref_found:
@@ -247,27 +237,45 @@ def snp_seq1(snp, seq_len, genome_open):
 
   else:
     # one hot code ref allele
-    seq_vecs_ref, seq_ref = dna_length_1hot(seq, seq_len)
+    seq_vecs_ref, seq_ref = index_length_1hot(seq, seq_len)
     seq_vecs_list.append(seq_vecs_ref)
 
     for alt_al in snp.alt_alleles:
       # remove ref allele and include alt allele
-      seq_alt = seq[:left_len] + alt_al + seq[left_len + len(snp.ref_allele):]
+      alt_index = basenji.dna_io.dna_1hot_index(alt_al)
+      seq_alt = np.concatenate([seq[:left_len], alt_index, seq[left_len + len(ref_index):]])
 
       # one hot code
-      seq_vecs_alt, seq_alt = dna_length_1hot(seq_alt, seq_len)
+      seq_vecs_alt, seq_alt = index_length_1hot(seq_alt, seq_len)
       seq_vecs_list.append(seq_vecs_alt)
 
   return seq_vecs_list
 
 
+def snp_seq_index(snp, seq_len, genome_open):
+  """ Fetch the sequence surrounding a SNP as a uint8 nucleotide index
+      array (N=4), padded with N's beyond the chromosome ends. A
+      GenomeStore decodes it directly from its packed arrays. """
+  left_len = seq_len // 2 - 1
+  right_len = seq_len // 2
+
+  # specify positions in GFF-style 1-based
+  seq_start = snp.pos - left_len
+  seq_end = snp.pos + right_len + max(0,
+                                      len(snp.ref_allele) - snp.longest_alt())
+
+  # extract sequence as BED style
+  return basenji.genome.fetch_seq(genome_open, snp.chr, seq_start - 1, seq_end,
+                                  seq_index=True)
+
+
 def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
   """ Produce an array of one hot coded sequences for a list of SNPs.
 
     Attrs:
         snps [SNP] : list of SNPs
         seq_len (int) : sequence length to code
-        genome_fasta (str) : genome FASTA file
+        genome_fasta (str) : genome FASTA file or genome store
 
     Return:
         seq_vecs (array) : one hot coded sequences surrounding the SNPs
@@ -275,7 +283,6 @@ def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
         seq_snps [SNP] : list of used SNPs
     """
   left_len = seq_len // 2 - 1
-  right_len = seq_len // 2
 
   # initialize one hot coded vector list
   seq_vecs_list = []
@@ -290,38 +297,27 @@ def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
   seq_headers = []
 
   # open genome FASTA
-  genome_open = pysam.Fastafile(genome_fasta)
+  genome_open = basenji.genome.open_genome(genome_fasta)
 
   for snp in snps:
-    # specify positions in GFF-style 1-based
-    seq_start = snp.pos - left_len
-    seq_end = snp.pos + right_len + max(0,
-                                        len(snp.ref_allele) - snp.longest_alt())
-
-    # extract sequence as BED style
-    if seq_start < 0:
-      seq = 'N' * (-seq_start) + genome_open.fetch(snp.chr, 0,
-                                                   seq_end).upper()
-    else:
-      seq = genome_open.fetch(snp.chr, seq_start - 1, seq_end).upper()
-
-    # extend to full length
-    if len(seq) < seq_end - seq_start:
-      seq += 'N' * (seq_end - seq_start - len(seq))
+    # extract sequence as nucleotide indexes
+    seq = snp_seq_index(snp, seq_len, genome_open)
+    ref_index = basenji.dna_io.dna_1hot_index(snp.ref_allele)
 
     # verify that ref allele matches ref sequence
-    seq_ref = seq[left_len:left_len + len(snp.ref_allele)]
-    if seq_ref != snp.ref_allele:
+    seq_ref = seq[left_len:left_len + len(ref_index)]
+    if not np.array_equal(seq_ref, ref_index):
 
       # search for reference allele in alternatives
       ref_found = False
 
       # for each alternative allele
       for alt_al in snp.alt_alleles:
+        alt_index = basenji.dna_io.dna_1hot_index(alt_al)
 
         # grab reference sequence matching alt length
-        seq_ref_alt = seq[left_len:left_len + len(alt_al)]
-        if seq_ref_alt == alt_al:
+        seq_ref_alt = seq[left_len:left_len + len(alt_index)]
+        if np.array_equal(seq_ref_alt, alt_index):
           # found it!
           ref_found = True
 
@@ -332,36 +328,37 @@ def snps_seq1(snps, seq_len, genome_fasta, return_seqs=False):
               file=sys.stderr)
 
           # remove alt allele and include ref allele
-          seq = seq[:left_len] + snp.ref_allele + seq[left_len + len(alt_al):]
+          seq = np.concatenate([seq[:left_len], ref_index, seq[left_len + len(alt_index):]])
           break
 
       if not ref_found:
         print(
             'WARNING: %s - reference genome %s does not match any allele; skipping'
-            % (seq_ref, snp.rsid),
+            % (basenji.dna_io.index_dna(seq_ref), snp.rsid),
             file=sys.stderr)
         continue
 
     seq_snps.append(snp)
 
     # one hot code ref allele
-    seq_vecs_ref, seq_ref = dna_length_1hot(seq, seq_len)
+    seq_vecs_ref, seq_ref = index_length_1hot(seq, seq_len)
     seq_vecs_list.append(seq_vecs_ref)
     if return_seqs:
-      seqs.append(seq_ref)
+      seqs.append(basenji.dna_io.index_dna(seq_ref))
 
     # name ref allele
     seq_headers.append('%s_%s' % (snp.rsid, cap_allele(snp.ref_allele)))
 
     for alt_al in snp.alt_alleles:
       # remove ref allele and include alt allele
-      seq_alt = seq[:left_len] + alt_al + seq[left_len + len(snp.ref_allele):]
+      alt_index = basenji.dna_io.dna_1hot_index(alt_al)
+      seq_alt = np.concatenate([seq[:left_len], alt_index, seq[left_len + len(ref_index):]])
 
       # one hot code
-      seq_vecs_alt, seq_alt = dna_length_1hot(seq_alt, seq_len)
+      seq_vecs_alt, seq_alt = index_length_1hot(seq_alt, seq_len)
       seq_vecs_list.append(seq_vecs_alt)
       if return_seqs:
-        seqs.append(seq_alt)  # not using right now
+        seqs.append(basenji.dna_io.index_dna(seq_alt))  # not using right now
 
       # name
       seq_headers.append('%s_%s' % (snp.rsid, cap_allele(alt_al)))
@@ -393,8 +390,8 @@ def snps2_seq1(snps, seq_len, genome1_fasta, genome2_fasta, return_seqs=False):
   right_len = seq_len // 2
 
   # open genome FASTA
-  genome1 = pysam.Fastafile(genome1_fasta)
-  genome2 = pysam.Fastafile(genome2_fasta)
+  genome1 = basenji.genome.open_genome(genome1_fasta)
+  genome2 = basenji.genome.open_genome(genome2_fasta)
 
   # initialize one hot coded vector list
   seq_vecs_list = []
@@ -509,6 +506,29 @@ def dna_length_1hot(seq, length):
 
   return seq_1hot, seq
 
+
+def index_length_1hot(seq_index, length):
+  """ Adjust the length of a nucleotide index sequence, like
+        dna_length_1hot, and compute a 1hot coding. """
+
+  if length < len(seq_index):
+    # trim the sequence
+    seq_trim = (len(seq_index) - length) // 2
+    seq_index = seq_index[seq_trim:seq_trim + length]
+
+  elif length > len(seq_index):
+    # extend with N's
+    nfront = (length - len(seq_index)) // 2
+    nback = length - len(seq_index) - nfront
+    seq_index = np.concatenate([np.full(nfront, 4, dtype='uint8'), seq_index,
+                                np.full(nback, 4, dtype='uint8')])
+
+  # n_uniform required to avoid different
+  #   random nucleotides for each allele
+  seq_1hot = basenji.dna_io.index_1hot(seq_index, n_uniform=True)
+
+  return seq_1hot, seq_index
+
 def vcf_count(vcf_file):
   """ Count SNPs in a VCF file """
   if vcf_file[-3:] == '.gz':
@@ -552,7 +572,7 @@ def vcf_snps(vcf_file, require_sorted=False, validate_ref_fasta=None,
 
   # to check reference
   if validate_ref_fasta is not None:
-    genome_open = pysam.Fastafile(validate_ref_fasta)
+    genome_open = basenji.genome.open_genome(validate_ref_fasta)
 
   # read in SNPs
   snps = []
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import time
+
+import tensorflow as tf
+if tf.__version__[0] == '1':
+  tf.compat.v1.enable_eager_execution()
+
+from basenji import dataset
+
+"""
+akita_data_bench.py
+
+Benchmark SeqDataset input pipeline throughput, comparing per-record
+parsing with batched parsing (and optionally a memory-mapped cache).
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <data_dir>'
+  parser = OptionParser(usage)
+  parser.add_option('-b', dest='batch_size',
+      default=8, type='int',
+      help='Batch size [Default: %default]')
+  parser.add_option('-m', dest='mmap_dir',
+      default=None,
+      help='Also benchmark this memory-mapped cache [Default: %default]')
+  parser.add_option('--mode', dest='mode',
+      default='train',
+      help='Dataset mode, train or eval [Default: %default]')
+  parser.add_option('-n', dest='num_batches',
+      default=32, type='int',
+      help='Batches to time, after one warm up batch [Default: %default]')
+  parser.add_option('--seq_index', dest='seq_index',
+      default=False, action='store_true',
+      help='Yield uint8 nucleotide indexes rather than one hot coding [Default: %default]')
+  parser.add_option('--split', dest='split_label',
+      default='train',
+      help='Dataset split [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error('Must provide data directory.')
+  else:
+    data_dir = args[0]
+
+  configs = [('single', {}), ('batched', {'batch_parse': True})]
+  if options.mmap_dir is not None:
+    configs.append(('mmap', {'mmap_dir': options.mmap_dir}))
+
+  for label, config in configs:
+    seq_data = dataset.SeqDataset(data_dir, options.split_label,
+                                  options.batch_size, mode=options.mode,
+                                  seq_index=options.seq_index, **config)
+    num_seqs, elapsed = time_dataset(seq_data.dataset, options.num_batches)
+    print('%-8s %6d seqs %7.2fs %8.1f seqs/s' % \
+          (label, num_seqs, elapsed, num_seqs / max(elapsed, 1e-9)), flush=True)
+
+
+def time_dataset(tf_dataset, num_batches):
+  """Iterate num_batches batches after one warm up batch, returning
+     the sequences read and seconds elapsed."""
+  data_iter = iter(tf_dataset)
+  next(data_iter)
+
+  num_seqs = 0
+  t0 = time.time()
+  for _ in range(num_batches):
+    try:
+      seqs_batch, _ = next(data_iter)
+    except StopIteration:
+      break
+    num_seqs += seqs_batch.shape[0]
+  return num_seqs, time.time() - t0
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import glob
+import time
+
+from natsort import natsorted
+
+from basenji import dataset
+
+"""
+akita_data_index.py
+
+Build the per-file record index sidecars (record offset and length in
+the uncompressed stream) of a data directory's TFRecord splits, read by
+SeqDataset(..., record_index=True) and SeqDataset.record_dataset.
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <data_dir>'
+  parser = OptionParser(usage)
+  parser.add_option('--splits', dest='splits',
+      default='train,valid,test',
+      help='Comma-separated splits to index [Default: %default]')
+  parser.add_option('-t', dest='num_threads',
+      default=None, type='int',
+      help='Files indexed in parallel [Default: CPU count]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error('Must provide data directory.')
+  else:
+    data_dir = args[0]
+
+  for split_label in options.splits.split(','):
+    t0 = time.time()
+    tfr_files = natsorted(glob.glob('%s/tfrecords/%s-*.tfr' % (data_dir, split_label)))
+    record_index = dataset.RecordIndex(tfr_files, num_threads=options.num_threads)
+    print('%s: %d records in %d files indexed in %.2fs' % \
+          (split_label, len(record_index), len(tfr_files), time.time()-t0), flush=True)
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
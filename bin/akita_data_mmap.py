@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import time
+
+import tensorflow as tf
+if tf.__version__[0] == '1':
+  tf.compat.v1.enable_eager_execution()
+
+from basenji import dataset
+
+"""
+akita_data_mmap.py
+
+Decode a data directory's TFRecord splits into fixed-stride, memory-mapped
+sequence and target files, read by SeqDataset(..., mmap_dir=...) without
+decompressing or parsing records every epoch.
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <data_dir>'
+  parser = OptionParser(usage)
+  parser.add_option('--1hot', dest='seq_1hot',
+      default=False, action='store_true',
+      help='Store sequences as bool one hot coding, rather than uint8 indexes [Default: %default]')
+  parser.add_option('-o', dest='mmap_dir',
+      default=None,
+      help='Output directory [Default: <data_dir>/mmap]')
+  parser.add_option('--splits', dest='splits',
+      default='train,valid,test',
+      help='Comma-separated splits to convert [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.error('Must provide data directory.')
+  else:
+    data_dir = args[0]
+
+  if options.mmap_dir is None:
+    options.mmap_dir = '%s/mmap' % data_dir
+  seq_format = '1hot' if options.seq_1hot else 'index'
+
+  for split_label in options.splits.split(','):
+    t0 = time.time()
+    dataset.write_mmap(data_dir, split_label, options.mmap_dir, seq_format)
+    print('%s written in %.2fs' % (split_label, time.time()-t0), flush=True)
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import json
+import time
+
+import tensorflow as tf
+if tf.__version__[0] == '1':
+  tf.compat.v1.enable_eager_execution()
+
+from basenji import inference
+from basenji import seqnn
+
+"""
+akita_export.py
+
+Export a trained model head, with optional ensembling, downcasting and
+index sequence input, to a SavedModel with a static input signature.
+Load it with basenji.inference.load_exported.
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <params_file> <model_file> <export_dir>'
+  parser = OptionParser(usage)
+  parser.add_option('-b', dest='batch_size',
+      default=4, type='int',
+      help='Static batch size [Default: %default]')
+  parser.add_option('--f16', dest='float16',
+      default=False, action='store_true',
+      help='Downcast predictions to float16 [Default: %default]')
+  parser.add_option('--head', dest='head_i',
+      default=0, type='int',
+      help='Model head index [Default: %default]')
+  parser.add_option('--index', dest='seq_index',
+      default=False, action='store_true',
+      help='Accept uint8 nucleotide index sequences [Default: %default]')
+  parser.add_option('--rc', dest='rc',
+      default=False, action='store_true',
+      help='Ensemble forward and reverse complement predictions [Default: %default]')
+  parser.add_option('--shifts', dest='shifts',
+      default='0',
+      help='Ensemble prediction shifts [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 3:
+    parser.error('Must provide parameters, model, and export directory.')
+  else:
+    params_file = args[0]
+    model_file = args[1]
+    export_dir = args[2]
+
+  options.shifts = [int(shift) for shift in options.shifts.split(',')]
+
+  #################################################################
+  # setup model
+
+  with open(params_file) as params_open:
+    params = json.load(params_open)
+  params_model = params['model']
+
+  t0 = time.time()
+  seqnn_model = seqnn.SeqNN(params_model)
+  seqnn_model.restore(model_file, options.head_i)
+  seqnn_model.build_ensemble(options.rc, options.shifts, batched=True)
+  if options.float16:
+    seqnn_model.downcast()
+  if options.seq_index:
+    seqnn_model.build_index()
+  print('Model built in %.2fs' % (time.time()-t0))
+
+  if seqnn_model.ensemble is not None:
+    model = seqnn_model.ensemble
+  else:
+    model = seqnn_model.model
+
+  #################################################################
+  # export
+
+  metadata = {
+    'params_file': params_file,
+    'model_file': model_file,
+    'head_i': options.head_i,
+    'rc': options.rc,
+    'shifts': options.shifts,
+    'float16': options.float16,
+    'seq_index': options.seq_index
+  }
+  inference.export_model(model, export_dir, options.batch_size, metadata)
+
+  # check load
+  exported = inference.load_exported(export_dir)
+  print('Exported %s, loads in %.2fs' % (export_dir, exported.load_time))
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+if tf.__version__[0] == '1':
+  tf.compat.v1.enable_eager_execution()
+
+from basenji import genome
+from basenji import seqnn
+
+"""
+akita_predict_tiled.py
+
+Predict contact maps for windows centered on BED intervals, evaluating
+the 2D stage in tiles so that windows longer than the training length,
+e.g. 2-4 Mb, fit in CPU memory. The genome may be a FASTA file or a
+packed genome store (*.gstore).
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <params_file> <model_file> <genome_file> <bed_file>'
+  parser = OptionParser(usage)
+  parser.add_option('-b', dest='batch_size',
+      default=1, type='int',
+      help='Batch size [Default: %default]')
+  parser.add_option('-c', dest='cropping',
+      default=None, type='int',
+      help='Override 2D cropping bins [Default: %default]')
+  parser.add_option('--f16', dest='float16',
+      default=False, action='store_true',
+      help='Store predictions as float16 [Default: %default]')
+  parser.add_option('--head', dest='head_i',
+      default=0, type='int',
+      help='Model head index [Default: %default]')
+  parser.add_option('-l', dest='seq_length',
+      default=None, type='int',
+      help='Window length, a multiple of the model pooling [Default: params]')
+  parser.add_option('-o', dest='out_dir',
+      default='tiled_out',
+      help='Output directory [Default: %default]')
+  parser.add_option('-t', dest='tile_size',
+      default=128, type='int',
+      help='2D tile size in bins [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 4:
+    parser.error('Must provide parameters, model, genome, and BED files.')
+  else:
+    params_file = args[0]
+    model_file = args[1]
+    genome_file = args[2]
+    bed_file = args[3]
+
+  if not os.path.isdir(options.out_dir):
+    os.mkdir(options.out_dir)
+
+  #################################################################
+  # setup model
+
+  with open(params_file) as params_open:
+    params = json.load(params_open)
+  params_model = params['model']
+
+  if options.seq_length is not None:
+    params_model['seq_length'] = options.seq_length
+  if options.cropping is not None:
+    for blocks in params_model.values():
+      if isinstance(blocks, list):
+        for block in blocks:
+          if isinstance(block, dict) and block.get('name') == 'cropping_2d':
+            block['cropping'] = options.cropping
+  seq_length = params_model['seq_length']
+
+  seqnn_model = seqnn.SeqNN(params_model)
+  seqnn_model.restore(model_file, options.head_i)
+  tiled = seqnn_model.build_tiled(options.tile_size, options.batch_size)
+
+  #################################################################
+  # windows
+
+  bed_df = pd.read_csv(bed_file, sep='\t', header=None, usecols=[0,1,2],
+                       names=['chrom','start','end'])
+  mid = (bed_df.start + bed_df.end) // 2
+  bed_df['start'] = mid - seq_length // 2
+  bed_df['end'] = bed_df.start + seq_length
+  num_seqs = bed_df.shape[0]
+
+  genome_open = genome.open_genome(genome_file)
+
+  #################################################################
+  # predict
+
+  preds_dtype = 'float16' if options.float16 else 'float32'
+  preds_h5 = h5py.File('%s/preds.h5' % options.out_dir, 'w')
+  preds_h5.create_dataset('chrom', data=np.array(bed_df.chrom, dtype='S'))
+  preds_h5.create_dataset('start', data=bed_df.start.values)
+  preds_h5.create_dataset('end', data=bed_df.end.values)
+  preds_dset = None
+
+  t0 = time.time()
+  for si in range(0, num_seqs, options.batch_size):
+    batch_df = bed_df.iloc[si:si+options.batch_size]
+    seqs_1hot = np.array([genome.fetch_seq(genome_open, chrom, start, end) \
+                          for chrom, start, end in batch_df.itertuples(index=False)])
+    preds_batch = tiled.predict(seqs_1hot)
+
+    if preds_dset is None:
+      preds_dset = preds_h5.create_dataset('preds',
+        shape=(num_seqs,) + preds_batch.shape[1:], dtype=preds_dtype)
+    preds_dset[si:si+len(batch_df)] = preds_batch.astype(preds_dtype)
+
+  preds_h5.close()
+  genome_open.close()
+
+  print('Predicted %d %d bp windows in %.2fs' % (num_seqs, seq_length, time.time()-t0))
+  print('Largest stored 2D map: %.1f MB' % (tiled.max_map_bytes / 2**20))
+
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright 2023 Calico LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =========================================================================
+from __future__ import print_function
+from optparse import OptionParser
+
+import json
+import os
+
+import tensorflow as tf
+if tf.__version__[0] == '1':
+  tf.compat.v1.enable_eager_execution()
+
+from basenji import dataset
+from basenji import quantize
+from basenji import seqnn
+
+"""
+akita_quantize.py
+
+Quantize a trained model head to TFLite, calibrating int8 quantization
+on a data split, and report per-target Pearson R against float32
+predictions on the test set.
+"""
+
+################################################################################
+# main
+################################################################################
+def main():
+  usage = 'usage: %prog [options] <params_file> <model_file> <data_dir>'
+  parser = OptionParser(usage)
+  parser.add_option('-b', dest='batch_size',
+      default=1, type='int',
+      help='Static batch size of the quantized model [Default: %default]')
+  parser.add_option('--calib', dest='calib_split',
+      default='train',
+      help='Calibration data split [Default: %default]')
+  parser.add_option('--calib_seqs', dest='calib_seqs',
+      default=64, type='int',
+      help='Number of calibration sequences [Default: %default]')
+  parser.add_option('--head', dest='head_i',
+      default=0, type='int',
+      help='Model head index [Default: %default]')
+  parser.add_option('--mode', dest='mode',
+      default='dynamic',
+      help='Quantization mode: %s [Default: %%default]' % '/'.join(quantize.QUANT_MODES))
+  parser.add_option('-o', dest='out_dir',
+      default='quant_out',
+      help='Output directory [Default: %default]')
+  parser.add_option('--split', dest='split_label',
+      default='test',
+      help='Dataset split label for the accuracy report [Default: %default]')
+  parser.add_option('--threads', dest='num_threads',
+      default=None, type='int',
+      help='TFLite interpreter threads [Default: %default]')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 3:
+    parser.error('Must provide parameters, model, and data directory.')
+  else:
+    params_file = args[0]
+    model_file = args[1]
+    data_dir = args[2]
+
+  if not os.path.isdir(options.out_dir):
+    os.mkdir(options.out_dir)
+
+  #################################################################
+  # setup model
+
+  with open(params_file) as params_open:
+    params = json.load(params_open)
+  params_model = params['model']
+  params_train = params['train']
+
+  seqnn_model = seqnn.SeqNN(params_model)
+  seqnn_model.restore(model_file, options.head_i)
+
+  #################################################################
+  # quantize
+
+  calib_data = None
+  if options.mode == 'int8':
+    calib_data = dataset.SeqDataset(data_dir,
+      split_label=options.calib_split,
+      batch_size=params_train['batch_size'],
+      mode='eval')
+
+  tflite_model = quantize.quantize_model(seqnn_model.model, options.mode,
+                                         batch_size=options.batch_size,
+                                         calib_data=calib_data,
+                                         calib_seqs=options.calib_seqs)
+
+  tflite_file = '%s/model%d_%s.tflite' % (options.out_dir, options.head_i, options.mode)
+  with open(tflite_file, 'wb') as tflite_open:
+    tflite_open.write(tflite_model)
+
+  #################################################################
+  # accuracy report
+
+  eval_data = dataset.SeqDataset(data_dir,
+    split_label=options.split_label,
+    batch_size=params_train['batch_size'],
+    mode='eval')
+
+  quant_model = quantize.QuantizedModel(tflite_model, num_threads=options.num_threads)
+  report_df = quantize.accuracy_report(seqnn_model.model, quant_model, eval_data)
+  report_df.to_csv('%s/acc_%s.txt' % (options.out_dir, options.mode),
+                   sep='\t', index=False, float_format='%.4f')
+
+  print('%s size: %.1f MB' % (tflite_file, len(tflite_model)/2**20))
+  print('Test PearsonR float32: %.4f' % report_df.pearsonr_float.mean())
+  print('Test PearsonR %s: %.4f' % (options.mode, report_df.pearsonr_quant.mean()))
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+  main()